@@ -0,0 +1,199 @@
+# Activities that could not be delivered are stored in the outbox_item table and re-sent later by drain_outbox(), which
+# 'flask outbox drain' runs from cron. Each item is retried with jittered exponential backoff until it is delivered or
+# OUTBOX_MAX_ATTEMPTS is reached. The health columns of Instance (failures, dormant, start_trying_again, gone_forever)
+# act as a circuit breaker - nothing is sent to a dormant instance until start_trying_again, the first failure during a
+# drain stops any more attempts to that instance until the next one, and an instance that is gone_forever has its
+# items dropped.
+
+import json
+import random
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from flask import current_app
+from sqlalchemy import text
+
+from app import db
+from app.activitypub.signature import HttpSignature
+from app.models import OutboxItem, Instance, User, Community, Notification, ActivityPubLog, utcnow
+from app.utils import awaken_dormant_instance, record_delivery_results, redis_connection, shorten_string
+
+OUTBOX_BASE_DELAY = 60          # seconds before the first retry. Doubles with each attempt...
+OUTBOX_MAX_DELAY = 6 * 60 * 60  # ...up to this
+OUTBOX_DRAIN_LOCK = 'outbox:drain'
+OUTBOX_DRAIN_ADVISORY_LOCK = 7244     # postgres advisory lock id, used instead of redis when REDIS_URL is not set
+
+
+# Seconds to wait before the next attempt. Randomised by +/- 50% so that items which failed together (e.g. during an
+# outage of the remote instance) don't all come back at the same moment.
+def retry_delay(attempts: int) -> float:
+    delay = min(OUTBOX_BASE_DELAY * 2 ** max(attempts - 1, 0), OUTBOX_MAX_DELAY)
+    return delay * random.uniform(0.5, 1.5)
+
+
+# Store an activity that could not be delivered, to be tried again later. Sign it as user_id or community_id.
+# The caller needs to commit.
+def queue_for_retry(instance_id: int | None, destination: str, payload: dict, user_id: int = None,
+                    community_id: int = None, error: str = None, notify_title: str = None, notify_url: str = None):
+    db.session.add(OutboxItem(instance_id=instance_id, destination=destination, activity_id=payload.get('id'),
+                              activity_json=json.dumps(payload), user_id=user_id, community_id=community_id,
+                              attempts=1, next_attempt_at=utcnow() + timedelta(seconds=retry_delay(1)),
+                              last_error=shorten_string(error, 255) if error else None,
+                              notify_title=shorten_string(notify_title) if notify_title else None, notify_url=notify_url))
+
+
+# Tell a local user that something they did could not be sent to the remote server
+def notify_delivery_failure(user_id: int, title: str, url: str):
+    user = User.query.get(user_id)
+    if user:
+        db.session.add(Notification(title=shorten_string(title), url=url or '', user_id=user.id, author_id=user.id))
+        user.unread_notifications += 1
+
+
+def abandon(item: OutboxItem, reason: str):
+    payload = json.loads(item.activity_json)
+    db.session.add(ActivityPubLog(direction='out', activity_json=item.activity_json,
+                                  activity_type=payload.get('type', ''), activity_id=item.activity_id,
+                                  result='failure', exception_message=f'Gave up sending to {item.destination} after '
+                                                                      f'{item.attempts} attempts. {reason}'))
+    if item.notify_title and item.user_id:
+        notify_delivery_failure(item.user_id, item.notify_title, item.notify_url)
+    db.session.delete(item)
+
+
+# Re-send items from the outbox. Only items that are due are sent unless force is True. Returns a dict of counts, or
+# None if another drain is already running.
+def drain_outbox(limit: int = 1000, force: bool = False, domain: str = None):
+    redis = redis_connection()
+    if redis is None:
+        # hold a session level advisory lock on a connection of its own, so the commits in _drain_outbox don't release it
+        with db.engine.connect() as connection:
+            if not connection.execute(text('SELECT pg_try_advisory_lock(:id)'), {'id': OUTBOX_DRAIN_ADVISORY_LOCK}).scalar():
+                return None
+            try:
+                return _drain_outbox(limit, force, domain)
+            finally:
+                connection.execute(text('SELECT pg_advisory_unlock(:id)'), {'id': OUTBOX_DRAIN_ADVISORY_LOCK})
+    if not redis.set(OUTBOX_DRAIN_LOCK, 1, nx=True, ex=600):
+        return None
+    try:
+        return _drain_outbox(limit, force, domain)
+    finally:
+        redis.delete(OUTBOX_DRAIN_LOCK)
+
+
+def _drain_outbox(limit: int, force: bool, domain: str | None):
+    now = utcnow()
+    counts = {'sent': 0, 'failed': 0, 'deferred': 0, 'abandoned': 0}
+    query = OutboxItem.query
+    if not force:
+        query = query.filter(OutboxItem.next_attempt_at <= now)
+    if domain:
+        query = query.join(Instance, Instance.id == OutboxItem.instance_id).filter(Instance.domain == domain)
+    items = query.order_by(OutboxItem.id).limit(limit).all()
+    if not items:
+        return counts
+
+    # check the circuit breaker of each instance before sending anything
+    by_instance = defaultdict(list)
+    for item in items:
+        by_instance[item.instance_id].append(item)
+    ready = {}
+    for instance_id, instance_items in by_instance.items():
+        instance = instance_items[0].instance
+        awaken_dormant_instance(instance)
+        if instance and instance.gone_forever:
+            for item in instance_items:
+                abandon(item, f'{instance.domain} is gone.')
+            counts['abandoned'] += len(instance_items)
+        elif instance and instance.dormant and not force:
+            for item in instance_items:
+                item.next_attempt_at = instance.start_trying_again or now + timedelta(seconds=retry_delay(item.attempts))
+            counts['deferred'] += len(instance_items)
+        else:
+            ready[instance_id] = instance_items
+
+    # sign everything up front, so the threads below only need to do http
+    signers = {}
+    user_ids = set(item.user_id for items in ready.values() for item in items if item.user_id)
+    community_ids = set(item.community_id for items in ready.values() for item in items if item.community_id)
+    for user in User.query.filter(User.id.in_(user_ids)).all() if user_ids else []:
+        signers[('user', user.id)] = (user.private_key, user.profile_id() + '#main-key')
+    for community in Community.query.filter(Community.id.in_(community_ids)).all() if community_ids else []:
+        signers[('community', community.id)] = (community.private_key, community.ap_profile_id + '#main-key')
+    requests_to_send = {}
+    for instance_items in ready.values():
+        for item in instance_items:
+            signer = signers.get(('user', item.user_id) if item.user_id else ('community', item.community_id))
+            if signer is None or signer[0] is None:
+                abandon(item, 'Sender no longer exists.')
+                counts['abandoned'] += 1
+                continue
+            body_bytes, headers = HttpSignature.signed_requests([item.destination], json.loads(item.activity_json),
+                                                                signer[0], signer[1])
+            requests_to_send[item.id] = (item.destination, headers[item.destination], body_bytes)
+
+    # each instance gets at most OUTBOX_HOST_CONCURRENCY lanes, each sending its share of the items one after another.
+    # The first failure opens the circuit for that instance and the rest of its items wait for the next drain.
+    app = current_app._get_current_object()
+    host_concurrency = max(current_app.config['OUTBOX_HOST_CONCURRENCY'], 1)
+    circuit_open = {instance_id: threading.Event() for instance_id in ready}
+    lanes = []
+    for instance_id, instance_items in ready.items():
+        item_ids = [item.id for item in instance_items if item.id in requests_to_send]
+        for lane in range(host_concurrency):
+            if item_ids[lane::host_concurrency]:
+                lanes.append((instance_id, item_ids[lane::host_concurrency]))
+
+    def send_lane(lane):
+        instance_id, item_ids = lane
+        results = []
+        with app.app_context():
+            for item_id in item_ids:
+                if circuit_open[instance_id].is_set():
+                    break
+                destination, headers, body_bytes = requests_to_send[item_id]
+                try:
+                    response = HttpSignature.send_signed(destination, headers, body_bytes)
+                    error = None if response.status_code in (200, 202) else f'Response status code was {response.status_code}'
+                except Exception as e:
+                    error = str(e)
+                results.append((item_id, error))
+                if error is not None:
+                    circuit_open[instance_id].set()
+        return results
+
+    with ThreadPoolExecutor(max_workers=current_app.config['FEDERATION_FANOUT_CONCURRENCY']) as executor:
+        outcomes = dict(result for lane_results in executor.map(send_lane, lanes) for result in lane_results)
+
+    succeeded = set()
+    failed = set()
+    max_attempts = current_app.config['OUTBOX_MAX_ATTEMPTS']
+    for instance_id, instance_items in ready.items():
+        for item in instance_items:
+            if item.id not in requests_to_send:
+                continue
+            if item.id not in outcomes:     # not attempted because the circuit opened
+                item.next_attempt_at = now + timedelta(seconds=retry_delay(item.attempts))
+                counts['deferred'] += 1
+            elif outcomes[item.id] is None:
+                succeeded.add(instance_id)
+                db.session.delete(item)
+                counts['sent'] += 1
+            else:
+                failed.add(instance_id)
+                item.attempts += 1
+                item.last_error = shorten_string(outcomes[item.id], 255)
+                if item.attempts >= max_attempts:
+                    abandon(item, item.last_error)
+                    counts['abandoned'] += 1
+                else:
+                    item.next_attempt_at = now + timedelta(seconds=retry_delay(item.attempts))
+                    counts['failed'] += 1
+    succeeded.discard(None)
+    failed.discard(None)
+    record_delivery_results(list(succeeded - failed), list(failed))
+    db.session.commit()
+    return counts
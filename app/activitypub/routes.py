@@ -4,9 +4,9 @@ from app import db, constants, cache, celery
 from app.activitypub import bp
 from flask import request, current_app, abort, jsonify, json, g, url_for, redirect, make_response
 
-from app.activitypub.signature import HttpSignature, post_request
+from app.activitypub.signature import HttpSignature, post_request, VerificationError
 from app.community.routes import show_community
-from app.community.util import send_to_remote_instance
+from app.community.util import send_to_followers
 from app.post.routes import continue_discussion, show_post
 from app.user.routes import show_profile
 from app.constants import POST_TYPE_LINK, POST_TYPE_IMAGE, SUBSCRIPTION_MEMBER
@@ -18,11 +18,12 @@ from app.activitypub.util import public_key, users_total, active_half_year, acti
     lemmy_site_data, instance_weight, is_activitypub_request, downvote_post_reply, downvote_post, upvote_post_reply, \
     upvote_post, activity_already_ingested, delete_post_or_comment, community_members, \
     user_removed_from_remote_server, create_post, create_post_reply, update_post_reply_from_activity, \
-    update_post_from_activity, undo_vote, undo_downvote
+    update_post_from_activity, undo_vote, undo_downvote, mark_activity_ingested
 from app.utils import gibberish, get_setting, is_image_url, allowlist_html, html_to_markdown, render_template, \
     domain_from_url, markdown_to_html, community_membership, ap_datetime, markdown_to_text, ip_address, can_downvote, \
-    can_upvote, can_create_post, awaken_dormant_instance, shorten_string, can_create_post_reply, sha256_digest
+    can_upvote, can_create_post, shorten_string, can_create_post_reply, sha256_digest, invalidate_home_timeline
 import werkzeug.exceptions
+from werkzeug.test import EnvironBuilder
 
 
 @bp.route('/.well-known/webfinger')
@@ -319,65 +320,102 @@ def community_profile(actor):
 @bp.route('/inbox', methods=['GET', 'POST'])
 def shared_inbox():
     if request.method == 'POST':
-        # save all incoming data to aid in debugging and development. Set result to 'success' if things go well
-        activity_log = ActivityPubLog(direction='in', result='failure')
+        if current_app.config['INBOX_FAST_PATH']:
+            # Accept now, check later. Keep a copy of everything needed to verify the signature and hand it to celery.
+            try:
+                body = request.get_data().decode('utf-8')
+            except UnicodeDecodeError:
+                return '', 400
+            headers = list(request.headers.items())
+            if current_app.debug:
+                process_raw_inbox_request(body, headers, request.path, ip_address())
+            else:
+                process_raw_inbox_request.delay(body, headers, request.path, ip_address())
+            return '', 202
 
         try:
             request_json = request.get_json(force=True)
         except werkzeug.exceptions.BadRequest as e:
-            activity_log.exception_message = 'Unable to parse json body: ' + e.description
-            activity_log.result = 'failure'
+            activity_log = ActivityPubLog(direction='in', result='failure',
+                                          exception_message='Unable to parse json body: ' + e.description)
             db.session.add(activity_log)
             db.session.commit()
             return ''
+        ingest_inbox_request(request, request_json, g.site, ip_address(), synchronous=current_app.debug)
+    return ''
 
-        if 'id' in request_json:
-            if activity_already_ingested(request_json['id']):   # Lemmy has an extremely short POST timeout and tends to retry unnecessarily. Ignore their retries.
-                activity_log.result = 'ignored'
-                activity_log.exception_message = 'Unnecessary retry attempt'
-                db.session.add(activity_log)
-                db.session.commit()
-                return ''
 
-            activity_log.activity_id = request_json['id']
-            if g.site.log_activitypub_json:
-                activity_log.activity_json = json.dumps(request_json)
-            activity_log.result = 'processing'
+@celery.task
+def process_raw_inbox_request(body: str, headers: list, path: str, ip_address):
+    """ The second half of shared_inbox when INBOX_FAST_PATH is on - everything after the activity has been accepted """
+    with current_app.app_context():
+        inbox_request = EnvironBuilder(method='POST', path=path, headers=headers, data=body.encode('utf-8')).get_request()
+        try:
+            request_json = json.loads(body)
+        except ValueError as e:
+            activity_log = ActivityPubLog(direction='in', result='failure',
+                                          exception_message='Unable to parse json body: ' + str(e))
             db.session.add(activity_log)
             db.session.commit()
+            return
+        ingest_inbox_request(inbox_request, request_json, Site.query.get(1), ip_address, synchronous=True)
 
-            # When a user is deleted, the only way to be fairly sure they get deleted everywhere is to tell the whole fediverse.
-            if 'type' in request_json and request_json['type'] == 'Delete' and request_json['id'].endswith('#delete'):
-                if current_app.debug:
-                    process_delete_request(request_json, activity_log.id, ip_address())
-                else:
-                    process_delete_request.delay(request_json, activity_log.id, ip_address())
-                return ''
-        else:
-            activity_log.activity_id = ''
-            if g.site.log_activitypub_json:
-                activity_log.activity_json = json.dumps(request_json)
+
+def ingest_inbox_request(inbox_request, request_json, site, ip_address, synchronous):
+    # save all incoming data to aid in debugging and development. Set result to 'success' if things go well
+    activity_log = ActivityPubLog(direction='in', result='failure')
+
+    if 'id' in request_json:
+        if activity_already_ingested(request_json['id']):   # Lemmy has an extremely short POST timeout and tends to retry unnecessarily. Ignore their retries.
+            activity_log.result = 'ignored'
+            activity_log.exception_message = 'Unnecessary retry attempt'
             db.session.add(activity_log)
             db.session.commit()
+            return
 
-        actor = find_actor_or_create(request_json['actor']) if 'actor' in request_json else None
-        if actor is not None:
-            if HttpSignature.verify_request(request, actor.public_key, skip_date=True):
-                if current_app.debug:
-                    process_inbox_request(request_json, activity_log.id, ip_address())
-                else:
-                    process_inbox_request.delay(request_json, activity_log.id, ip_address())
-                return ''
+        activity_log.activity_id = request_json['id']
+        if site.log_activitypub_json:
+            activity_log.activity_json = json.dumps(request_json)
+        activity_log.result = 'processing'
+        db.session.add(activity_log)
+        db.session.commit()
+        mark_activity_ingested(request_json['id'])
+
+        # When a user is deleted, the only way to be fairly sure they get deleted everywhere is to tell the whole fediverse.
+        if 'type' in request_json and request_json['type'] == 'Delete' and request_json['id'].endswith('#delete'):
+            if synchronous:
+                process_delete_request(request_json, activity_log.id, ip_address)
+            else:
+                process_delete_request.delay(request_json, activity_log.id, ip_address)
+            return
+    else:
+        activity_log.activity_id = ''
+        if site.log_activitypub_json:
+            activity_log.activity_json = json.dumps(request_json)
+        db.session.add(activity_log)
+        db.session.commit()
+
+    actor = find_actor_or_create(request_json['actor']) if 'actor' in request_json else None
+    if actor is not None:
+        try:
+            verified = HttpSignature.verify_request(inbox_request, actor.public_key, skip_date=True)
+        except VerificationError:
+            verified = False
+        if verified:
+            if synchronous:
+                process_inbox_request(request_json, activity_log.id, ip_address)
             else:
-                activity_log.exception_message = 'Could not verify signature'
+                process_inbox_request.delay(request_json, activity_log.id, ip_address)
+            return
         else:
-            actor_name = request_json['actor'] if 'actor' in request_json else ''
-            activity_log.exception_message = f'Actor could not be found: {actor_name}'
+            activity_log.exception_message = 'Could not verify signature'
+    else:
+        actor_name = request_json['actor'] if 'actor' in request_json else ''
+        activity_log.exception_message = f'Actor could not be found: {actor_name}'
 
-        if activity_log.exception_message is not None:
-            activity_log.result = 'failure'
-        db.session.commit()
-    return ''
+    if activity_log.exception_message is not None:
+        activity_log.result = 'failure'
+    db.session.commit()
 
 
 @celery.task
@@ -728,6 +766,7 @@ def process_inbox_request(request_json, activitypublog_id, ip_address):
                                     db.session.add(member)
                                     community.subscriptions_count += 1
                                     db.session.commit()
+                                    invalidate_home_timeline(user.id)
                                 activity_log.result = 'success'
                                 cache.delete_memoized(community_membership, user, community)
 
@@ -954,15 +993,9 @@ def announce_activity_to_followers(community, creator, activity):
         "type": "Announce",
     }
 
-    for instance in community.following_instances(include_dormant=True):
-        # awaken dormant instances if they've been sleeping for long enough to be worth trying again
-        awaken_dormant_instance(instance)
-
-        # All good? Send!
-        if instance and instance.online() and not instance_blocked(instance.inbox):
-            if creator.instance_id != instance.id:    # don't send it to the instance that hosts the creator as presumably they already have the content
-                announce_activity['id'] = f"https://{current_app.config['SERVER_NAME']}/activities/announce/{gibberish(15)}"
-                send_to_remote_instance(instance.id, community.id, announce_activity)
+    announce_activity['id'] = f"https://{current_app.config['SERVER_NAME']}/activities/announce/{gibberish(15)}"
+    # don't send it to the instance that hosts the creator as presumably they already have the content
+    send_to_followers(community.id, announce_activity, exclude_instance_id=creator.instance_id, include_dormant=True)
 
 
 @bp.route('/c/<actor>/outbox', methods=['GET'])
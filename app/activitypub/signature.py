@@ -30,7 +30,12 @@
 from __future__ import annotations
 
 import base64
+import hashlib
 import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
 from typing import Literal, TypedDict, cast
 from urllib.parse import urlparse
 
@@ -44,10 +49,11 @@ from datetime import datetime
 from dateutil import parser
 from pyld import jsonld
 from email.utils import formatdate
-from app import db
+from app import db, celery
 from app.activitypub.util import default_context
 from app.constants import DATETIME_MS_FORMAT
-from app.models import utcnow, ActivityPubLog
+from app.models import utcnow, ActivityPubLog, User, Instance
+from app.utils import http_request, inbox_domain, awaken_dormant_instance, record_delivery_results
 
 
 def http_date(epoch_seconds=None):
@@ -106,6 +112,54 @@ def post_request(uri: str, body: dict | None, private_key: str, key_id: str, con
     return log.result != 'failure'
 
 
+def post_request_in_background(uri: str, body: dict, user_id: int, failure_message: str = None, failure_url: str = ''):
+    """
+    post_request, signed as a local user, done by celery so the user is not kept waiting for the remote server. If the
+    first attempt fails the activity goes into the outbox to be retried later. If it still can't be delivered the user
+    gets a notification (failure_message, linking to failure_url) instead of an error message, unless failure_message
+    is None because it was not something they did.
+    """
+    if '@context' not in body:  # add a default json-ld context if necessary
+        body['@context'] = default_context()
+    if current_app.debug:
+        send_post_request_task(uri, body, user_id, failure_message, failure_url)
+    else:
+        send_post_request_task.delay(uri, body, user_id, failure_message, failure_url)
+
+
+@celery.task
+def send_post_request_task(uri: str, body: dict, user_id: int, failure_message: str | None, failure_url: str):
+    from app.activitypub.outbox import queue_for_retry, notify_delivery_failure
+    user = User.query.get(user_id)
+    if user is None:
+        return
+    instance = Instance.query.filter_by(domain=inbox_domain(uri)).first()
+
+    if instance:
+        awaken_dormant_instance(instance)
+        if instance.gone_forever:
+            if failure_message:
+                notify_delivery_failure(user.id, failure_message, failure_url)
+                db.session.commit()
+            return
+        if instance.dormant:
+            # don't tie up a worker on an instance that is known to be down, the outbox will send it once it's back
+            queue_for_retry(instance.id, uri, body, user_id=user.id, error=f'{instance.domain} is dormant',
+                            notify_title=failure_message, notify_url=failure_url)
+            db.session.commit()
+            return
+
+    if post_request(uri, body, user.private_key, user.profile_id() + '#main-key'):
+        if instance:
+            record_delivery_results([instance.id], [])
+    else:
+        if instance:
+            record_delivery_results([], [instance.id])
+        queue_for_retry(instance.id if instance else None, uri, body, user_id=user.id,
+                        notify_title=failure_message, notify_url=failure_url)
+    db.session.commit()
+
+
 class VerificationError(BaseException):
     """
     There was an error with verifying the signature
@@ -122,6 +176,109 @@ class VerificationFormatError(VerificationError):
     pass
 
 
+class KeyCache(ABC):
+    """
+    LRU cache of parsed keys, so the same PEM is not parsed again for every activity. Subclasses implement load().
+
+    Keys are stored by key id and a hash of the PEM, so a key that has been rotated is never served from the cache
+    even by processes that didn't see the rotation.
+    """
+
+    def __init__(self, max_size: int = 1000):
+        self.max_size = max_size
+        self.keys: OrderedDict[tuple[str, str], object] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @abstractmethod
+    def load(self, pem: str):
+        """
+        Parse a PEM into a key instance
+        """
+
+    def get(self, key_id: str | None, pem: str):
+        cache_key = (key_id or '', hashlib.sha256(pem.encode("ascii")).hexdigest())
+        with self.lock:
+            key_instance = self.keys.get(cache_key)
+            if key_instance is not None:
+                self.keys.move_to_end(cache_key)
+                self.hits += 1
+                return key_instance
+            self.misses += 1
+        key_instance = self.load(pem)
+        with self.lock:
+            self.keys[cache_key] = key_instance
+            while len(self.keys) > self.max_size:
+                self.keys.popitem(last=False)
+        return key_instance
+
+    def invalidate(self, actor_url: str):
+        """
+        Forget every key belonging to an actor, e.g. after their profile was refreshed with a new key
+        """
+        actor_url = actor_url.lower()
+        with self.lock:
+            for cache_key in [k for k in self.keys if k[0].split('#')[0].lower() == actor_url]:
+                del self.keys[cache_key]
+
+
+class PublicKeyCache(KeyCache):
+    """
+    Public keys of remote actors, used to verify incoming activities. Also keeps counts that show how well the cache
+    and verification are performing in this process.
+    """
+
+    def __init__(self, max_size: int = 1000):
+        super().__init__(max_size)
+        self.verifications = 0
+        self.verification_seconds = 0.0
+
+    def load(self, pem: str) -> rsa.RSAPublicKey:
+        return cast(
+            rsa.RSAPublicKey,
+            serialization.load_pem_public_key(pem.encode("ascii")),
+        )
+
+    def record_verification(self, seconds: float):
+        with self.lock:
+            self.verifications += 1
+            self.verification_seconds += seconds
+            verifications = self.verifications
+        if verifications % 1000 == 0:
+            current_app.logger.info('Public key cache: ' + ', '.join(f'{k} {v}' for k, v in self.stats().items()))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.keys),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            'verifications': self.verifications,
+            'average_verification_ms': round(self.verification_seconds * 1000 / self.verifications, 3) if self.verifications else 0.0,
+        }
+
+
+class PrivateKeyCache(KeyCache):
+    """
+    Private keys of local users and communities, used to sign outgoing activities
+    """
+
+    def load(self, pem: str) -> rsa.RSAPrivateKey:
+        return cast(
+            rsa.RSAPrivateKey,
+            serialization.load_pem_private_key(
+                pem.encode("ascii"),
+                password=None,
+            ),
+        )
+
+
+public_key_cache = PublicKeyCache()
+private_key_cache = PrivateKeyCache()
+
+
 class RsaKeys:
     @classmethod
     def generate_keypair(cls) -> tuple[str, str]:
@@ -219,11 +376,10 @@ class HttpSignature:
         signature: bytes,
         cleartext: str,
         public_key: str,
+        key_id: str | None = None,
     ):
-        public_key_instance: rsa.RSAPublicKey = cast(
-            rsa.RSAPublicKey,
-            serialization.load_pem_public_key(public_key.encode("ascii")),
-        )
+        started = time.perf_counter()
+        public_key_instance = public_key_cache.get(key_id, public_key)
         try:
             public_key_instance.verify(
                 signature,
@@ -233,6 +389,8 @@ class HttpSignature:
             )
         except InvalidSignature:
             raise VerificationError("Signature mismatch")
+        finally:
+            public_key_cache.record_verification(time.perf_counter() - started)
 
     @classmethod
     def verify_request(cls, request: Request, public_key, skip_date=False):
@@ -270,43 +428,38 @@ class HttpSignature:
             signature_details["signature"],
             headers_string,
             public_key,
+            signature_details["keyid"],
         )
         return True
 
     @classmethod
-    def signed_request(
+    def signed_headers(
         cls,
         uri: str,
-        body: dict | None,
-        private_key: str,
+        private_key_instance: rsa.RSAPrivateKey,
         key_id: str,
+        digest: str | None,
+        date_string: str,
         content_type: str = "application/activity+json",
         method: Literal["get", "post"] = "post",
-        timeout: int = 5,
-    ):
+    ) -> dict[str, str]:
         """
-        Performs a request to the given path, with a document, signed
-        as an identity.
+        Creates the signed headers for one request. The body digest and date are passed in so they can be
+        shared by many requests carrying the same body.
         """
         if "://" not in uri:
             raise ValueError("URI does not contain a scheme")
         # Create the core header field set
         uri_parts = urlparse(uri)
-        date_string = http_date()
         headers = {
             "(request-target)": f"{method} {uri_parts.path}",
             "Host": uri_parts.hostname,
             "Date": date_string,
         }
         # If we have a body, add a digest and content type
-        if body is not None:
-            if '@context' not in body:                          # add a default json-ld context if necessary
-                body['@context'] = default_context()
-            body_bytes = json.dumps(body).encode("utf8")
-            headers["Digest"] = cls.calculate_digest(body_bytes)
+        if digest is not None:
+            headers["Digest"] = digest
             headers["Content-Type"] = content_type
-        else:
-            body_bytes = b""
         # GET requests get implicit accept headers added
         if method == "get":
             headers["Accept"] = "application/ld+json"
@@ -314,13 +467,6 @@ class HttpSignature:
         signed_string = "\n".join(
             f"{name.lower()}: {value}" for name, value in headers.items()
         )
-        private_key_instance: rsa.RSAPrivateKey = cast(
-            rsa.RSAPrivateKey,
-            serialization.load_pem_private_key(
-                private_key.encode("ascii"),
-                password=None,
-            ),
-        )
         signature = private_key_instance.sign(
             signed_string.encode("ascii"),
             padding.PKCS1v15(),
@@ -339,8 +485,45 @@ class HttpSignature:
 
         # Send the request with all those headers except the pseudo one
         del headers["(request-target)"]
+        return headers
+
+    @classmethod
+    def signed_requests(
+        cls,
+        uris: list[str],
+        body: dict,
+        private_key: str,
+        key_id: str,
+        content_type: str = "application/activity+json",
+    ) -> tuple[bytes, dict[str, dict[str, str]]]:
+        """
+        Signs one body for delivery to many inboxes. The body is serialized, digested and dated once and the
+        private key is parsed at most once; only the per-inbox headers are signed. Returns the body and the
+        headers to send to each uri, ready for send_signed().
+        """
+        if '@context' not in body:                          # add a default json-ld context if necessary
+            body['@context'] = default_context()
+        body_bytes = json.dumps(body).encode("utf8")
+        digest = cls.calculate_digest(body_bytes)
+        date_string = http_date()
+        private_key_instance = private_key_cache.get(key_id, private_key)
+        return body_bytes, {uri: cls.signed_headers(uri, private_key_instance, key_id, digest, date_string, content_type)
+                            for uri in uris}
+
+    @classmethod
+    def send_signed(
+        cls,
+        uri: str,
+        headers: dict[str, str],
+        body_bytes: bytes,
+        method: Literal["get", "post"] = "post",
+        timeout: int = 5,
+    ):
+        """
+        Sends a request whose headers were made by signed_headers()
+        """
         try:
-            response = requests.request(
+            response = http_request(
                 method,
                 uri,
                 headers=headers,
@@ -367,6 +550,34 @@ class HttpSignature:
 
         return response
 
+    @classmethod
+    def signed_request(
+        cls,
+        uri: str,
+        body: dict | None,
+        private_key: str,
+        key_id: str,
+        content_type: str = "application/activity+json",
+        method: Literal["get", "post"] = "post",
+        timeout: int = 5,
+    ):
+        """
+        Performs a request to the given path, with a document, signed
+        as an identity.
+        """
+        # If we have a body, add a digest
+        if body is not None:
+            if '@context' not in body:                          # add a default json-ld context if necessary
+                body['@context'] = default_context()
+            body_bytes = json.dumps(body).encode("utf8")
+            digest = cls.calculate_digest(body_bytes)
+        else:
+            body_bytes = b""
+            digest = None
+        headers = cls.signed_headers(uri, private_key_cache.get(key_id, private_key), key_id, digest, http_date(),
+                                     content_type, method)
+        return cls.send_signed(uri, headers, body_bytes, method, timeout)
+
 
 class HttpSignatureDetails(TypedDict):
     algorithm: str
@@ -401,10 +612,7 @@ class LDSignature:
         # Get the normalised hash of each document
         final_hash = cls.normalized_hash(options) + cls.normalized_hash(document)
         # Verify the signature
-        public_key_instance: rsa.RSAPublicKey = cast(
-            rsa.RSAPublicKey,
-            serialization.load_pem_public_key(public_key.encode("ascii")),
-        )
+        public_key_instance = public_key_cache.get(signature["creator"], public_key)
         try:
             public_key_instance.verify(
                 base64.b64decode(signature["signatureValue"]),
@@ -431,13 +639,7 @@ class LDSignature:
         # Get the normalised hash of each document
         final_hash = cls.normalized_hash(options) + cls.normalized_hash(document)
         # Create the signature
-        private_key_instance: rsa.RSAPrivateKey = cast(
-            rsa.RSAPrivateKey,
-            serialization.load_pem_private_key(
-                private_key.encode("ascii"),
-                password=None,
-            ),
-        )
+        private_key_instance = private_key_cache.get(key_id, private_key)
         signature = base64.b64encode(
             private_key_instance.sign(
                 final_hash,
@@ -4,7 +4,7 @@ import html
 import os
 from datetime import timedelta
 from random import randint
-from typing import Union, Tuple
+from typing import Union, Tuple, List
 from flask import current_app, request, g, url_for
 from flask_babel import _
 from sqlalchemy import text, func
@@ -13,6 +13,8 @@ from app.models import User, Post, Community, BannedInstances, File, PostReply,
     PostVote, PostReplyVote, ActivityPubLog, Notification, Site, CommunityMember, InstanceRole
 import time
 import base64
+import hashlib
+import redis
 import requests
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import padding
@@ -24,7 +26,8 @@ import pytesseract
 
 from app.utils import get_request, allowlist_html, html_to_markdown, get_setting, ap_datetime, markdown_to_html, \
     is_image_url, domain_from_url, gibberish, ensure_directory_exists, markdown_to_text, head_request, post_ranking, \
-    shorten_string, reply_already_exists, reply_is_just_link_to_gif_reaction, confidence, remove_tracking_from_link
+    shorten_string, reply_already_exists, reply_is_just_link_to_gif_reaction, confidence, remove_tracking_from_link, \
+    redis_connection, http_request, add_post_to_home_timelines, VoteTally, apply_vote_tally
 
 
 def public_key():
@@ -105,12 +108,12 @@ def send_activity(sender: User, host: str, content: str):
 
     # Make the HTTP request
     try:
-        response = requests.post(f'https://{host}{host_inbox}', headers=headers, data=content,
-                                 timeout=REQUEST_TIMEOUT)
+        response = http_request('POST', f'https://{host}{host_inbox}', headers=headers, data=content,
+                                timeout=REQUEST_TIMEOUT)
     except requests.exceptions.RequestException:
         time.sleep(1)
-        response = requests.post(f'https://{host}{host_inbox}', headers=headers, data=content,
-                                 timeout=REQUEST_TIMEOUT / 2)
+        response = http_request('POST', f'https://{host}{host_inbox}', headers=headers, data=content,
+                                timeout=REQUEST_TIMEOUT / 2)
     return response.status_code
 
 
@@ -350,6 +353,9 @@ def refresh_user_profile_task(user_id):
             user.user_name = activity_json['preferredUsername']
             user.about_html = parse_summary(activity_json)
             user.ap_fetched_at = utcnow()
+            if user.public_key != activity_json['publicKey']['publicKeyPem']:
+                from app.activitypub.signature import public_key_cache
+                public_key_cache.invalidate(user.ap_profile_id)
             user.public_key = activity_json['publicKey']['publicKeyPem']
             user.indexable = new_indexable
 
@@ -414,6 +420,9 @@ def refresh_community_profile_task(community_id):
             community.private_mods = activity_json['privateMods'] if 'privateMods' in activity_json else False
             community.ap_moderators_url = mods_url
             community.ap_fetched_at = utcnow()
+            if community.public_key != activity_json['publicKey']['publicKeyPem']:
+                from app.activitypub.signature import public_key_cache
+                public_key_cache.invalidate(community.ap_profile_id)
             community.public_key=activity_json['publicKey']['publicKeyPem']
 
             if 'source' in activity_json and \
@@ -736,9 +745,7 @@ def make_image_sizes_async(file_id, thumbnail_width, medium_width, directory):
 def parse_summary(user_json) -> str:
     if 'source' in user_json and user_json['source'].get('mediaType') == 'text/markdown':
         # Convert Markdown to HTML
-        markdown_text = user_json['source']['content']
-        html_content = html_to_markdown(markdown_text)
-        return html_content
+        return markdown_to_html(user_json['source']['content'])
     elif 'summary' in user_json:
         return allowlist_html(user_json['summary'])
     else:
@@ -928,147 +935,264 @@ def is_activitypub_request():
 
 
 def activity_already_ingested(ap_id):
+    # Ask the bloom filter first - if it has never seen this id there is no need to query the activity_pub_log table.
+    if ingested_filter_might_contain(ap_id) is False:
+        return None
     return db.session.execute(text('SELECT id FROM "activity_pub_log" WHERE activity_id = :activity_id'),
                               {'activity_id': ap_id}).scalar()
 
 
+# A bloom filter of recently ingested activity ids, kept in redis so all web workers share it. There is one bitmap per day,
+# each expiring after INGESTED_FILTER_DAYS which is longer than daily-maintenance keeps activity_pub_log rows. A 'yes'
+# might be a false positive so the caller confirms it with the database. A 'no' is only trusted once the filter has
+# been warmed from activity_pub_log by warm_ingested_filter() - until then, and after this process fails to add an id
+# to it, every lookup goes to the database.
+INGESTED_FILTER_BITS = 2 ** 24     # 2 MB per day. ~0.1% false positives at 500k activities per day
+INGESTED_FILTER_HASHES = 4
+INGESTED_FILTER_DAYS = 4
+
+_ingested_filter_write_failed = False     # an id could not be added, so the filter must be warmed again before it is trusted
+
+
+def _ingested_filter_positions(ap_id: str) -> List[int]:
+    digest = hashlib.sha256(ap_id.encode('utf-8')).digest()
+    return [int.from_bytes(digest[i * 4:i * 4 + 4], 'big') % INGESTED_FILTER_BITS for i in range(INGESTED_FILTER_HASHES)]
+
+
+def _ingested_filter_key(day) -> str:
+    return f"{current_app.config['CACHE_KEY_PREFIX']}:ingested:{day.strftime('%Y%m%d')}"
+
+
+def _ingested_filter_warm_key() -> str:
+    return f"{current_app.config['CACHE_KEY_PREFIX']}:ingested:warm"
+
+
+# Forget that the filter was warmed, after an id could not be added to it. If redis is still down that fails too, so
+# try again next time redis is used.
+def _forget_ingested_filter_warmth(r):
+    global _ingested_filter_write_failed
+    try:
+        r.delete(_ingested_filter_warm_key())
+        _ingested_filter_write_failed = False
+    except redis.exceptions.RedisError:
+        _ingested_filter_write_failed = True
+
+
+# True if ap_id is probably in the filter, False if it definitely isn't, None if the filter can't be relied on
+def ingested_filter_might_contain(ap_id: str):
+    r = redis_connection()
+    if r is None:
+        return None
+    if _ingested_filter_write_failed:
+        _forget_ingested_filter_warmth(r)
+    positions = _ingested_filter_positions(ap_id)
+    today = utcnow().date()
+    try:
+        pipe = r.pipeline(transaction=False)
+        pipe.exists(_ingested_filter_warm_key())
+        for days_ago in range(INGESTED_FILTER_DAYS):
+            key = _ingested_filter_key(today - timedelta(days=days_ago))
+            for position in positions:
+                pipe.getbit(key, position)
+        warm, *bits = pipe.execute()
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning(f'Ingested activity filter unavailable: {e}')
+        return None
+    for i in range(0, len(bits), INGESTED_FILTER_HASHES):
+        if all(bits[i:i + INGESTED_FILTER_HASHES]):
+            return True
+    return False if warm else None
+
+
+def _set_ingested_filter_bits(pipe, ap_id: str, day):
+    key = _ingested_filter_key(day)
+    for position in _ingested_filter_positions(ap_id):
+        pipe.setbit(key, position, 1)
+    pipe.expire(key, timedelta(days=INGESTED_FILTER_DAYS))
+
+
+def mark_activity_ingested(ap_id: str):
+    r = redis_connection()
+    if r is None:
+        return
+    try:
+        pipe = r.pipeline(transaction=False)
+        _set_ingested_filter_bits(pipe, ap_id, utcnow().date())
+        pipe.execute()
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning(f'Ingested activity filter unavailable: {e}')
+        _forget_ingested_filter_warmth(r)
+
+
+# Add the ids in activity_pub_log to the filter, then mark it as trustworthy. Run by daily-maintenance and
+# 'flask warm-ingested-filter'. Returns the number of ids added, or None without redis.
+def warm_ingested_filter(batch_size: int = 10000):
+    r = redis_connection()
+    if r is None:
+        return None
+    global _ingested_filter_write_failed
+    _ingested_filter_write_failed = False
+    rows = db.session.execute(text('SELECT activity_id, created_at FROM "activity_pub_log" '
+                                   'WHERE created_at > :since AND activity_id is not null').
+                              execution_options(stream_results=True, max_row_buffer=batch_size),
+                              {'since': utcnow() - timedelta(days=INGESTED_FILTER_DAYS)})
+    count = 0
+    pipe = r.pipeline(transaction=False)
+    for activity_id, created_at in rows:
+        _set_ingested_filter_bits(pipe, activity_id, created_at.date())
+        count += 1
+        if count % batch_size == 0:
+            pipe.execute()
+    pipe.execute()
+    r.set(_ingested_filter_warm_key(), 1)
+    return count
+
+
 def downvote_post(post, user):
+    tally = VoteTally()
     user.last_seen = utcnow()
-    user.recalculate_attitude()
     existing_vote = PostVote.query.filter_by(user_id=user.id, post_id=post.id).first()
     if not existing_vote:
         effect = -1.0
-        post.down_votes += 1
-        post.score -= 1.0
+        tally.down_votes += 1
+        tally.score -= 1.0
         vote = PostVote(user_id=user.id, post_id=post.id, author_id=post.author.id,
                         effect=effect)
-        post.author.reputation += effect
+        user.vote_changed(None, effect)
+        tally.reputation += effect
         db.session.add(vote)
     else:
         # remove previously cast upvote
         if existing_vote.effect > 0:
-            post.author.reputation -= existing_vote.effect
-            post.up_votes -= 1
-            post.score -= existing_vote.effect
+            user.vote_changed(existing_vote.effect, -1.0)
+            tally.reputation -= existing_vote.effect
+            tally.up_votes -= 1
+            tally.score -= existing_vote.effect
             db.session.delete(existing_vote)
 
             # apply down vote
             effect = -1.0
-            post.down_votes += 1
-            post.score -= 1.0
+            tally.down_votes += 1
+            tally.score -= 1.0
             vote = PostVote(user_id=user.id, post_id=post.id, author_id=post.author.id,
                             effect=effect)
-            post.author.reputation += effect
+            tally.reputation += effect
             db.session.add(vote)
         else:
             pass  # they have already downvoted this post
-    post.ranking = post_ranking(post.score, post.posted_at)
+    apply_vote_tally(post, tally)
     db.session.commit()
 
 
 def downvote_post_reply(comment, user):
+    tally = VoteTally()
     user.last_seen = utcnow()
-    user.recalculate_attitude()
     existing_vote = PostReplyVote.query.filter_by(user_id=user.id,
                                                   post_reply_id=comment.id).first()
     if not existing_vote:
         effect = -1.0
-        comment.down_votes += 1
-        comment.score -= 1.0
+        tally.down_votes += 1
+        tally.score -= 1.0
         vote = PostReplyVote(user_id=user.id, post_reply_id=comment.id,
                              author_id=comment.author.id, effect=effect)
-        comment.author.reputation += effect
+        user.vote_changed(None, effect)
+        tally.reputation += effect
         db.session.add(vote)
     else:
         # remove previously cast upvote
         if existing_vote.effect > 0:
-            comment.author.reputation -= existing_vote.effect
-            comment.up_votes -= 1
-            comment.score -= existing_vote.effect
+            user.vote_changed(existing_vote.effect, -1.0)
+            tally.reputation -= existing_vote.effect
+            tally.up_votes -= 1
+            tally.score -= existing_vote.effect
             db.session.delete(existing_vote)
 
             # apply down vote
             effect = -1.0
-            comment.down_votes += 1
-            comment.score -= 1.0
+            tally.down_votes += 1
+            tally.score -= 1.0
             vote = PostReplyVote(user_id=user.id, post_reply_id=comment.id,
                                  author_id=comment.author.id, effect=effect)
-            comment.author.reputation += effect
+            tally.reputation += effect
             db.session.add(vote)
         else:
             pass  # they have already downvoted this reply
-    comment.ranking = confidence(comment.up_votes, comment.down_votes)
+    apply_vote_tally(comment, tally)
 
 
 def upvote_post_reply(comment, user):
+    tally = VoteTally()
     user.last_seen = utcnow()
-    user.recalculate_attitude()
     effect = instance_weight(user.ap_domain)
     existing_vote = PostReplyVote.query.filter_by(user_id=user.id,
                                                   post_reply_id=comment.id).first()
     if not existing_vote:
-        comment.up_votes += 1
-        comment.score += effect
+        tally.up_votes += 1
+        tally.score += effect
         vote = PostReplyVote(user_id=user.id, post_reply_id=comment.id,
                              author_id=comment.author.id, effect=effect)
+        user.vote_changed(None, effect)
         if comment.community.low_quality and effect > 0:
             effect = 0
-        comment.author.reputation += effect
+        tally.reputation += effect
         db.session.add(vote)
     else:
         # remove previously cast downvote
         if existing_vote.effect < 0:
-            comment.author.reputation -= existing_vote.effect
-            comment.down_votes -= 1
-            comment.score -= existing_vote.effect
+            user.vote_changed(existing_vote.effect, effect)
+            tally.reputation -= existing_vote.effect
+            tally.down_votes -= 1
+            tally.score -= existing_vote.effect
             db.session.delete(existing_vote)
 
             # apply up vote
-            comment.up_votes += 1
-            comment.score += effect
+            tally.up_votes += 1
+            tally.score += effect
             vote = PostReplyVote(user_id=user.id, post_reply_id=comment.id,
                                  author_id=comment.author.id, effect=effect)
             if comment.community.low_quality and effect > 0:
                 effect = 0
-            comment.author.reputation += effect
+            tally.reputation += effect
             db.session.add(vote)
         else:
             pass  # they have already upvoted this reply
-    comment.ranking = confidence(comment.up_votes, comment.down_votes)
+    apply_vote_tally(comment, tally)
 
 
 def upvote_post(post, user):
+    tally = VoteTally()
     user.last_seen = utcnow()
-    user.recalculate_attitude()
     effect = instance_weight(user.ap_domain)
     existing_vote = PostVote.query.filter_by(user_id=user.id, post_id=post.id).first()
     if not existing_vote:
-        post.up_votes += 1
-        post.score += effect
+        tally.up_votes += 1
+        tally.score += effect
         vote = PostVote(user_id=user.id, post_id=post.id, author_id=post.author.id,
                         effect=effect)
+        user.vote_changed(None, effect)
         if post.community.low_quality and effect > 0:
             effect = 0
-        post.author.reputation += effect
+        tally.reputation += effect
         db.session.add(vote)
     else:
         # remove previous cast downvote
         if existing_vote.effect < 0:
-            post.author.reputation -= existing_vote.effect
-            post.down_votes -= 1
-            post.score -= existing_vote.effect
+            user.vote_changed(existing_vote.effect, effect)
+            tally.reputation -= existing_vote.effect
+            tally.down_votes -= 1
+            tally.score -= existing_vote.effect
             db.session.delete(existing_vote)
 
             # apply up vote
-            post.up_votes += 1
-            post.score += effect
+            tally.up_votes += 1
+            tally.score += effect
             vote = PostVote(user_id=user.id, post_id=post.id, author_id=post.author.id,
                             effect=effect)
             if post.community.low_quality and effect > 0:
                 effect = 0
-            post.author.reputation += effect
+            tally.reputation += effect
             db.session.add(vote)
-    post.ranking = post_ranking(post.score, post.posted_at)
+    apply_vote_tally(post, tally)
     db.session.commit()
 
 
@@ -1292,6 +1416,8 @@ def create_post(activity_log: ActivityPubLog, community: Community, request_json
             post.score += 1
             post.ranking = post_ranking(post.score, post.posted_at)
             db.session.commit()
+
+        add_post_to_home_timelines(post.id)
     return post
 
 
@@ -1348,19 +1474,25 @@ def undo_downvote(activity_log, comment, post, target_ap_id, user):
     if (user and not user.is_local()) and post:
         existing_vote = PostVote.query.filter_by(user_id=user.id, post_id=post.id).first()
         if existing_vote:
-            post.author.reputation -= existing_vote.effect
-            post.down_votes -= 1
-            post.score -= existing_vote.effect
+            tally = VoteTally()
+            user.vote_changed(existing_vote.effect, None)
+            tally.reputation -= existing_vote.effect
+            tally.down_votes -= 1
+            tally.score -= existing_vote.effect
             db.session.delete(existing_vote)
+            apply_vote_tally(post, tally)
             activity_log.result = 'success'
     if (user and not user.is_local()) and comment:
         existing_vote = PostReplyVote.query.filter_by(user_id=user.id,
                                                       post_reply_id=comment.id).first()
         if existing_vote:
-            comment.author.reputation -= existing_vote.effect
-            comment.down_votes -= 1
-            comment.score -= existing_vote.effect
+            tally = VoteTally()
+            user.vote_changed(existing_vote.effect, None)
+            tally.reputation -= existing_vote.effect
+            tally.down_votes -= 1
+            tally.score -= existing_vote.effect
             db.session.delete(existing_vote)
+            apply_vote_tally(comment, tally)
             activity_log.result = 'success'
     if user is None:
         activity_log.exception_message = 'Blocked or unfound user'
@@ -1377,25 +1509,31 @@ def undo_vote(activity_log, comment, post, target_ap_id, user):
         user.last_seen = utcnow()
         existing_vote = PostVote.query.filter_by(user_id=user.id, post_id=post.id).first()
         if existing_vote:
-            post.author.reputation -= existing_vote.effect
+            tally = VoteTally()
+            user.vote_changed(existing_vote.effect, None)
+            tally.reputation -= existing_vote.effect
             if existing_vote.effect < 0:  # Lemmy sends 'like' for upvote and 'dislike' for down votes. Cool! When it undoes an upvote it sends an 'Undo Like'. Fine. When it undoes a downvote it sends an 'Undo Like' - not 'Undo Dislike'?!
-                post.down_votes -= 1
+                tally.down_votes -= 1
             else:
-                post.up_votes -= 1
-            post.score -= existing_vote.effect
+                tally.up_votes -= 1
+            tally.score -= existing_vote.effect
             db.session.delete(existing_vote)
+            apply_vote_tally(post, tally)
             activity_log.result = 'success'
     if (user and not user.is_local()) and isinstance(voted_on, PostReply):
         comment = voted_on
         existing_vote = PostReplyVote.query.filter_by(user_id=user.id, post_reply_id=comment.id).first()
         if existing_vote:
-            comment.author.reputation -= existing_vote.effect
+            tally = VoteTally()
+            user.vote_changed(existing_vote.effect, None)
+            tally.reputation -= existing_vote.effect
             if existing_vote.effect < 0:  # Lemmy sends 'like' for upvote and 'dislike' for down votes. Cool! When it undoes an upvote it sends an 'Undo Like'. Fine. When it undoes a downvote it sends an 'Undo Like' - not 'Undo Dislike'?!
-                comment.down_votes -= 1
+                tally.down_votes -= 1
             else:
-                comment.up_votes -= 1
-            comment.score -= existing_vote.effect
+                tally.up_votes -= 1
+            tally.score -= existing_vote.effect
             db.session.delete(existing_vote)
+            apply_vote_tally(comment, tally)
             activity_log.result = 'success'
     else:
         if user is None or comment is None:
@@ -12,13 +12,14 @@ from app.activitypub.signature import post_request
 from app.activitypub.util import default_context
 from app.admin.forms import FederationForm, SiteMiscForm, SiteProfileForm, EditCommunityForm, EditUserForm, \
     EditTopicForm, SendNewsletterForm, AddUserForm
-from app.admin.util import unsubscribe_from_everything_then_delete, unsubscribe_from_community, send_newsletter, \
-    topic_tree, topics_for_form
+from app.admin.util import unsubscribe_from_community, send_newsletter, \
+    topic_tree, topics_for_form, newsletter_progress
 from app.community.util import save_icon_file, save_banner_file
 from app.models import AllowedInstances, BannedInstances, ActivityPubLog, utcnow, Site, Community, CommunityMember, \
     User, Instance, File, Report, Topic, UserRegistration, Role, Post
 from app.utils import render_template, permission_required, set_setting, get_setting, gibberish, markdown_to_html, \
     moderating_communities, joined_communities, finalize_user_setup, theme_list
+from app.user.utils import delete_account
 from app.admin import bp
 
 
@@ -472,7 +473,8 @@ def admin_content_trash():
 
     page = request.args.get('page', 1, type=int)
 
-    posts = Post.query.filter(Post.posted_at > utcnow() - timedelta(days=3)).order_by(Post.score)
+    posts = Post.query.filter(Post.posted_at > utcnow() - timedelta(days=3)).order_by(Post.score).\
+        options(*Post.loading_profile('teaser'))
     posts = posts.paginate(page=page, per_page=100, error_out=False)
 
     next_url = url_for('admin.admin_content_trash', page=posts.next_num) if posts.has_next else None
@@ -679,7 +681,7 @@ def admin_user_delete(user_id):
     db.session.commit()
 
     if user.is_local():
-        unsubscribe_from_everything_then_delete(user.id)
+        delete_account(user.id, ['unsubscribe', 'account', 'finish'], cleanup='files')
     else:
         user.deleted = True
         user.delete_dependencies()
@@ -722,11 +724,13 @@ def admin_reports():
 def newsletter():
     form = SendNewsletterForm()
     if form.validate_on_submit():
-        send_newsletter(form)
-        flash('Newsletter sent')
+        if send_newsletter(form) == 0:
+            flash(_('No recipients'), 'error')
+        else:
+            flash(_('Newsletter is being sent'))
         return redirect(url_for('admin.newsletter'))
 
-    return render_template("admin/newsletter.html", form=form, title=_('Send newsletter'),
+    return render_template("admin/newsletter.html", form=form, title=_('Send newsletter'), progress=newsletter_progress(),
                            moderating_communities=moderating_communities(current_user.get_id()),
                            joined_communities=joined_communities(current_user.get_id()),
                            site=g.site
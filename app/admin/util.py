@@ -1,56 +1,14 @@
 from typing import List, Tuple
 
-from flask import request, abort, g, current_app, json, flash, render_template
+from flask import request, abort, g, current_app, render_template, url_for, escape
 from flask_login import current_user
-from sqlalchemy import text, desc
+from sqlalchemy import text
 from flask_babel import _
 
 from app import db, cache, celery
-from app.activitypub.signature import post_request
-from app.activitypub.util import default_context
-from app.models import User, Community, Instance, Site, ActivityPubLog, CommunityMember, Topic
-from app.utils import gibberish
-
-
-def unsubscribe_from_everything_then_delete(user_id):
-    if current_app.debug:
-        unsubscribe_from_everything_then_delete_task(user_id)
-    else:
-        unsubscribe_from_everything_then_delete_task.delay(user_id)
-
-
-@celery.task
-def unsubscribe_from_everything_then_delete_task(user_id):
-    user = User.query.get(user_id)
-    if user:
-        # unsubscribe
-        communities = CommunityMember.query.filter_by(user_id=user_id).all()
-        for membership in communities:
-            community = Community.query.get(membership.community_id)
-            unsubscribe_from_community(community, user)
-
-        # federate deletion of account
-        if user.is_local():
-            instances = Instance.query.all()
-            site = Site.query.get(1)
-            payload = {
-                "@context": default_context(),
-                "actor": user.ap_profile_id,
-                "id": f"{user.ap_profile_id}#delete",
-                "object": user.ap_profile_id,
-                "to": [
-                    "https://www.w3.org/ns/activitystreams#Public"
-                ],
-                "type": "Delete"
-            }
-            for instance in instances:
-                if instance.inbox and instance.id != 1:
-                    post_request(instance.inbox, payload, site.private_key,
-                                 f"https://{current_app.config['SERVER_NAME']}#main-key")
-
-        user.deleted = True
-        user.delete_dependencies()
-        db.session.commit()
+from app.activitypub.signature import post_request_in_background
+from app.models import Topic
+from app.utils import gibberish, redis_connection
 
 
 def unsubscribe_from_community(community, user):
@@ -69,41 +27,86 @@ def unsubscribe_from_community(community, user):
         'id': undo_id,
         'object': follow
     }
-    activity = ActivityPubLog(direction='out', activity_id=undo_id, activity_type='Undo',
-                              activity_json=json.dumps(undo), result='processing')
-    db.session.add(activity)
-    db.session.commit()
-    post_request(community.ap_inbox_url, undo, user.private_key, user.profile_id() + '#main-key')
-    activity.result = 'success'
-    db.session.commit()
-
-
-def send_newsletter(form):
-    recipients = User.query.filter(User.newsletter == True, User.banned == False, User.ap_id == None).order_by(desc(User.id)).limit(40000)
-
-    from app.email import send_email
-
-    if recipients.count() == 0:
-        flash('No recipients', 'error')
-
-    for recipient in recipients:
-        body_text = render_template('email/newsletter.txt',
-                                    recipient=recipient if not form.test.data else current_user,
-                                    content=form.body_text.data)
-        body_html = render_template('email/newsletter.html',
-                                    recipient=recipient if not form.test.data else current_user,
-                                    content=form.body_html.data,
-                                    domain=current_app.config['SERVER_NAME'])
-        if form.test.data:
-            to = current_user.email
+    post_request_in_background(community.ap_inbox_url, undo, user.id)    # no need to tell them if it fails
+
+
+NEWSLETTER_CHUNK_SIZE = 500    # recipients per celery task, all sent over one connection to the mail server
+NEWSLETTER_MAX_RECIPIENTS = 40000
+NEWSLETTER_PROGRESS_KEY = 'newsletter:progress'
+
+
+# The templates are rendered once, with placeholders where the name and unsubscribe link of each recipient go. Recipients
+# are streamed from the database and handed to celery in chunks. Returns the number of recipients.
+def send_newsletter(form) -> int:
+    body_text = render_template('email/newsletter.txt', recipient_name='[[recipient_name]]',
+                                unsubscribe_url='[[unsubscribe_url]]', content=form.body_text.data)
+    body_html = render_template('email/newsletter.html', recipient_name='[[recipient_name]]',
+                                unsubscribe_url='[[unsubscribe_url]]', content=form.body_html.data,
+                                domain=current_app.config['SERVER_NAME'])
+    sender = f'{g.site.name} <noreply@{current_app.config["SERVER_NAME"]}>'
+
+    if form.test.data:
+        send_newsletter_chunk(form.subject.data, sender, body_text, body_html, [current_user.id], test=True)
+        return 1
+
+    recipient_ids = db.session.execute(text("""SELECT id FROM "user" WHERE newsletter = true AND banned = false
+                                               AND ap_id is null ORDER BY id DESC LIMIT :limit""").
+                                       execution_options(stream_results=True),
+                                       {'limit': NEWSLETTER_MAX_RECIPIENTS}).scalars()
+    total = 0
+    redis = redis_connection()
+    if redis:
+        redis.delete(NEWSLETTER_PROGRESS_KEY)
+        redis.hset(NEWSLETTER_PROGRESS_KEY, mapping={'subject': form.subject.data, 'total': 0, 'sent': 0, 'failed': 0})
+    for chunk in recipient_ids.partitions(NEWSLETTER_CHUNK_SIZE):
+        total += len(chunk)
+        if redis:
+            redis.hincrby(NEWSLETTER_PROGRESS_KEY, 'total', len(chunk))
+        if current_app.debug:
+            send_newsletter_chunk(form.subject.data, sender, body_text, body_html, list(chunk))
         else:
-            to = recipient.email
+            send_newsletter_chunk.delay(form.subject.data, sender, body_text, body_html, list(chunk))
+    return total
 
-        send_email(subject=form.subject.data, sender=f'{g.site.name} <noreply@{current_app.config["SERVER_NAME"]}>', recipients=[to],
-                   text_body=body_text, html_body=body_html)
 
-        if form.test.data:
-            break
+@celery.task
+def send_newsletter_chunk(subject, sender, body_text, body_html, recipient_ids, test=False):
+    from app.email import send_bulk_email, BULK_EMAIL_RETRY_DELAY
+    recipients = db.session.execute(text('SELECT id, email, title, user_name, verification_token FROM "user" '
+                                         'WHERE id = ANY(:ids)'),
+                                    {'ids': recipient_ids}).fetchall()
+    messages = []
+    for user_id, email, title, user_name, verification_token in recipients:
+        name = title or user_name   # as User.display_name()
+        unsubscribe_url = url_for('user.user_newsletter_unsubscribe', user_id=user_id, token=verification_token, _external=True)
+        messages.append((email,
+                         body_text.replace('[[recipient_name]]', name).replace('[[unsubscribe_url]]', unsubscribe_url),
+                         body_html.replace('[[recipient_name]]', str(escape(name))).replace('[[unsubscribe_url]]', unsubscribe_url)))
+
+    redis = redis_connection() if not test else None
+
+    def progress(succeeded: bool):
+        if redis:
+            redis.hincrby(NEWSLETTER_PROGRESS_KEY, 'sent' if succeeded else 'failed', 1)
+
+    sent, failed, unsent = send_bulk_email(subject, sender, messages, progress)
+    if unsent and not test:     # the mail server went away, try the rest of the chunk again later
+        unsent_emails = set(email for email, text_body, html_body in unsent)
+        send_newsletter_chunk.apply_async((subject, sender, body_text, body_html,
+                                           [user_id for user_id, email, *rest in recipients if email in unsent_emails]),
+                                          countdown=BULK_EMAIL_RETRY_DELAY)
+
+
+# How far the most recent newsletter has got, for the admin page. None if it is not known.
+def newsletter_progress():
+    redis = redis_connection()
+    if redis is None:
+        return None
+    progress = redis.hgetall(NEWSLETTER_PROGRESS_KEY)
+    if not progress:
+        return None
+    return {'subject': progress[b'subject'].decode(), 'total': int(progress[b'total']), 'sent': int(progress[b'sent']),
+            'failed': int(progress[b'failed'])}
 
 
 # replies to a post, in a tree, sorted by a variety of methods
@@ -4,7 +4,7 @@ from flask_babel import _
 from sqlalchemy import text
 
 from app import db
-from app.activitypub.signature import post_request
+from app.activitypub.signature import post_request_in_background
 from app.models import User, ChatMessage, Notification, utcnow, Conversation
 from app.utils import allowlist_html, shorten_string, gibberish, markdown_to_html
 
@@ -52,10 +52,9 @@ def send_message(form, conversation_id: int) -> ChatMessage:
                     ],
                     "type": "Create"
                 }
-                success = post_request(recipient.ap_inbox_url, reply_json, current_user.private_key,
-                                       current_user.profile_id() + '#main-key')
-                if not success:
-                    flash(_('Message failed to send to %(name)s.', name=recipient.link()), 'error')
+                post_request_in_background(recipient.ap_inbox_url, reply_json, current_user.id,
+                                           _('Message failed to send to %(name)s.', name=recipient.link()),
+                                           '/chat/' + str(conversation_id))
 
     flash(_('Message sent.'))
     return reply
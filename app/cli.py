@@ -2,24 +2,27 @@
 # e.g. export FLASK_APP=pyfedi.py
 import imaplib
 import re
+from collections import defaultdict
 from datetime import datetime, timedelta
 
-import flask
 from flask import json, current_app
-from flask_babel import _
-from sqlalchemy import or_, desc
+from sqlalchemy import text
 from sqlalchemy.orm import configure_mappers
 
 from app import db
 import click
 import os
 
+from app.activitypub.outbox import drain_outbox
 from app.activitypub.signature import RsaKeys
+from app.activitypub.util import warm_ingested_filter
 from app.auth.util import random_token
-from app.email import send_verification_email, send_email
+from app.user.utils import send_unread_notification_digests, resume_account_deletions
+from app.email import send_verification_email
 from app.models import Settings, BannedInstances, Interest, Role, User, RolePermission, Domain, ActivityPubLog, \
-    utcnow, Site, Instance, File, Notification, Post, CommunityMember
-from app.utils import file_get_contents, retrieve_block_list, blocked_domains, retrieve_peertube_block_list
+    utcnow, Site, Instance, File
+from app.utils import file_get_contents, retrieve_block_list, retrieve_peertube_block_list, rerank_posts, \
+    flush_vote_deltas, generate_sitemaps, markdown_to_html
 
 
 def register(app):
@@ -176,6 +179,134 @@ def register(app):
             """Remove activity older than 3 days"""
             db.session.query(ActivityPubLog).filter(ActivityPubLog.created_at < utcnow() - timedelta(days=3)).delete()
             db.session.commit()
+            warm_ingested_filter()
+
+    @app.cli.command("warm-ingested-filter")
+    def warm_ingested_filter_command():
+        """Load recent activity ids into the redis filter used to spot repeated activities. Run once after deploying."""
+        with app.app_context():
+            count = warm_ingested_filter()
+            print('REDIS_URL is not set' if count is None else f'Added {count} activity ids')
+
+    @app.cli.command("backfill-votes-cast")
+    def backfill_votes_cast():
+        """Populate User.upvotes_cast, User.downvotes_cast and User.attitude from the post_vote and post_reply_vote tables"""
+        with app.app_context():
+            db.session.execute(text('UPDATE "user" SET upvotes_cast = 0, downvotes_cast = 0, attitude = 1.0'))
+            db.session.execute(text(VOTES_CAST_TOTALS_SQL + """
+                UPDATE "user" SET upvotes_cast = totals.up, downvotes_cast = totals.down,
+                    attitude = CASE WHEN totals.down = 0 THEN 1.0 ELSE (totals.up - totals.down)::float / (totals.up + totals.down) END
+                FROM totals WHERE "user".id = totals.user_id"""))
+            db.session.commit()
+            print('Done')
+
+    @app.cli.command("backfill-profile-html")
+    def backfill_profile_html():
+        """Render User.about_html, Community.description_html and Community.rules_html from their markdown for local
+        accounts and communities. Profile pages no longer do this on every view."""
+        with app.app_context():
+            users = db.session.execute(text('SELECT id, about FROM "user" WHERE ap_id is null AND about is not null')).fetchall()
+            for user_id, about in users:
+                db.session.execute(text('UPDATE "user" SET about_html = :about_html WHERE id = :user_id'),
+                                   {'about_html': markdown_to_html(about), 'user_id': user_id})
+            communities = db.session.execute(text('SELECT id, description, rules FROM "community" WHERE ap_id is null')).fetchall()
+            for community_id, description, rules in communities:
+                db.session.execute(text('UPDATE "community" SET description_html = :description_html, rules_html = :rules_html '
+                                        'WHERE id = :community_id'),
+                                   {'description_html': markdown_to_html(description), 'rules_html': markdown_to_html(rules),
+                                    'community_id': community_id})
+            db.session.commit()
+            print(f'Rendered {len(users)} profiles and {len(communities)} communities')
+
+    @app.cli.command("check-votes-cast")
+    @click.option('--fix', is_flag=True, help='Correct any accounts whose counters have drifted')
+    def check_votes_cast(fix):
+        """Compare User.upvotes_cast and User.downvotes_cast against the votes actually recorded"""
+        with app.app_context():
+            mismatches = db.session.execute(text(VOTES_CAST_TOTALS_SQL + """
+                SELECT u.id, u.upvotes_cast, u.downvotes_cast, COALESCE(totals.up, 0), COALESCE(totals.down, 0)
+                FROM "user" u LEFT JOIN totals ON totals.user_id = u.id
+                WHERE COALESCE(u.upvotes_cast, 0) <> COALESCE(totals.up, 0) OR COALESCE(u.downvotes_cast, 0) <> COALESCE(totals.down, 0)""")).fetchall()
+            for user_id, upvotes_cast, downvotes_cast, upvotes, downvotes in mismatches:
+                print(f'{user_id}: counters say {upvotes_cast} up / {downvotes_cast} down, votes say {upvotes} up / {downvotes} down')
+                if fix:
+                    user = User.query.get(user_id)
+                    user.upvotes_cast = upvotes
+                    user.downvotes_cast = downvotes
+                    user.recalculate_attitude()
+            if fix:
+                db.session.commit()
+            print(f'{len(mismatches)} accounts with incorrect vote counters')
+
+    @app.cli.group()
+    def outbox():
+        """Inspect and send the queue of activities waiting to be re-sent to other instances."""
+        pass
+
+    @outbox.command()
+    def inspect():
+        """Show how many activities are waiting for each instance"""
+        with app.app_context():
+            rows = db.session.execute(text("""
+                SELECT i.domain, COUNT(o.id), COUNT(o.id) FILTER (WHERE o.next_attempt_at <= :now), MIN(o.created_at),
+                       MAX(o.attempts), MIN(o.next_attempt_at), i.failures, i.dormant, i.gone_forever, i.start_trying_again
+                FROM "outbox_item" o LEFT JOIN "instance" i ON i.id = o.instance_id
+                GROUP BY i.domain, i.failures, i.dormant, i.gone_forever, i.start_trying_again
+                ORDER BY COUNT(o.id) DESC"""), {'now': utcnow()}).fetchall()
+            for domain, waiting, due, oldest, attempts, next_attempt, failures, dormant, gone_forever, start_trying_again in rows:
+                state = 'gone' if gone_forever else f'dormant until {start_trying_again}' if dormant else 'ok'
+                print(f'{domain}: {waiting} waiting, {due} due, most attempts {attempts}, oldest {oldest}, '
+                      f'next attempt {next_attempt}, {failures} failures, {state}')
+            print(f'{sum(row[1] for row in rows)} activities waiting for {len(rows)} instances')
+
+    @outbox.command()
+    @click.option('--limit', default=1000, help='How many activities to send at a time')
+    @click.option('--force', is_flag=True, help='Send everything now, even to dormant instances')
+    @click.option('--domain', help='Only send to this instance')
+    def drain(limit, force, domain):
+        """Send activities that are due to be retried. Run this from cron every few minutes."""
+        with app.app_context():
+            totals = defaultdict(int)
+            while True:
+                counts = drain_outbox(limit, force, domain)
+                if counts is None:
+                    print('The outbox is already being drained')
+                    return
+                for key, value in counts.items():
+                    totals[key] += value
+                # when forced, items stay due even after failing so only do one batch
+                if force or sum(counts.values()) < limit:
+                    break
+            print(', '.join(f'{value} {key}' for key, value in totals.items()))
+
+    @app.cli.command("rerank")
+    def rerank():
+        """Recalculate the 'hot' ranking of recent posts"""
+        with app.app_context():
+            print(f'Re-ranked {rerank_posts()} posts')
+
+    @app.cli.command("flush-votes")
+    def flush_votes():
+        """Write the vote counts collected in redis to the database, when VOTE_WRITE_BEHIND is on"""
+        with app.app_context():
+            changed = flush_vote_deltas()
+            if changed is None:
+                print('Votes are already being written, or REDIS_URL is not set')
+            else:
+                print(f'Updated {changed} posts, replies and users')
+
+    @app.cli.command("resume-account-deletions")
+    def resume_account_deletions_command():
+        """Carry on with account deletions that were interrupted, e.g. by celery being restarted"""
+        with app.app_context():
+            resumed = resume_account_deletions()
+            print(f'Resumed the deletion of {len(resumed)} accounts')
+
+    @app.cli.command("generate-sitemaps")
+    def generate_sitemaps_command():
+        """Write sitemap.xml and the sitemaps it links to into app/static/sitemaps"""
+        with app.app_context():
+            print(f'Wrote {generate_sitemaps()} sitemaps')
 
     @app.cli.command("spaceusage")
     def spaceusage():
@@ -204,48 +335,14 @@ def register(app):
                     os.unlink(file_path)
 
     @app.cli.command("send_missed_notifs")
-    def send_missed_notifs():
+    @click.option('--dry-run', is_flag=True, help='Work out who would be emailed and render the emails, without sending them')
+    @click.option('--batch-size', default=500, help='How many people to process at a time')
+    def send_missed_notifs(dry_run, batch_size):
+        """Email people about notifications they have not seen. Run this from cron."""
         with app.app_context():
-            users_to_notify = User.query.join(Notification, User.id == Notification.user_id).filter(
-                User.ap_id == None,
-                Notification.created_at > User.last_seen,
-                Notification.read == False,
-                User.email_unread_sent == False,  # they have not been emailed since last activity
-                User.email_unread == True  # they want to be emailed
-            ).all()
-
-            for user in users_to_notify:
-                notifications = Notification.query.filter(Notification.user_id == user.id, Notification.read == False,
-                                                          Notification.created_at > user.last_seen).all()
-                if notifications:
-                    # Also get the top 20 posts since their last login
-                    posts = Post.query.join(CommunityMember, Post.community_id == CommunityMember.community_id).filter(
-                        CommunityMember.is_banned == False)
-                    posts = posts.filter(CommunityMember.user_id == user.id)
-                    if user.ignore_bots:
-                        posts = posts.filter(Post.from_bot == False)
-                    if user.show_nsfl is False:
-                        posts = posts.filter(Post.nsfl == False)
-                    if user.show_nsfw is False:
-                        posts = posts.filter(Post.nsfw == False)
-                    domains_ids = blocked_domains(user.id)
-                    if domains_ids:
-                        posts = posts.filter(or_(Post.domain_id.not_in(domains_ids), Post.domain_id == None))
-                    posts = posts.filter(Post.posted_at > user.last_seen).order_by(desc(Post.score))
-                    posts = posts.limit(20).all()
-
-                    # Send email!
-                    send_email(_('[PieFed] You have unread notifications'),
-                               sender=f'PieFed <noreply@{current_app.config["SERVER_NAME"]}>',
-                               recipients=[user.email],
-                               text_body=flask.render_template('email/unread_notifications.txt', user=user,
-                                                               notifications=notifications),
-                               html_body=flask.render_template('email/unread_notifications.html', user=user,
-                                                               notifications=notifications,
-                                                               posts=posts,
-                                                               domain=current_app.config['SERVER_NAME']))
-                    user.email_unread_sent = True
-                    db.session.commit()
+            result = send_unread_notification_digests(dry_run=dry_run, batch_size=batch_size)
+            print(f"{'Would have sent' if dry_run else 'Sent'} {result['emails']} emails. Seconds spent: " +
+                  ', '.join(f'{step} {seconds:.2f}' for step, seconds in result['timings'].items()))
 
     @app.cli.command("process_email_bounces")
     def process_email_bounces():
@@ -319,6 +416,20 @@ def register(app):
             db.session.commit()
 
 
+# Per-user totals of up and down votes cast on posts and replies. Prefixed onto the statements in backfill-votes-cast
+# and check-votes-cast, which refer to it as 'totals'
+VOTES_CAST_TOTALS_SQL = """
+    WITH votes AS (
+        SELECT user_id, COUNT(id) FILTER (WHERE effect > 0) AS up, COUNT(id) FILTER (WHERE effect < 0) AS down
+        FROM "post_vote" GROUP BY user_id
+        UNION ALL
+        SELECT user_id, COUNT(id) FILTER (WHERE effect > 0) AS up, COUNT(id) FILTER (WHERE effect < 0) AS down
+        FROM "post_reply_vote" GROUP BY user_id
+    ), totals AS (
+        SELECT user_id, SUM(up)::int AS up, SUM(down)::int AS down FROM votes GROUP BY user_id
+    )"""
+
+
 def parse_communities(interests_source, segment):
     lines = interests_source.split("\n")
     include_in_output = False
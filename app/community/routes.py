@@ -8,12 +8,12 @@ from flask_babel import _
 from sqlalchemy import or_, desc
 
 from app import db, constants, cache
-from app.activitypub.signature import RsaKeys, post_request
+from app.activitypub.signature import RsaKeys, post_request_in_background
 from app.activitypub.util import default_context, notify_about_post
 from app.community.forms import SearchRemoteCommunity, AddLocalCommunity, CreatePostForm, ReportCommunityForm, \
     DeleteCommunityForm
 from app.community.util import search_for_community, community_url_exists, actor_to_community, \
-    opengraph_parse, url_to_thumbnail_file, save_post, save_icon_file, save_banner_file, send_to_remote_instance
+    opengraph_parse, url_to_thumbnail_file, save_post, save_icon_file, save_banner_file, send_to_followers
 from app.constants import SUBSCRIPTION_MEMBER, SUBSCRIPTION_OWNER, POST_TYPE_LINK, POST_TYPE_ARTICLE, POST_TYPE_IMAGE, \
     SUBSCRIPTION_PENDING, SUBSCRIPTION_MODERATOR
 from app.inoculation import inoculation
@@ -22,8 +22,9 @@ from app.models import User, Community, CommunityMember, CommunityJoinRequest, C
 from app.community import bp
 from app.utils import get_setting, render_template, allowlist_html, markdown_to_html, validation_required, \
     shorten_string, gibberish, community_membership, ap_datetime, \
-    request_etag_matches, return_304, instance_banned, can_create_post, can_upvote, can_downvote, user_filters_posts, \
-    joined_communities, moderating_communities, blocked_domains, mimetype_from_url, blocked_instances
+    request_etag_matches, return_304, can_create_post, can_upvote, can_downvote, user_filters_posts, \
+    joined_communities, moderating_communities, blocked_domains, mimetype_from_url, blocked_instances, \
+    invalidate_home_timeline, add_post_to_home_timelines, keyset_paginate, post_sort_columns, request_loader
 from feedgen.feed import FeedGenerator
 from datetime import timezone, timedelta
 
@@ -69,6 +70,7 @@ def add_local():
         cache.delete_memoized(community_membership, current_user, community)
         cache.delete_memoized(joined_communities, current_user.id)
         cache.delete_memoized(moderating_communities, current_user.id)
+        invalidate_home_timeline(current_user.id)
         return redirect('/c/' + community.name)
 
     return render_template('community/add_local.html', title=_('Create community'), form=form, moderating_communities=moderating_communities(current_user.get_id()),
@@ -114,7 +116,7 @@ def show_community(community: Community):
     if community.banned:
         abort(404)
 
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     sort = request.args.get('sort', '' if current_user.is_anonymous else current_user.default_sort)
     low_bandwidth = request.cookies.get('low_bandwidth', '0') == '1'
     post_layout = request.args.get('layout', community.default_layout if not low_bandwidth else None)
@@ -160,20 +162,15 @@ def show_community(community: Community):
         if instance_ids:
             posts = posts.filter(or_(Post.instance_id.not_in(instance_ids), Post.instance_id == None))
 
-    if sort == '' or sort == 'hot':
-        posts = posts.order_by(desc(Post.ranking)).order_by(desc(Post.posted_at))
-    elif sort == 'top':
-        posts = posts.filter(Post.posted_at > utcnow() - timedelta(days=7)).order_by(desc(Post.score))
-    elif sort == 'new':
-        posts = posts.order_by(desc(Post.posted_at))
-    elif sort == 'active':
-        posts = posts.order_by(desc(Post.last_active))
+    if sort == 'top':
+        posts = posts.filter(Post.posted_at > utcnow() - timedelta(days=7))
     per_page = 100
     if post_layout == 'masonry':
         per_page = 200
     elif post_layout == 'masonry_wide':
         per_page = 300
-    posts = posts.paginate(page=page, per_page=per_page, error_out=False)
+    posts = keyset_paginate(posts.options(*Post.loading_profile('teaser')), post_sort_columns(sort), cursor, per_page)
+    request_loader().prime(posts=posts.items)
 
     breadcrumbs = []
     breadcrumb = namedtuple("Breadcrumb", ['text', 'url'])
@@ -216,9 +213,9 @@ def show_community(community: Community):
     og_image = community.image.source_url if community.image_id else None
 
     next_url = url_for('activitypub.community_profile', actor=community.ap_id if community.ap_id is not None else community.name,
-                       page=posts.next_num, sort=sort, layout=post_layout) if posts.has_next else None
+                       cursor=posts.next_cursor, sort=sort, layout=post_layout) if posts.has_next else None
     prev_url = url_for('activitypub.community_profile', actor=community.ap_id if community.ap_id is not None else community.name,
-                       page=posts.prev_num, sort=sort, layout=post_layout) if posts.has_prev and page != 1 else None
+                       cursor=posts.prev_cursor, sort=sort, layout=post_layout) if posts.has_prev else None
 
     return render_template('community/community.html', community=community, title=community.title, breadcrumbs=breadcrumbs,
                            is_moderator=is_moderator, is_owner=is_owner, is_admin=is_admin, mods=mod_list, posts=posts, description=description,
@@ -316,10 +313,8 @@ def subscribe(actor):
                     "type": "Follow",
                     "id": f"https://{current_app.config['SERVER_NAME']}/activities/follow/{join_request.id}"
                 }
-                success = post_request(community.ap_inbox_url, follow, current_user.private_key,
-                                                           current_user.profile_id() + '#main-key')
-                if not success:
-                    flash(_("There was a problem while trying to communicate with remote server. If other people have already joined this community it won't matter."), 'error')
+                post_request_in_background(community.ap_inbox_url, follow, current_user.id,
+                                           _('Problem joining %(name)s', name=community.title), f'/c/{community.link()}')
             # for local communities, joining is instant
             member = CommunityMember(user_id=current_user.id, community_id=community.id)
             db.session.add(member)
@@ -328,6 +323,7 @@ def subscribe(actor):
         referrer = request.headers.get('Referer', None)
         cache.delete_memoized(community_membership, current_user, community)
         cache.delete_memoized(joined_communities, current_user.id)
+        invalidate_home_timeline(current_user.id)
         if referrer is not None:
             return redirect(referrer)
         else:
@@ -363,10 +359,8 @@ def unsubscribe(actor):
                         'id': undo_id,
                         'object': follow
                     }
-                    success = post_request(community.ap_inbox_url, undo, current_user.private_key,
-                                                               current_user.profile_id() + '#main-key')
-                    if not success:
-                        flash('There was a problem while trying to unsubscribe', 'error')
+                    post_request_in_background(community.ap_inbox_url, undo, current_user.id,
+                                               _('Problem leaving %(name)s', name=community.title), f'/c/{community.link()}')
 
                 if proceed:
                     db.session.query(CommunityMember).filter_by(user_id=current_user.id, community_id=community.id).delete()
@@ -376,6 +370,7 @@ def unsubscribe(actor):
                     flash('You have left ' + community.title)
                 cache.delete_memoized(community_membership, current_user, community)
                 cache.delete_memoized(joined_communities, current_user.id)
+                invalidate_home_timeline(current_user.id)
             else:
                 # todo: community deletion
                 flash('You need to make someone else the owner before unsubscribing.', 'warning')
@@ -408,11 +403,12 @@ def join_then_add(actor):
                 "type": "Follow",
                 "id": f"https://{current_app.config['SERVER_NAME']}/activities/follow/{join_request.id}"
             }
-            success = post_request(community.ap_inbox_url, follow, current_user.private_key,
-                                   current_user.profile_id() + '#main-key')
+            post_request_in_background(community.ap_inbox_url, follow, current_user.id,
+                                       _('Problem joining %(name)s', name=community.title), f'/c/{community.link()}')
         member = CommunityMember(user_id=current_user.id, community_id=community.id)
         db.session.add(member)
         db.session.commit()
+        invalidate_home_timeline(current_user.id)
         flash('You joined ' + community.title)
     if not community.user_is_banned(current_user):
         return redirect(url_for('community.add_post', actor=community.link()))
@@ -453,6 +449,7 @@ def add_post(actor):
         db.session.commit()
 
         notify_about_post(post)
+        add_post_to_home_timelines(post.id)
 
         if not community.local_only:
             page = {
@@ -506,12 +503,10 @@ def add_post(actor):
                 if post.type == POST_TYPE_IMAGE:
                     page['attachment'] = [{'type': 'Link', 'href': post.image.source_url}]  # source_url is always a https link, no need for .replace() as done above
             if not community.is_local():  # this is a remote community - send the post to the instance that hosts it
-                success = post_request(community.ap_inbox_url, create, current_user.private_key,
-                                       current_user.ap_profile_id + '#main-key')
-                if success:
-                    flash(_('Your post to %(name)s has been made.', name=community.title))
-                else:
-                    flash('There was a problem making your post to ' + community.title)
+                post_request_in_background(community.ap_inbox_url, create, current_user.id,
+                                           _('Problem sending your post to %(name)s', name=community.title),
+                                           url_for('activitypub.post_ap', post_id=post.id))
+                flash(_('Your post to %(name)s has been made.', name=community.title))
             else:   # local community - send (announce) post out to followers
                 announce = {
                     "id": f"https://{current_app.config['SERVER_NAME']}/activities/announce/{gibberish(15)}",
@@ -527,15 +522,8 @@ def add_post(actor):
                     'object': create
                 }
 
-                sent_to = 0
-                for instance in community.following_instances():
-                    if instance.inbox and not current_user.has_blocked_instance(instance.id) and not instance_banned(instance.domain):
-                        send_to_remote_instance(instance.id, community.id, announce)
-                        sent_to += 1
-                if sent_to:
-                    flash(_('Your post to %(name)s has been made.', name=community.title))
-                else:
-                    flash(_('Your post to %(name)s has been made.', name=community.title))
+                send_to_followers(community.id, announce, blocked_by_user_id=current_user.id)
+                flash(_('Your post to %(name)s has been made.', name=community.title))
 
         return redirect(f"/c/{community.link()}")
     else:
@@ -635,5 +623,6 @@ def community_notification(community_id: int):
             new_member = CommunityMember(community_id=community.id, user_id=current_user.id, notify_new_posts=True)
             db.session.add(new_member)
             db.session.commit()
+            invalidate_home_timeline(current_user.id)
 
     return render_template('community/_notification_toggle.html', community=community)
@@ -1,21 +1,24 @@
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from threading import Thread
 from time import sleep
 from typing import List
-import requests
 from PIL import Image, ImageOps
 from flask import request, abort, g, current_app
 from flask_login import current_user
 from pillow_heif import register_heif_opener
 
 from app import db, cache, celery
-from app.activitypub.signature import post_request
+from app.activitypub.outbox import queue_for_retry
+from app.activitypub.signature import post_request, HttpSignature
 from app.activitypub.util import find_actor_or_create, actor_json_to_model, post_json_to_model
 from app.constants import POST_TYPE_ARTICLE, POST_TYPE_LINK, POST_TYPE_IMAGE
 from app.models import Community, File, BannedInstances, PostReply, PostVote, Post, utcnow, CommunityMember, Site, \
-    Instance, Notification, User
+    Instance, Notification, User, ActivityPubLog
 from app.utils import get_request, gibberish, markdown_to_html, domain_from_url, allowlist_html, \
-    html_to_markdown, is_image_url, ensure_directory_exists, inbox_domain, post_ranking, shorten_string, parse_page, remove_tracking_from_link
+    html_to_markdown, is_image_url, ensure_directory_exists, inbox_domain, post_ranking, shorten_string, parse_page, \
+    remove_tracking_from_link, blocked_instances, awaken_dormant_instance, http_request, \
+    record_delivery_results
 from sqlalchemy import func
 import os
 
@@ -142,7 +145,7 @@ def opengraph_parse(url):
 def url_to_thumbnail_file(filename) -> File:
     filename_for_extension = filename.split('?')[0] if '?' in filename else filename
     unused, file_extension = os.path.splitext(filename_for_extension)
-    response = requests.get(filename, timeout=5)
+    response = http_request('GET', filename)
     if response.status_code == 200:
         new_filename = gibberish(15)
         directory = 'app/static/media/posts/' + new_filename[0:2] + '/' + new_filename[2:4]
@@ -395,13 +398,76 @@ def send_to_remote_instance_task(instance_id: int, community_id: int, payload):
     if community:
         instance = Instance.query.get(instance_id)
         if post_request(instance.inbox, payload, community.private_key, community.ap_profile_id + '#main-key'):
-            instance.last_successful_send = utcnow()
-            instance.failures = 0
+            record_delivery_results([instance.id], [])
         else:
-            instance.failures += 1
-            instance.most_recent_attempt = utcnow()
-            instance.start_trying_again = utcnow() + timedelta(seconds=instance.failures ** 4)
-            if instance.failures > 2:
-                instance.dormant = True
+            record_delivery_results([], [instance.id])
+            queue_for_retry(instance.id, instance.inbox, payload, community_id=community.id)
         db.session.commit()
 
+
+# Send an Announce to every remote instance that has members of a local community, using one celery task for all of them.
+# Like send_to_remote_instance this signs as the community so is only suitable for Announce activities.
+def send_to_followers(community_id: int, payload, blocked_by_user_id: int = None, exclude_instance_id: int = None,
+                      include_dormant=False):
+    if current_app.debug:
+        send_to_followers_task(community_id, payload, blocked_by_user_id, exclude_instance_id, include_dormant)
+    else:
+        send_to_followers_task.delay(community_id, payload, blocked_by_user_id, exclude_instance_id, include_dormant)
+
+
+@celery.task
+def send_to_followers_task(community_id: int, payload, blocked_by_user_id: int = None, exclude_instance_id: int = None,
+                           include_dormant=False):
+    community = Community.query.get(community_id)
+    if community is None:
+        return
+
+    # work out who to send to, with as few queries as possible
+    banned_domains = set(banned.domain for banned in BannedInstances.query.all())
+    blocked_instance_ids = set(blocked_instances(blocked_by_user_id)) if blocked_by_user_id else set()
+    recipients = []
+    for instance in community.following_instances(include_dormant=include_dormant):
+        if include_dormant:
+            # awaken dormant instances if they've been sleeping for long enough to be worth trying again
+            awaken_dormant_instance(instance)
+        if not instance.online() or not instance.inbox or instance.id == exclude_instance_id or \
+                instance.id in blocked_instance_ids or \
+                instance.domain in banned_domains or inbox_domain(instance.inbox) in banned_domains:
+            continue
+        recipients.append((instance.id, instance.inbox))
+    if not recipients:
+        return
+
+    # serialize and sign once, then deliver concurrently
+    body_bytes, signed_headers = HttpSignature.signed_requests([inbox for instance_id, inbox in recipients], payload,
+                                                               community.private_key, community.ap_profile_id + '#main-key')
+    app = current_app._get_current_object()
+
+    def deliver(recipient):
+        instance_id, inbox = recipient
+        with app.app_context():
+            try:
+                response = HttpSignature.send_signed(inbox, signed_headers[inbox], body_bytes)
+                if response.status_code == 200 or response.status_code == 202:
+                    return instance_id, None
+                return instance_id, f'{inbox} {response.status_code}'
+            except Exception as e:
+                return instance_id, f'{inbox} {e}'
+
+    with ThreadPoolExecutor(max_workers=current_app.config['FEDERATION_FANOUT_CONCURRENCY']) as executor:
+        results = list(executor.map(deliver, recipients))
+
+    succeeded = [instance_id for instance_id, error in results if error is None]
+    failed = [instance_id for instance_id, error in results if error is not None]
+    log = ActivityPubLog(direction='out', activity_json=body_bytes.decode('utf8'), activity_type=payload['type'],
+                         activity_id=payload['id'], result='success' if not failed else 'failure',
+                         exception_message=f'Sent to {len(succeeded)} of {len(results)} instances. ' +
+                                           ' '.join(error for instance_id, error in results if error is not None))
+    db.session.add(log)
+    record_delivery_results(succeeded, failed)
+    inboxes = dict(recipients)
+    for instance_id, error in results:
+        if error is not None:   # try again later
+            queue_for_retry(instance_id, inboxes[instance_id], payload, community_id=community.id, error=error)
+    db.session.commit()
+
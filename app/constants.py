@@ -16,4 +16,5 @@ SUBSCRIPTION_NONMEMBER = 0
 SUBSCRIPTION_PENDING = -1
 SUBSCRIPTION_BANNED = -2
 
-THREAD_CUTOFF_DEPTH = 4
\ No newline at end of file
+THREAD_CUTOFF_DEPTH = 4
+COMMENT_THREADS_PER_PAGE = 50   # top-level comments per page of a post's comments
@@ -9,13 +9,13 @@ from app.inoculation import inoculation
 from app.models import Post, Domain, Community, DomainBlock
 from app.domain import bp
 from app.utils import render_template, permission_required, joined_communities, moderating_communities, \
-    user_filters_posts, blocked_domains, blocked_instances
-from sqlalchemy import desc, or_
+    user_filters_posts, blocked_domains, blocked_instances, keyset_paginate, post_sort_columns, request_loader
+from sqlalchemy import or_
 
 
 @bp.route('/d/<domain_id>', methods=['GET'])
 def show_domain(domain_id):
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
 
     if '.' in domain_id:
         domain = Domain.query.filter_by(name=domain_id, banned=False).first()
@@ -26,10 +26,9 @@ def show_domain(domain_id):
     if domain:
         if current_user.is_anonymous or current_user.ignore_bots:
             posts = Post.query.join(Community, Community.id == Post.community_id).\
-                filter(Post.from_bot == False, Post.domain_id == domain.id, Community.banned == False).\
-                order_by(desc(Post.posted_at))
+                filter(Post.from_bot == False, Post.domain_id == domain.id, Community.banned == False)
         else:
-            posts = Post.query.join(Community).filter(Post.domain_id == domain.id, Community.banned == False).order_by(desc(Post.posted_at))
+            posts = Post.query.join(Community).filter(Post.domain_id == domain.id, Community.banned == False)
 
         if current_user.is_authenticated:
             instance_ids = blocked_instances(current_user.id)
@@ -39,9 +38,10 @@ def show_domain(domain_id):
         else:
             content_filters = {}
         # pagination
-        posts = posts.paginate(page=page, per_page=100, error_out=False)
-        next_url = url_for('domain.show_domain', domain_id=domain_id, page=posts.next_num) if posts.has_next else None
-        prev_url = url_for('domain.show_domain', domain_id=domain_id, page=posts.prev_num) if posts.has_prev and page != 1 else None
+        posts = keyset_paginate(posts.options(*Post.loading_profile('teaser')), post_sort_columns('new'), cursor, per_page=100)
+        request_loader().prime(posts=posts.items)
+        next_url = url_for('domain.show_domain', domain_id=domain_id, cursor=posts.next_cursor) if posts.has_next else None
+        prev_url = url_for('domain.show_domain', domain_id=domain_id, cursor=posts.prev_cursor) if posts.has_prev else None
         return render_template('domain/domain.html', domain=domain, title=domain.name, posts=posts,
                                POST_TYPE_IMAGE=constants.POST_TYPE_IMAGE, POST_TYPE_LINK=constants.POST_TYPE_LINK,
                                next_url=next_url, prev_url=prev_url,
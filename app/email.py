@@ -5,6 +5,7 @@ import boto3
 from botocore.exceptions import ClientError
 from typing import List
 import smtplib
+import time
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
@@ -107,6 +108,125 @@ def send_async_email(subject, sender, recipients, text_body, html_body, reply_to
                 return e.response['Error']['Message']
 
 
+BULK_EMAIL_RECONNECTS = 3      # times a dropped connection to the mail server is re-established within one call
+BULK_EMAIL_RETRY_DELAY = 60    # seconds before trying again with messages that could not be sent because the server went away
+
+
+# Wait until another message may be sent. With REDIS_URL set the limit is shared by every celery worker - each second
+# has a counter and when it reaches MAIL_RATE_LIMIT the sender waits for the next second. Without redis each worker
+# keeps to the limit on its own, so the total can be workers x MAIL_RATE_LIMIT.
+def _wait_for_mail_rate_limit(last_sent: float) -> float:
+    limit = current_app.config['MAIL_RATE_LIMIT']
+    if not limit:
+        return time.monotonic()
+    from app.utils import redis_connection
+    redis = redis_connection()
+    if redis is not None:
+        from redis.exceptions import RedisError
+        try:
+            while True:
+                now = time.time()
+                key = f"{current_app.config['CACHE_KEY_PREFIX']}:mail_rate:{int(now)}"
+                pipe = redis.pipeline(transaction=False)
+                pipe.incr(key)
+                pipe.expire(key, 2)
+                if pipe.execute()[0] <= limit:
+                    return time.monotonic()
+                time.sleep(int(now) + 1 - now)
+        except RedisError as e:
+            current_app.logger.warning(f'Mail rate limiter unavailable: {e}')
+    time.sleep(max(1 / limit - (time.monotonic() - last_sent), 0))
+    return time.monotonic()
+
+
+def _smtp_connection():
+    email_sender = SMTPEmailService(current_app.config['MAIL_USERNAME'], current_app.config['MAIL_PASSWORD'],
+                                    (current_app.config['MAIL_SERVER'], current_app.config['MAIL_PORT']),
+                                    use_tls=current_app.config['MAIL_USE_TLS'])
+    email_sender.connect()
+    return email_sender.smtpserver
+
+
+# Send a different message to each of many people, over one connection to the mail server. messages is a list of
+# (email address, text body, html body). No more than MAIL_RATE_LIMIT messages are sent per second. progress, if given,
+# is called after each message with whether it was sent. If the mail server drops the connection it is reconnected, up to
+# BULK_EMAIL_RECONNECTS times. Returns the number sent, the number that failed and the messages that were not tried
+# because the server could not be reached, for the caller to try again later.
+def send_bulk_email(subject, sender, messages: List[tuple], progress=None):
+    return_path = 'bounces@' + current_app.config['SERVER_NAME']
+    sent = failed = 0
+    if current_app.config['MAIL_SERVER']:
+        smtp_server = None
+
+        def send(recipient, text_body, html_body):
+            message = MIMEMultipart('alternative')
+            message.attach(MIMEText(text_body, 'plain'))
+            message.attach(MIMEText(html_body, 'html'))
+            message['Subject'] = subject
+            message['From'] = sender
+            message['To'] = recipient
+            smtp_server.send_message(message)
+    elif current_app.config['AWS_REGION']:
+        smtp_server = None
+        amazon_client = boto3.client('ses', region_name=current_app.config['AWS_REGION'])
+
+        def send(recipient, text_body, html_body):
+            amazon_client.send_email(Destination={'ToAddresses': [recipient]},
+                                     Message={'Body': {'Html': {'Charset': CHARSET, 'Data': html_body},
+                                                       'Text': {'Charset': CHARSET, 'Data': text_body}},
+                                              'Subject': {'Charset': CHARSET, 'Data': subject}},
+                                     Source=sender, ReturnPath=return_path)
+    else:
+        return 0, len(messages), []
+
+    last_sent = 0.0
+    reconnects = 0
+    position = 0
+    try:
+        while position < len(messages):
+            recipient, text_body, html_body = messages[position]
+            if current_app.config['MAIL_SERVER'] and smtp_server is None:
+                try:
+                    smtp_server = _smtp_connection()
+                except (smtplib.SMTPException, OSError) as e:
+                    current_app.logger.error(f'Could not connect to the mail server. {e}')
+                    break
+            last_sent = _wait_for_mail_rate_limit(last_sent)
+            try:
+                send(recipient, text_body, html_body)
+                sent += 1
+                succeeded = True
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError) as e:
+                # the connection went away, not the message's fault. Connect again and retry the same message.
+                current_app.logger.warning(f'Lost the connection to the mail server. {e}')
+                smtp_server = None
+                reconnects += 1
+                if reconnects > BULK_EMAIL_RECONNECTS:
+                    break
+                continue
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError, ClientError) as e:
+                current_app.logger.error(f'Failed to send email to {recipient}. {e}')
+                failed += 1
+                succeeded = False
+            if progress:
+                progress(succeeded)
+            position += 1
+    finally:
+        if smtp_server:
+            try:
+                smtp_server.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp_server.close()
+    return sent, failed, messages[position:]
+
+
+@celery.task
+def send_bulk_email_task(subject, sender, messages: List[tuple]):
+    sent, failed, unsent = send_bulk_email(subject, sender, messages)
+    if unsent:
+        send_bulk_email_task.apply_async((subject, sender, unsent), countdown=BULK_EMAIL_RETRY_DELAY)
+
+
 def send_email(subject, sender, recipients: List[str], text_body, html_body, reply_to=None):
     if current_app.debug:
         send_async_email(subject, sender, recipients, text_body, html_body, reply_to)
@@ -254,7 +374,8 @@ class SMTPEmailService:
         """
         if self.use_tls:
             self.smtpserver.starttls()
-        self.smtpserver.login(self.username, self.password)
+        if self.username:
+            self.smtpserver.login(self.username, self.password)
         self.connected = True
         print("Connected to {}".format(self.server_name))
 
@@ -3,11 +3,10 @@ from datetime import datetime, timedelta
 from math import log
 from random import randint
 
-import flask
 import markdown2
 from sqlalchemy.sql.operators import or_, and_
 
-from app import db, cache
+from app import cache
 from app.activitypub.util import default_context, make_image_sizes_async, refresh_user_profile, find_actor_or_create, \
     refresh_community_profile_task
 from app.constants import SUBSCRIPTION_PENDING, SUBSCRIPTION_MEMBER, POST_TYPE_IMAGE, POST_TYPE_LINK, \
@@ -15,7 +14,7 @@ from app.constants import SUBSCRIPTION_PENDING, SUBSCRIPTION_MEMBER, POST_TYPE_I
 from app.email import send_email, send_welcome_email
 from app.inoculation import inoculation
 from app.main import bp
-from flask import g, session, flash, request, current_app, url_for, redirect, make_response, jsonify
+from flask import g, session, flash, request, current_app, url_for, redirect, make_response, jsonify, send_file, abort
 from flask_moment import moment
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
@@ -24,9 +23,9 @@ from sqlalchemy_searchable import search
 from app.utils import render_template, get_setting, gibberish, request_etag_matches, return_304, blocked_domains, \
     ap_datetime, ip_address, retrieve_block_list, shorten_string, markdown_to_text, user_filters_home, \
     joined_communities, moderating_communities, parse_page, theme_list, get_request, markdown_to_html, allowlist_html, \
-    blocked_instances
-from app.models import Community, CommunityMember, Post, Site, User, utcnow, Domain, Topic, File, Instance, \
-    InstanceRole, Notification
+    blocked_instances, home_timelines_enabled, home_timeline_post_ids, rescore_home_timeline, keyset_paginate, \
+    post_sort_columns, request_loader, generate_sitemaps_task, SITEMAP_DIRECTORY, redis_connection
+from app.models import Community, CommunityMember, Post, Site, utcnow, Domain, Topic, File, Instance, InstanceRole
 from PIL import Image
 import pytesseract
 
@@ -65,8 +64,9 @@ def home_page(type, sort):
     if current_user.is_anonymous and request_etag_matches(current_etag):
         return return_304(current_etag)
 
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     low_bandwidth = request.cookies.get('low_bandwidth', '0') == '1'
+    timeline_ids = None
 
     if current_user.is_anonymous:
         flash(_('Create an account to tailor this feed to your interests.'))
@@ -80,7 +80,12 @@ def home_page(type, sort):
             posts = posts.filter(Community.show_all == True)
         content_filters = {}
     else:
-        if type == 'home':
+        # read the ids from their materialized timeline and just fetch those posts
+        timeline_ids = home_timeline_post_ids(current_user.id) if type == 'home' and sort == 'hot' and \
+            home_timelines_enabled() else None
+        if timeline_ids is not None:
+            posts = Post.query.filter(Post.id.in_(timeline_ids))
+        elif type == 'home':
             posts = Post.query.join(CommunityMember, Post.community_id == CommunityMember.community_id).filter(
                 CommunityMember.is_banned == False)
             # posts = posts.join(User, CommunityMember.user_id == User.id).filter(User.id == current_user.id)
@@ -109,27 +114,24 @@ def home_page(type, sort):
             posts = posts.filter(or_(Post.instance_id.not_in(instance_ids), Post.instance_id == None))
         content_filters = user_filters_home(current_user.id)
 
-    # Sorting
-    if sort == 'hot':
-        posts = posts.order_by(desc(Post.ranking)).order_by(desc(Post.posted_at))
-    elif sort == 'top':
-        posts = posts.filter(Post.posted_at > utcnow() - timedelta(days=1)).order_by(desc(Post.score))
-    elif sort == 'new':
-        posts = posts.order_by(desc(Post.posted_at))
-    elif sort == 'active':
-        posts = posts.order_by(desc(Post.last_active))
-
-    # Pagination
-    posts = posts.paginate(page=page, per_page=100 if current_user.is_authenticated and not low_bandwidth else 50, error_out=False)
+    if sort == 'top':
+        posts = posts.filter(Post.posted_at > utcnow() - timedelta(days=1))
+
+    # Sorting and pagination
+    posts = keyset_paginate(posts.options(*Post.loading_profile('teaser')), post_sort_columns(sort), cursor,
+                            per_page=100 if current_user.is_authenticated and not low_bandwidth else 50)
+    if timeline_ids is not None:
+        rescore_home_timeline(current_user.id, posts.items)
+    request_loader().prime(posts=posts.items)
     if type == 'home':
-        next_url = url_for('main.index', page=posts.next_num, sort=sort) if posts.has_next else None
-        prev_url = url_for('main.index', page=posts.prev_num, sort=sort) if posts.has_prev and page != 1 else None
+        next_url = url_for('main.index', cursor=posts.next_cursor, sort=sort) if posts.has_next else None
+        prev_url = url_for('main.index', cursor=posts.prev_cursor, sort=sort) if posts.has_prev else None
     elif type == 'popular':
-        next_url = url_for('main.popular', page=posts.next_num, sort=sort) if posts.has_next else None
-        prev_url = url_for('main.popular', page=posts.prev_num, sort=sort) if posts.has_prev and page != 1 else None
+        next_url = url_for('main.popular', cursor=posts.next_cursor, sort=sort) if posts.has_next else None
+        prev_url = url_for('main.popular', cursor=posts.prev_cursor, sort=sort) if posts.has_prev else None
     elif type == 'all':
-        next_url = url_for('main.all_posts', page=posts.next_num, sort=sort) if posts.has_next else None
-        prev_url = url_for('main.all_posts', page=posts.prev_num, sort=sort) if posts.has_prev and page != 1 else None
+        next_url = url_for('main.all_posts', cursor=posts.next_cursor, sort=sort) if posts.has_next else None
+        prev_url = url_for('main.all_posts', cursor=posts.prev_cursor, sort=sort) if posts.has_prev else None
 
     active_communities = Community.query.filter_by(banned=False).order_by(desc(Community.last_active)).limit(5).all()
 
@@ -178,7 +180,9 @@ def list_communities():
     if topic_id != 0:
         communities = communities.filter_by(topic_id=topic_id)
 
-    return render_template('list_communities.html', communities=communities.order_by(sort_by).all(), search=search_param, title=_('Communities'),
+    communities = communities.order_by(sort_by).all()
+    request_loader().prime(communities=communities)
+    return render_template('list_communities.html', communities=communities, search=search_param, title=_('Communities'),
                            SUBSCRIPTION_PENDING=SUBSCRIPTION_PENDING, SUBSCRIPTION_MEMBER=SUBSCRIPTION_MEMBER,
                            SUBSCRIPTION_OWNER=SUBSCRIPTION_OWNER, SUBSCRIPTION_MODERATOR=SUBSCRIPTION_MODERATOR,
                            topics=topics, topic_id=topic_id, sort_by=sort_by,
@@ -191,7 +195,9 @@ def list_local_communities():
     verification_warning()
     sort_by = text('community.' + request.args.get('sort_by') if request.args.get('sort_by') else 'community.post_reply_count desc')
     communities = Community.query.filter_by(ap_id=None, banned=False)
-    return render_template('list_communities.html', communities=communities.order_by(sort_by).all(), title=_('Local communities'), sort_by=sort_by,
+    communities = communities.order_by(sort_by).all()
+    request_loader().prime(communities=communities)
+    return render_template('list_communities.html', communities=communities, title=_('Local communities'), sort_by=sort_by,
                            SUBSCRIPTION_PENDING=SUBSCRIPTION_PENDING, SUBSCRIPTION_MEMBER=SUBSCRIPTION_MEMBER,
                            SUBSCRIPTION_OWNER=SUBSCRIPTION_OWNER, SUBSCRIPTION_MODERATOR=SUBSCRIPTION_MODERATOR,
                            low_bandwidth=request.cookies.get('low_bandwidth', '0') == '1', moderating_communities=moderating_communities(current_user.get_id()),
@@ -206,6 +212,7 @@ def list_subscribed_communities():
         communities = Community.query.filter_by(banned=False).join(CommunityMember).filter(CommunityMember.user_id == current_user.id).order_by(sort_by).all()
     else:
         communities = []
+    request_loader().prime(communities=communities)
     return render_template('list_communities.html', communities=communities, title=_('Joined communities'),
                            SUBSCRIPTION_PENDING=SUBSCRIPTION_PENDING, SUBSCRIPTION_MEMBER=SUBSCRIPTION_MEMBER, sort_by=sort_by,
                            SUBSCRIPTION_OWNER=SUBSCRIPTION_OWNER, SUBSCRIPTION_MODERATOR=SUBSCRIPTION_MODERATOR,
@@ -235,21 +242,28 @@ def robots():
     return resp
 
 
+# The sitemaps are generated by 'flask generate-sitemaps', from cron. send_file() sets Last-Modified and answers
+# If-Modified-Since with a 304. If they have never been generated, that is started in the background and this is a 404
+# until it has finished.
 @bp.route('/sitemap.xml')
-@cache.cached(timeout=6000)
 def sitemap():
-    posts = Post.query.filter(Post.from_bot == False)
-    posts = posts.join(Community, Community.id == Post.community_id)
-    posts = posts.filter(Community.show_all == True, Community.ap_id == None)   # sitemap.xml only includes local posts
-    if not g.site.enable_nsfw:
-        posts = posts.filter(Community.nsfw == False)
-    if not g.site.enable_nsfl:
-        posts = posts.filter(Community.nsfl == False)
-    posts = posts.order_by(desc(Post.posted_at))
-
-    resp = make_response(render_template('sitemap.xml', posts=posts, current_app=current_app))
-    resp.mimetype = 'text/xml'
-    return resp
+    if not os.path.exists(os.path.join(SITEMAP_DIRECTORY, 'sitemap.xml')):
+        redis = redis_connection()
+        if redis is None or redis.set('sitemaps:generating', 1, nx=True, ex=600):
+            if current_app.debug:
+                generate_sitemaps_task()
+            else:
+                generate_sitemaps_task.delay()
+        abort(404)
+    return send_file(os.path.abspath(os.path.join(SITEMAP_DIRECTORY, 'sitemap.xml')), mimetype='text/xml', max_age=3600)
+
+
+@bp.route('/sitemap-<int:number>.xml')
+def sitemap_page(number: int):
+    filename = os.path.abspath(os.path.join(SITEMAP_DIRECTORY, f'sitemap-{number}.xml'))
+    if not os.path.exists(filename):
+        abort(404)
+    return send_file(filename, mimetype='text/xml', max_age=3600)
 
 
 @bp.route('/keyboard_shortcuts')
@@ -268,49 +282,6 @@ def test():
     x = find_actor_or_create('artporn@lemm.ee')
     return 'ok'
 
-    users_to_notify = User.query.join(Notification, User.id == Notification.user_id).filter(
-            User.ap_id == None,
-            Notification.created_at > User.last_seen,
-            Notification.read == False,
-            User.email_unread_sent == False,    # they have not been emailed since last activity
-            User.email_unread == True           # they want to be emailed
-    ).all()
-
-    for user in users_to_notify:
-        notifications = Notification.query.filter(Notification.user_id == user.id, Notification.read == False,
-                                                  Notification.created_at > user.last_seen).all()
-        if notifications:
-            # Also get the top 20 posts since their last login
-            posts = Post.query.join(CommunityMember, Post.community_id == CommunityMember.community_id).filter(
-                CommunityMember.is_banned == False)
-            posts = posts.filter(CommunityMember.user_id == user.id)
-            if user.ignore_bots:
-                posts = posts.filter(Post.from_bot == False)
-            if user.show_nsfl is False:
-                posts = posts.filter(Post.nsfl == False)
-            if user.show_nsfw is False:
-                posts = posts.filter(Post.nsfw == False)
-            domains_ids = blocked_domains(user.id)
-            if domains_ids:
-                posts = posts.filter(or_(Post.domain_id.not_in(domains_ids), Post.domain_id == None))
-            posts = posts.filter(Post.posted_at > user.last_seen).order_by(desc(Post.score))
-            posts = posts.limit(20).all()
-
-            # Send email!
-            send_email(_('[PieFed] You have unread notifications'),
-                       sender=f'PieFed <noreply@{current_app.config["SERVER_NAME"]}>',
-                       recipients=[user.email],
-                       text_body=flask.render_template('email/unread_notifications.txt', user=user, notifications=notifications),
-                       html_body=flask.render_template('email/unread_notifications.html', user=user,
-                                                 notifications=notifications,
-                                                 posts=posts,
-                                                 domain=current_app.config['SERVER_NAME']))
-            user.email_unread_sent = True
-            db.session.commit()
-
-
-    return 'ok'
-
 
 @bp.route('/test_email')
 @login_required
@@ -2,12 +2,12 @@ from datetime import datetime, timedelta, date, timezone
 from time import time
 from typing import List
 
-from flask import current_app, escape, url_for, render_template_string
+from flask import current_app, escape, url_for, render_template_string, g
 from flask_login import UserMixin, current_user
 from sqlalchemy import or_, text
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_babel import _, lazy_gettext as _l
-from sqlalchemy.orm import backref
+from sqlalchemy.orm import backref, selectinload, joinedload, defer, lazyload
 from sqlalchemy_utils.types import TSVectorType # https://sqlalchemy-searchable.readthedocs.io/en/latest/installation.html
 from flask_sqlalchemy import BaseQuery
 from sqlalchemy_searchable import SearchQueryMixin
@@ -352,6 +352,8 @@ class Community(db.Model):
                                      ).all()
 
     def is_moderator(self, user=None):
+        if 'request_loader' in g:  # see RequestLoader in app/utils.py
+            return g.request_loader.is_moderator(self.id, current_user.id if user is None else user.id)
         if user is None:
             return any(moderator.user_id == current_user.id for moderator in self.moderators())
         else:
@@ -456,6 +458,8 @@ class User(UserMixin, db.Model):
     timezone = db.Column(db.String(20))
     reputation = db.Column(db.Float, default=0.0)
     attitude = db.Column(db.Float, default=1.0)  # (upvotes cast - downvotes cast) / (upvotes + downvotes). A number between 1 and -1 is the ratio between up and down votes they cast
+    upvotes_cast = db.Column(db.Integer, default=0)     # running total of upvotes cast on posts and replies. Kept up to date by vote_changed()
+    downvotes_cast = db.Column(db.Integer, default=0)   # running total of downvotes cast on posts and replies
     stripe_customer_id = db.Column(db.String(50))
     stripe_subscription_id = db.Column(db.String(50))
     searchable = db.Column(db.Boolean, default=True)
@@ -471,9 +475,9 @@ class User(UserMixin, db.Model):
     referrer = db.Column(db.String(256))
     markdown_editor = db.Column(db.Boolean, default=False)
 
-    avatar = db.relationship('File', lazy='joined', foreign_keys=[avatar_id], single_parent=True, cascade="all, delete-orphan")
-    cover = db.relationship('File', lazy='joined', foreign_keys=[cover_id], single_parent=True, cascade="all, delete-orphan")
-    instance = db.relationship('Instance', lazy='joined', foreign_keys=[instance_id])
+    avatar = db.relationship('File', foreign_keys=[avatar_id], single_parent=True, cascade="all, delete-orphan")
+    cover = db.relationship('File', foreign_keys=[cover_id], single_parent=True, cascade="all, delete-orphan")
+    instance = db.relationship('Instance', foreign_keys=[instance_id])
     conversations = db.relationship('Conversation', lazy='dynamic', secondary=conversation_member, backref=db.backref('members', lazy='joined'))
 
     ap_id = db.Column(db.String(255), index=True)           # e.g. username@server
@@ -636,33 +640,30 @@ class User(UserMixin, db.Model):
         return self.expires < datetime(2019, 9, 1)
 
     def recalculate_attitude(self):
-        upvotes = db.session.execute(text('SELECT COUNT(id) as c FROM "post_vote" WHERE user_id = :user_id AND effect > 0'),
-                                         {'user_id': self.id}).scalar()
-        downvotes = db.session.execute(text('SELECT COUNT(id) as c FROM "post_vote" WHERE user_id = :user_id AND effect < 0'),
-                                         {'user_id': self.id}).scalar()
-        if upvotes is None:
-            upvotes = 0
-        if downvotes is None:
-            downvotes = 0
-
-        comment_upvotes = db.session.execute(text('SELECT COUNT(id) as c FROM "post_reply_vote" WHERE user_id = :user_id AND effect > 0'),
-                                     {'user_id': self.id}).scalar()
-        comment_downvotes = db.session.execute(text('SELECT COUNT(id) as c FROM "post_reply_vote" WHERE user_id = :user_id AND effect < 0'),
-                                       {'user_id': self.id}).scalar()
-
-        if comment_upvotes is None:
-            comment_upvotes = 0
-        if comment_downvotes is None:
-            comment_downvotes = 0
-
-        total_upvotes = upvotes + comment_upvotes
-        total_downvotes = downvotes + comment_downvotes
+        total_upvotes = self.upvotes_cast or 0
+        total_downvotes = self.downvotes_cast or 0
 
         if total_downvotes == 0:    # guard against division by zero
             self.attitude = 1.0
         else:
             self.attitude = (total_upvotes - total_downvotes) / (total_upvotes + total_downvotes)
 
+    # Keep upvotes_cast and downvotes_cast in step with a vote by this user being added, reversed or removed.
+    # old_effect is the effect of the vote before the change (None if there wasn't one), new_effect is the effect afterwards
+    # (None if the vote was removed).
+    def vote_changed(self, old_effect, new_effect):
+        if old_effect:
+            if old_effect > 0:
+                self.upvotes_cast = max((self.upvotes_cast or 0) - 1, 0)
+            elif old_effect < 0:
+                self.downvotes_cast = max((self.downvotes_cast or 0) - 1, 0)
+        if new_effect:
+            if new_effect > 0:
+                self.upvotes_cast = (self.upvotes_cast or 0) + 1
+            elif new_effect < 0:
+                self.downvotes_cast = (self.downvotes_cast or 0) + 1
+        self.recalculate_attitude()
+
     def subscribed(self, community_id: int) -> int:
         if community_id is None:
             return False
@@ -784,7 +785,7 @@ class Post(db.Model):
     ip = db.Column(db.String(50))
     up_votes = db.Column(db.Integer, default=0)
     down_votes = db.Column(db.Integer, default=0)
-    ranking = db.Column(db.Integer, default=0, index=True)                          # used for 'hot' ranking
+    ranking = db.Column(db.Float, default=0.0, index=True)                          # used for 'hot' ranking
     language = db.Column(db.String(10))
     edited_at = db.Column(db.DateTime)
     reports = db.Column(db.Integer, default=0)                          # how many times this post has been reported. Set to -1 to ignore reports
@@ -795,10 +796,11 @@ class Post(db.Model):
 
     search_vector = db.Column(TSVectorType('title', 'body'))
 
-    image = db.relationship(File, lazy='joined', foreign_keys=[image_id], cascade="all, delete")
-    domain = db.relationship('Domain', lazy='joined', foreign_keys=[domain_id])
-    author = db.relationship('User', lazy='joined', overlaps='posts', foreign_keys=[user_id])
-    community = db.relationship('Community', lazy='joined', overlaps='posts', foreign_keys=[community_id])
+    # these are loaded when first used unless the query asks for them with loading_profile()
+    image = db.relationship(File, foreign_keys=[image_id], cascade="all, delete")
+    domain = db.relationship('Domain', foreign_keys=[domain_id])
+    author = db.relationship('User', overlaps='posts', foreign_keys=[user_id])
+    community = db.relationship('Community', overlaps='posts', foreign_keys=[community_id])
     replies = db.relationship('PostReply', lazy='dynamic', backref='post')
 
     def is_local(self):
@@ -806,7 +808,21 @@ class Post(db.Model):
 
     @classmethod
     def get_by_ap_id(cls, ap_id):
-        return cls.query.filter_by(ap_id=ap_id).first()
+        return cls.query.options(*cls.loading_profile('federation-lookup')).filter_by(ap_id=ap_id).first()
+
+    # Query options for loading posts, depending on what they will be used for.
+    # e.g. Post.query.options(*Post.loading_profile('teaser'))
+    @classmethod
+    def loading_profile(cls, name: str) -> list:
+        if name == 'teaser':                # lists of posts
+            return [selectinload(cls.author).joinedload(User.avatar), selectinload(cls.community),
+                    joinedload(cls.image), joinedload(cls.domain)]
+        elif name == 'full':                # the post page
+            return [joinedload(cls.author).joinedload(User.avatar), joinedload(cls.community),
+                    joinedload(cls.image), joinedload(cls.domain)]
+        elif name == 'federation-lookup':   # finding the post an activity is about
+            return [defer(cls.body), defer(cls.body_html), defer(cls.search_vector)]
+        raise ValueError(f'Unknown loading profile {name}')
 
     def delete_dependencies(self):
         db.session.query(Report).filter(Report.suspect_post_id == self.id).delete()
@@ -830,13 +846,9 @@ class Post(db.Model):
         else:
             return f"https://{current_app.config['SERVER_NAME']}/post/{self.id}"
 
+    # content_filters is a ContentFilters from one of the user_filters_* functions in app.utils
     def blocked_by_content_filter(self, content_filters):
-        lowercase_title = self.title.lower()
-        for name, keywords in content_filters.items() if content_filters else {}:
-            for keyword in keywords:
-                if keyword in lowercase_title:
-                    return name
-        return False
+        return content_filters.match(self.title) if content_filters else False
 
     def flush_cache(self):
         cache.delete(f'/post/{self.id}_False')
@@ -887,7 +899,17 @@ class PostReply(db.Model):
 
     @classmethod
     def get_by_ap_id(cls, ap_id):
-        return cls.query.filter_by(ap_id=ap_id).first()
+        return cls.query.options(*cls.loading_profile('federation-lookup')).filter_by(ap_id=ap_id).first()
+
+    # Query options for loading replies, depending on what they will be used for. See Post.loading_profile()
+    @classmethod
+    def loading_profile(cls, name: str) -> list:
+        if name == 'thread':                # a tree of comments under a post
+            return [lazyload(cls.community), joinedload(cls.author).joinedload(User.avatar),
+                    defer(cls.body), defer(cls.search_vector)]
+        elif name == 'federation-lookup':   # finding the reply an activity is about
+            return [defer(cls.body), defer(cls.body_html), defer(cls.search_vector)]
+        raise ValueError(f'Unknown loading profile {name}')
 
     def profile_id(self):
         if self.ap_id:
@@ -924,12 +946,7 @@ class PostReply(db.Model):
         return reply is not None
 
     def blocked_by_content_filter(self, content_filters):
-        lowercase_body = self.body.lower()
-        for name, keywords in content_filters.items() if content_filters else {}:
-            for keyword in keywords:
-                if keyword in lowercase_body:
-                    return name
-        return False
+        return content_filters.match(self.body) if content_filters else False
 
 
 class Domain(db.Model):
@@ -1068,6 +1085,25 @@ class ActivityPubLog(db.Model):
     created_at = db.Column(db.DateTime, default=utcnow)
 
 
+# activities waiting to be re-sent to a remote inbox after a failed delivery. See app/activitypub/outbox.py
+class OutboxItem(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    instance_id = db.Column(db.Integer, db.ForeignKey('instance.id'), index=True)
+    destination = db.Column(db.String(256))     # inbox url
+    activity_id = db.Column(db.String(256))
+    activity_json = db.Column(db.Text)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'))              # sign as this user...
+    community_id = db.Column(db.Integer, db.ForeignKey('community.id', ondelete='CASCADE'))    # ...or this community
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=utcnow, index=True)
+    last_error = db.Column(db.String(256))
+    notify_title = db.Column(db.String(50))     # if set, user_id gets a notification with this title if delivery is abandoned
+    notify_url = db.Column(db.String(512))
+    created_at = db.Column(db.DateTime, default=utcnow)
+
+    instance = db.relationship('Instance', lazy='joined')
+
+
 class Filter(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(50))
@@ -8,9 +8,9 @@ from flask_babel import _
 from sqlalchemy import or_, desc
 
 from app import db, constants, cache
-from app.activitypub.signature import HttpSignature, post_request
+from app.activitypub.signature import HttpSignature, post_request_in_background
 from app.activitypub.util import default_context
-from app.community.util import save_post, send_to_remote_instance
+from app.community.util import save_post, send_to_followers
 from app.inoculation import inoculation
 from app.post.forms import NewReplyForm, ReportPostForm, MeaCulpaForm
 from app.community.forms import CreatePostForm
@@ -21,22 +21,23 @@ from app.models import Post, PostReply, \
 from app.post import bp
 from app.utils import get_setting, render_template, allowlist_html, markdown_to_html, validation_required, \
     shorten_string, markdown_to_text, gibberish, ap_datetime, return_304, \
-    request_etag_matches, ip_address, user_ip_banned, instance_banned, can_downvote, can_upvote, post_ranking, \
-    reply_already_exists, reply_is_just_link_to_gif_reaction, confidence, moderating_communities, joined_communities, \
+    request_etag_matches, ip_address, user_ip_banned, can_downvote, can_upvote, apply_vote_tally, \
+    reply_already_exists, reply_is_just_link_to_gif_reaction, VoteTally, moderating_communities, joined_communities, \
     blocked_instances, blocked_domains
 
 
 def show_post(post_id: int):
-    post = Post.query.get_or_404(post_id)
+    post = Post.query.options(*Post.loading_profile('full')).get_or_404(post_id)
     community: Community = post.community
 
     if community.banned:
         abort(404)
 
     sort = request.args.get('sort', 'hot')
+    page = request.args.get('page', 1, type=int)
 
     # If nothing has changed since their last visit, return HTTP 304
-    current_etag = f"{post.id}{sort}_{hash(post.last_active)}"
+    current_etag = f"{post.id}{sort}{page}_{hash(post.last_active)}"
     if current_user.is_anonymous and request_etag_matches(current_etag):
         return return_304(current_etag)
 
@@ -143,10 +144,8 @@ def show_post(post_id: int):
             'id': f"https://{current_app.config['SERVER_NAME']}/activities/create/{gibberish(15)}"
         }
         if not community.is_local():    # this is a remote community, send it to the instance that hosts it
-            success = post_request(community.ap_inbox_url, create_json, current_user.private_key,
-                                                       current_user.ap_profile_id + '#main-key')
-            if not success:
-                flash('Failed to send to remote instance', 'error')
+            post_request_in_background(community.ap_inbox_url, create_json, current_user.id,
+                                       _('Failed to send to remote instance'), url_for('activitypub.post_ap', post_id=post.id))
         else:                       # local community - send it to followers on remote instances
             announce = {
                 "id": f"https://{current_app.config['SERVER_NAME']}/activities/announce/{gibberish(15)}",
@@ -162,15 +161,19 @@ def show_post(post_id: int):
                 'object': create_json
             }
 
-            for instance in community.following_instances():
-                if instance.inbox and not current_user.has_blocked_instance(instance.id) and not instance_banned(instance.domain):
-                    send_to_remote_instance(instance.id, community.id, announce)
+            send_to_followers(community.id, announce, blocked_by_user_id=current_user.id)
 
         return redirect(url_for('activitypub.post_ap', post_id=post_id))  # redirect to current page to avoid refresh resubmitting the form
     else:
-        replies = post_replies(post.id, sort)
+        replies = post_replies(post.id, sort, page)
         form.notify_author.data = True
 
+    # a full page of top-level comments means there may be more
+    next_url = url_for('activitypub.post_ap', post_id=post.id, sort=sort, page=page + 1, _anchor='post_replies') \
+        if len(replies) == constants.COMMENT_THREADS_PER_PAGE else None
+    prev_url = url_for('activitypub.post_ap', post_id=post.id, sort=sort, page=page - 1, _anchor='post_replies') \
+        if page > 1 else None
+
     og_image = post.image.source_url if post.image_id else None
     description = shorten_string(markdown_to_text(post.body), 150) if post.body else None
 
@@ -217,7 +220,8 @@ def show_post(post_id: int):
                            description=description, og_image=og_image, POST_TYPE_IMAGE=constants.POST_TYPE_IMAGE,
                            POST_TYPE_LINK=constants.POST_TYPE_LINK, POST_TYPE_ARTICLE=constants.POST_TYPE_ARTICLE,
                            noindex=not post.author.indexable,
-                           etag=f"{post.id}{sort}_{hash(post.last_active)}", markdown_editor=current_user.is_authenticated and current_user.markdown_editor,
+                           next_url=next_url, prev_url=prev_url,
+                           etag=f"{post.id}{sort}{page}_{hash(post.last_active)}", markdown_editor=current_user.is_authenticated and current_user.markdown_editor,
                            low_bandwidth=request.cookies.get('low_bandwidth', '0') == '1', SUBSCRIPTION_MEMBER=SUBSCRIPTION_MEMBER,
                            moderating_communities=moderating_communities(current_user.get_id()),
                            joined_communities=joined_communities(current_user.get_id()),
@@ -231,51 +235,57 @@ def show_post(post_id: int):
 @login_required
 @validation_required
 def post_vote(post_id: int, vote_direction):
+    tally = VoteTally()
     upvoted_class = downvoted_class = ''
     post = Post.query.get_or_404(post_id)
     existing_vote = PostVote.query.filter_by(user_id=current_user.id, post_id=post.id).first()
     if existing_vote:
         if not post.community.low_quality:
-            post.author.reputation -= existing_vote.effect
+            tally.reputation -= existing_vote.effect
         if existing_vote.effect > 0:  # previous vote was up
             if vote_direction == 'upvote':  # new vote is also up, so remove it
+                current_user.vote_changed(existing_vote.effect, None)
                 db.session.delete(existing_vote)
-                post.up_votes -= 1
-                post.score -= 1
+                tally.up_votes -= 1
+                tally.score -= 1
             else:  # new vote is down while previous vote was up, so reverse their previous vote
+                current_user.vote_changed(existing_vote.effect, -1)
                 existing_vote.effect = -1
-                post.up_votes -= 1
-                post.down_votes += 1
-                post.score -= 2
+                tally.up_votes -= 1
+                tally.down_votes += 1
+                tally.score -= 2
                 downvoted_class = 'voted_down'
         else:  # previous vote was down
             if vote_direction == 'downvote':  # new vote is also down, so remove it
+                current_user.vote_changed(existing_vote.effect, None)
                 db.session.delete(existing_vote)
-                post.down_votes -= 1
-                post.score += 1
+                tally.down_votes -= 1
+                tally.score += 1
             else:  # new vote is up while previous vote was down, so reverse their previous vote
+                current_user.vote_changed(existing_vote.effect, 1)
                 existing_vote.effect = 1
-                post.up_votes += 1
-                post.down_votes -= 1
-                post.score += 2
+                tally.up_votes += 1
+                tally.down_votes -= 1
+                tally.score += 2
                 upvoted_class = 'voted_up'
     else:
         if vote_direction == 'upvote':
             effect = 1
-            post.up_votes += 1
-            post.score += 1
+            tally.up_votes += 1
+            tally.score += 1
             upvoted_class = 'voted_up'
         else:
             effect = -1
-            post.down_votes += 1
-            post.score -= 1
+            tally.down_votes += 1
+            tally.score -= 1
             downvoted_class = 'voted_down'
         vote = PostVote(user_id=current_user.id, post_id=post.id, author_id=post.author.id,
                              effect=effect)
+        current_user.vote_changed(None, effect)
         # upvotes do not increase reputation in low quality communities
         if post.community.low_quality and effect > 0:
             effect = 0
-        post.author.reputation += effect
+        tally.reputation += effect
         db.session.add(vote)
 
         if not post.community.local_only:
@@ -301,21 +311,15 @@ def post_vote(post_id: int, vote_direction):
                     '@context': default_context(),
                     'object': action_json
                 }
-                for instance in post.community.following_instances():
-                    if instance.inbox and not current_user.has_blocked_instance(instance.id) and not instance_banned(instance.domain):
-                        send_to_remote_instance(instance.id, post.community.id, announce)
+                send_to_followers(post.community.id, announce, blocked_by_user_id=current_user.id)
             else:
-                success = post_request(post.community.ap_inbox_url, action_json, current_user.private_key,
-                                                           current_user.ap_profile_id + '#main-key')
-                if not success:
-                    flash('Failed to send vote', 'warning')
+                post_request_in_background(post.community.ap_inbox_url, action_json, current_user.id,
+                                           _('Failed to send vote'), url_for('activitypub.post_ap', post_id=post.id))
 
     current_user.last_seen = utcnow()
     current_user.ip_address = ip_address()
     if not current_user.banned:
-        post.ranking = post_ranking(post.score, post.created_at)
-        db.session.commit()
-        current_user.recalculate_attitude()
+        apply_vote_tally(post, tally)
         db.session.commit()
     post.flush_cache()
     template = 'post/_post_voting_buttons.html' if request.args.get('style', '') == '' else 'post/_post_voting_buttons_masonry.html'
@@ -328,45 +332,51 @@ def post_vote(post_id: int, vote_direction):
 @login_required
 @validation_required
 def comment_vote(comment_id, vote_direction):
+    tally = VoteTally()
     upvoted_class = downvoted_class = ''
     comment = PostReply.query.get_or_404(comment_id)
     existing_vote = PostReplyVote.query.filter_by(user_id=current_user.id, post_reply_id=comment.id).first()
     if existing_vote:
         if existing_vote.effect > 0:  # previous vote was up
             if vote_direction == 'upvote':  # new vote is also up, so remove it
+                current_user.vote_changed(existing_vote.effect, None)
                 db.session.delete(existing_vote)
-                comment.up_votes -= 1
-                comment.score -= 1
+                tally.up_votes -= 1
+                tally.score -= 1
             else:  # new vote is down while previous vote was up, so reverse their previous vote
+                current_user.vote_changed(existing_vote.effect, -1)
                 existing_vote.effect = -1
-                comment.up_votes -= 1
-                comment.down_votes += 1
-                comment.score -= 2
+                tally.up_votes -= 1
+                tally.down_votes += 1
+                tally.score -= 2
                 downvoted_class = 'voted_down'
         else:  # previous vote was down
             if vote_direction == 'downvote':  # new vote is also down, so remove it
+                current_user.vote_changed(existing_vote.effect, None)
                 db.session.delete(existing_vote)
-                comment.down_votes -= 1
-                comment.score += 1
+                tally.down_votes -= 1
+                tally.score += 1
             else:  # new vote is up while previous vote was down, so reverse their previous vote
+                current_user.vote_changed(existing_vote.effect, 1)
                 existing_vote.effect = 1
-                comment.up_votes += 1
-                comment.down_votes -= 1
-                comment.score += 2
+                tally.up_votes += 1
+                tally.down_votes -= 1
+                tally.score += 2
                 upvoted_class = 'voted_up'
     else:
         if vote_direction == 'upvote':
             effect = 1
-            comment.up_votes += 1
-            comment.score += 1
+            tally.up_votes += 1
+            tally.score += 1
             upvoted_class = 'voted_up'
         else:
             effect = -1
-            comment.down_votes += 1
-            comment.score -= 1
+            tally.down_votes += 1
+            tally.score -= 1
             downvoted_class = 'voted_down'
         vote = PostReplyVote(user_id=current_user.id, post_reply_id=comment_id, author_id=comment.author.id, effect=effect)
-        comment.author.reputation += effect
+        current_user.vote_changed(None, effect)
+        tally.reputation += effect
         db.session.add(vote)
 
         if comment.community.is_local():
@@ -382,16 +392,12 @@ def comment_vote(comment_id, vote_direction):
                     'id': f"https://{current_app.config['SERVER_NAME']}/activities/{action_type.lower()}/{gibberish(15)}",
                     'audience': comment.community.profile_id()
                 }
-                success = post_request(comment.community.ap_inbox_url, action_json, current_user.private_key,
-                                                           current_user.ap_profile_id + '#main-key')
-                if not success:
-                    flash('Failed to send vote', 'error')
+                post_request_in_background(comment.community.ap_inbox_url, action_json, current_user.id,
+                                           _('Failed to send vote'), url_for('activitypub.post_ap', post_id=comment.post_id))
 
     current_user.last_seen = utcnow()
     current_user.ip_address = ip_address()
-    comment.ranking = confidence(comment.up_votes, comment.down_votes)
-    db.session.commit()
-    current_user.recalculate_attitude()
+    apply_vote_tally(comment, tally)
     db.session.commit()
 
     comment.post.flush_cache()
@@ -546,10 +552,8 @@ def add_reply(post_id: int, comment_id: int):
                     }
                 ]
             if not post.community.is_local():    # this is a remote community, send it to the instance that hosts it
-                success = post_request(post.community.ap_inbox_url, create_json, current_user.private_key,
-                                                           current_user.ap_profile_id + '#main-key')
-                if not success:
-                    flash('Failed to send reply', 'error')
+                post_request_in_background(post.community.ap_inbox_url, create_json, current_user.id,
+                                           _('Failed to send reply'), url_for('activitypub.post_ap', post_id=post.id))
             else:                       # local community - send it to followers on remote instances
                 announce = {
                     "id": f"https://{current_app.config['SERVER_NAME']}/activities/announce/{gibberish(15)}",
@@ -565,9 +569,7 @@ def add_reply(post_id: int, comment_id: int):
                     'object': create_json
                 }
 
-                for instance in post.community.following_instances():
-                    if instance.inbox and not current_user.has_blocked_instance(instance.id) and not instance_banned(instance.domain):
-                        send_to_remote_instance(instance.id, post.community.id, announce)
+                send_to_followers(post.community.id, announce, blocked_by_user_id=current_user.id)
 
         if reply.depth <= constants.THREAD_CUTOFF_DEPTH:
             return redirect(url_for('activitypub.post_ap', post_id=post_id, _anchor=f'comment_{reply.id}'))
@@ -678,10 +680,8 @@ def post_edit(post_id: int):
                         page_json['attachment'] = [{'type': 'Link', 'href': post.image.source_url}]  # source_url is always a https link, no need for .replace() as done above
 
                 if not post.community.is_local():  # this is a remote community, send it to the instance that hosts it
-                    success = post_request(post.community.ap_inbox_url, update_json, current_user.private_key,
-                                           current_user.ap_profile_id + '#main-key')
-                    if not success:
-                        flash('Failed to send edit to remote server', 'error')
+                    post_request_in_background(post.community.ap_inbox_url, update_json, current_user.id,
+                                               _('Failed to send edit to remote server'), url_for('activitypub.post_ap', post_id=post.id))
                 else:  # local community - send it to followers on remote instances
                     announce = {
                         "id": f"https://{current_app.config['SERVER_NAME']}/activities/announce/{gibberish(15)}",
@@ -697,9 +697,7 @@ def post_edit(post_id: int):
                         'object': update_json
                     }
 
-                    for instance in post.community.following_instances():
-                        if instance.inbox and not current_user.has_blocked_instance(instance.id) and not instance_banned(instance.domain):
-                            send_to_remote_instance(instance.id, post.community.id, announce)
+                    send_to_followers(post.community.id, announce, blocked_by_user_id=current_user.id)
 
             return redirect(url_for('activitypub.post_ap', post_id=post.id))
         else:
@@ -758,10 +756,8 @@ def post_delete(post_id: int):
             }
 
             if not post.community.is_local():  # this is a remote community, send it to the instance that hosts it
-                success = post_request(post.community.ap_inbox_url, delete_json, current_user.private_key,
-                                       current_user.ap_profile_id + '#main-key')
-                if not success:
-                    flash('Failed to send delete to remote server', 'error')
+                post_request_in_background(post.community.ap_inbox_url, delete_json, current_user.id,
+                                           _('Failed to send delete to remote server'), url_for('activitypub.post_ap', post_id=post.id))
             else:  # local community - send it to followers on remote instances
                 announce = {
                     "id": f"https://{current_app.config['SERVER_NAME']}/activities/announce/{gibberish(15)}",
@@ -777,10 +773,7 @@ def post_delete(post_id: int):
                     'object': delete_json
                 }
 
-                for instance in post.community.following_instances():
-                    if instance.inbox and not current_user.has_blocked_instance(instance.id) and not instance_banned(
-                            instance.domain):
-                        send_to_remote_instance(instance.id, post.community.id, announce)
+                send_to_followers(post.community.id, announce, blocked_by_user_id=current_user.id)
 
     return redirect(url_for('activitypub.community_profile', actor=community.ap_id if community.ap_id is not None else community.name))
 
@@ -1030,10 +1023,8 @@ def post_reply_edit(post_id: int, comment_id: int):
                 }
 
                 if not post.community.is_local():  # this is a remote community, send it to the instance that hosts it
-                    success = post_request(post.community.ap_inbox_url, update_json, current_user.private_key,
-                                           current_user.ap_profile_id + '#main-key')
-                    if not success:
-                        flash('Failed to send edit to remote server', 'error')
+                    post_request_in_background(post.community.ap_inbox_url, update_json, current_user.id,
+                                               _('Failed to send edit to remote server'), url_for('activitypub.post_ap', post_id=post.id))
                 else:  # local community - send it to followers on remote instances
                     announce = {
                         "id": f"https://{current_app.config['SERVER_NAME']}/activities/announce/{gibberish(15)}",
@@ -1049,10 +1040,7 @@ def post_reply_edit(post_id: int, comment_id: int):
                         'object': update_json
                     }
 
-                    for instance in post.community.following_instances():
-                        if instance.inbox and not current_user.has_blocked_instance(instance.id) and not instance_banned(
-                                instance.domain):
-                            send_to_remote_instance(instance.id, post.community.id, announce)
+                    send_to_followers(post.community.id, announce, blocked_by_user_id=current_user.id)
             return redirect(url_for('activitypub.post_ap', post_id=post.id))
         else:
             form.body.data = post_reply.body
@@ -1098,10 +1086,8 @@ def post_reply_delete(post_id: int, comment_id: int):
             }
 
             if not post.community.is_local():  # this is a remote community, send it to the instance that hosts it
-                success = post_request(post.community.ap_inbox_url, delete_json, current_user.private_key,
-                                       current_user.ap_profile_id + '#main-key')
-                if not success:
-                    flash('Failed to send delete to remote server', 'error')
+                post_request_in_background(post.community.ap_inbox_url, delete_json, current_user.id,
+                                           _('Failed to send delete to remote server'), url_for('activitypub.post_ap', post_id=post.id))
             else:  # local community - send it to followers on remote instances
                 announce = {
                     "id": f"https://{current_app.config['SERVER_NAME']}/activities/announce/{gibberish(15)}",
@@ -1117,9 +1103,7 @@ def post_reply_delete(post_id: int, comment_id: int):
                     'object': delete_json
                 }
 
-                for instance in post.community.following_instances():
-                    if instance.inbox and not current_user.has_blocked_instance(instance.id) and not instance_banned(instance.domain):
-                        send_to_remote_instance(instance.id, post.community.id, announce)
+                send_to_followers(post.community.id, announce, blocked_by_user_id=current_user.id)
 
     return redirect(url_for('activitypub.post_ap', post_id=post.id))
 
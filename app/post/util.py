@@ -1,67 +1,75 @@
 from typing import List
 
 from flask_login import current_user
-from sqlalchemy import desc, text, or_
+from sqlalchemy import desc, text, or_, select, literal
 
 from app import db
+from app.constants import THREAD_CUTOFF_DEPTH, COMMENT_THREADS_PER_PAGE
 from app.models import PostReply
-from app.utils import blocked_instances
-
-
-# replies to a post, in a tree, sorted by a variety of methods
-def post_replies(post_id: int, sort_by: str, show_first: int = 0) -> List[PostReply]:
-    comments = PostReply.query.filter_by(post_id=post_id)
-    if current_user.is_authenticated:
-        instance_ids = blocked_instances(current_user.id)
-        if instance_ids:
-            comments = comments.filter(or_(PostReply.instance_id.not_in(instance_ids), PostReply.instance_id == None))
+from app.utils import blocked_instances, request_loader
+
+MAX_COMMENTS_PER_TREE = 2000  # safety limit on the size of any one page of comments
+
+
+# replies to a post, in a tree, sorted by a variety of methods. Paginated by top-level comment - each page has up to
+# per_page top-level comments and the replies under them, down to a little below THREAD_CUTOFF_DEPTH (the template
+# links to continue_discussion beyond that).
+def post_replies(post_id: int, sort_by: str, page: int = 1, per_page: int = COMMENT_THREADS_PER_PAGE) -> List[dict]:
+    top_level = db.session.query(PostReply.id).filter(PostReply.post_id == post_id, PostReply.parent_id == None)
+    top_level = _filter_blocked(top_level)
+    top_level = top_level.order_by(*_reply_order(sort_by)).limit(per_page).offset((page - 1) * per_page)
+    return comment_tree(post_id, PostReply.id.in_(top_level.scalar_subquery()), sort_by,
+                        max_level=THREAD_CUTOFF_DEPTH + 2)
+
+
+def get_comment_branch(post_id: int, comment_id: int, sort_by: str) -> List[dict]:
+    return comment_tree(post_id, PostReply.id == comment_id, sort_by)
+
+
+# Fetch the comments matching root_condition and everything underneath them in one query using a recursive CTE, with
+# their authors. Returns the roots, each as {'comment': PostReply, 'replies': [...]} where replies are the same
+# structure. max_level limits how many levels of replies below the roots are fetched.
+def comment_tree(post_id: int, root_condition, sort_by: str, max_level: int = None) -> List[dict]:
+    roots = select(PostReply.id, literal(0).label('level')).where(PostReply.post_id == post_id, root_condition)
+    tree = roots.cte('tree', recursive=True)
+    children = select(PostReply.id, (tree.c.level + 1).label('level')).join(tree, PostReply.parent_id == tree.c.id)
+    if max_level is not None:
+        children = children.where(tree.c.level < max_level)
+    tree = tree.union_all(children)
+
+    comments = db.session.query(PostReply, tree.c.level).join(tree, PostReply.id == tree.c.id).\
+        options(*PostReply.loading_profile('thread'))
+    comments = _filter_blocked(comments).order_by(*_reply_order(sort_by)).limit(MAX_COMMENTS_PER_TREE).all()
+    request_loader().prime(replies=[comment for comment, level in comments])   # the viewer's votes, in one query
+
+    # comments arrive already sorted so appending keeps every level in order. Replies whose parent was filtered out
+    # are dropped along with their parent.
+    nodes = {comment.id: {'comment': comment, 'replies': []} for comment, level in comments}
+    result = []
+    for comment, level in comments:
+        if level == 0:
+            result.append(nodes[comment.id])
+        elif comment.parent_id in nodes:
+            nodes[comment.parent_id]['replies'].append(nodes[comment.id])
+    return result
+
+
+def _reply_order(sort_by: str):
     if sort_by == 'hot':
-        comments = comments.order_by(desc(PostReply.ranking))
+        return desc(PostReply.ranking), desc(PostReply.id)
     elif sort_by == 'top':
-        comments = comments.order_by(desc(PostReply.score))
+        return desc(PostReply.score), desc(PostReply.id)
     elif sort_by == 'new':
-        comments = comments.order_by(desc(PostReply.posted_at))
-
-    comments = comments.limit(2000) # paginating indented replies is too hard so just get the first 2000.
-
-    comments_dict = {comment.id: {'comment': comment, 'replies': []} for comment in comments.all()}
-
-    for comment in comments:
-        if comment.parent_id is not None:
-            parent_comment = comments_dict.get(comment.parent_id)
-            if parent_comment:
-                parent_comment['replies'].append(comments_dict[comment.id])
+        return desc(PostReply.posted_at), desc(PostReply.id)
+    return PostReply.id,
 
-    return [comment for comment in comments_dict.values() if comment['comment'].parent_id is None]
 
-
-def get_comment_branch(post_id: int, comment_id: int, sort_by: str) -> List[PostReply]:
-    # Fetch the specified parent comment and its replies
-    parent_comment = PostReply.query.get(comment_id)
-    if parent_comment is None:
-        return []
-
-    comments = PostReply.query.filter(PostReply.post_id == post_id)
+def _filter_blocked(query):
     if current_user.is_authenticated:
         instance_ids = blocked_instances(current_user.id)
         if instance_ids:
-            comments = comments.filter(or_(PostReply.instance_id.not_in(instance_ids), PostReply.instance_id == None))
-    if sort_by == 'hot':
-        comments = comments.order_by(desc(PostReply.ranking))
-    elif sort_by == 'top':
-        comments = comments.order_by(desc(PostReply.score))
-    elif sort_by == 'new':
-        comments = comments.order_by(desc(PostReply.posted_at))
-
-    comments_dict = {comment.id: {'comment': comment, 'replies': []} for comment in comments.all()}
-
-    for comment in comments:
-        if comment.parent_id is not None:
-            parent_comment = comments_dict.get(comment.parent_id)
-            if parent_comment:
-                parent_comment['replies'].append(comments_dict[comment.id])
-
-    return [comment for comment in comments_dict.values() if comment['comment'].id == comment_id]
+            query = query.filter(or_(PostReply.instance_id.not_in(instance_ids), PostReply.instance_id == None))
+    return query
 
 
 # The number of replies a post has
@@ -5,14 +5,15 @@ from sqlalchemy import or_
 
 from app.models import Post
 from app.search import bp
-from app.utils import moderating_communities, joined_communities, render_template, blocked_domains, blocked_instances
+from app.utils import moderating_communities, joined_communities, render_template, blocked_domains, blocked_instances, \
+    keyset_paginate, post_sort_columns, request_loader
 
 
 @bp.route('/search', methods=['GET', 'POST'])
 def run_search():
     if request.args.get('q') is not None:
         q = request.args.get('q')
-        page = request.args.get('page', 1, type=int)
+        cursor = request.args.get('cursor')
         low_bandwidth = request.cookies.get('low_bandwidth', '0') == '1'
 
         posts = Post.query.search(q)
@@ -36,11 +37,12 @@ def run_search():
 
         posts = posts.filter(Post.indexable == True)
 
-        posts = posts.paginate(page=page, per_page=100 if current_user.is_authenticated and not low_bandwidth else 50,
-                               error_out=False)
+        posts = keyset_paginate(posts.options(*Post.loading_profile('teaser')), post_sort_columns('new'), cursor,
+                                per_page=100 if current_user.is_authenticated and not low_bandwidth else 50)
+        request_loader().prime(posts=posts.items)
 
-        next_url = url_for('search.run_search', page=posts.next_num, q=q) if posts.has_next else None
-        prev_url = url_for('search.run_search', page=posts.prev_num, q=q) if posts.has_prev and page != 1 else None
+        next_url = url_for('search.run_search', cursor=posts.next_cursor, q=q) if posts.has_next else None
+        prev_url = url_for('search.run_search', cursor=posts.prev_cursor, q=q) if posts.has_prev else None
 
         return render_template('search/results.html', title=_('Search results for %(q)s', q=q), posts=posts, q=q,
                                next_url=next_url, prev_url=prev_url,
@@ -8,21 +8,22 @@ from flask_login import login_required, current_user
 from flask_babel import _
 from sqlalchemy import text, desc, or_
 
-from app.activitypub.signature import post_request
+from app.activitypub.signature import post_request_in_background
 from app.constants import SUBSCRIPTION_NONMEMBER, POST_TYPE_IMAGE, POST_TYPE_LINK
 from app.inoculation import inoculation
-from app.models import Topic, Community, Post, utcnow, CommunityMember, CommunityJoinRequest, User
+from app.models import Topic, Community, Post, utcnow, CommunityMember, CommunityJoinRequest
 from app.topic import bp
-from app import db, celery, cache
+from app import db, cache
 from app.topic.forms import ChooseTopicsForm
 from app.utils import render_template, user_filters_posts, moderating_communities, joined_communities, \
-    community_membership, blocked_domains, validation_required, mimetype_from_url, blocked_instances
+    community_membership, blocked_domains, validation_required, mimetype_from_url, blocked_instances, \
+    invalidate_home_timeline, keyset_paginate, post_sort_columns, request_loader
 
 
 @bp.route('/topic/<path:topic_path>', methods=['GET'])
 def show_topic(topic_path):
 
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     sort = request.args.get('sort', '' if current_user.is_anonymous else current_user.default_sort)
     low_bandwidth = request.cookies.get('low_bandwidth', '0') == '1'
     post_layout = request.args.get('layout', 'list' if not low_bandwidth else None)
@@ -69,37 +70,31 @@ def show_topic(topic_path):
             if instance_ids:
                 posts = posts.filter(or_(Post.instance_id.not_in(instance_ids), Post.instance_id == None))
 
-        # sorting
-        if sort == '' or sort == 'hot':
-            posts = posts.order_by(desc(Post.ranking)).order_by(desc(Post.posted_at))
-        elif sort == 'top':
-            posts = posts.filter(Post.posted_at > utcnow() - timedelta(days=7)).order_by(desc(Post.score))
-        elif sort == 'new':
-            posts = posts.order_by(desc(Post.posted_at))
-        elif sort == 'active':
-            posts = posts.order_by(desc(Post.last_active))
-
-        # paging
+        if sort == 'top':
+            posts = posts.filter(Post.posted_at > utcnow() - timedelta(days=7))
+
+        # sorting and paging
         per_page = 100
         if post_layout == 'masonry':
             per_page = 200
         elif post_layout == 'masonry_wide':
             per_page = 300
-        posts = posts.paginate(page=page, per_page=per_page, error_out=False)
+        posts = keyset_paginate(posts.options(*Post.loading_profile('teaser')), post_sort_columns(sort), cursor, per_page)
+        request_loader().prime(posts=posts.items)
 
         topic_communities = Community.query.filter(Community.topic_id == current_topic.id).order_by(Community.name)
 
         next_url = url_for('topic.show_topic',
                            topic_path=topic_path,
-                           page=posts.next_num, sort=sort, layout=post_layout) if posts.has_next else None
+                           cursor=posts.next_cursor, sort=sort, layout=post_layout) if posts.has_next else None
         prev_url = url_for('topic.show_topic',
                            topic_path=topic_path,
-                           page=posts.prev_num, sort=sort, layout=post_layout) if posts.has_prev and page != 1 else None
+                           cursor=posts.prev_cursor, sort=sort, layout=post_layout) if posts.has_prev else None
 
         sub_topics = Topic.query.filter_by(parent_id=current_topic.id).order_by(Topic.name).all()
 
         return render_template('topic/show_topic.html', title=_(current_topic.name), posts=posts, topic=current_topic, sort=sort,
-                               page=page, post_layout=post_layout, next_url=next_url, prev_url=prev_url,
+                               post_layout=post_layout, next_url=next_url, prev_url=prev_url,
                                topic_communities=topic_communities, content_filters=content_filters,
                                sub_topics=sub_topics, topic_path=topic_path, breadcrumbs=breadcrumbs,
                                rss_feed=f"https://{current_app.config['SERVER_NAME']}/topic/{topic_path}.rss",
@@ -213,28 +208,18 @@ def join_topic(topic_id):
                 join_request = CommunityJoinRequest(user_id=current_user.id, community_id=community.id)
                 db.session.add(join_request)
                 db.session.commit()
-                if current_app.debug:
-                    send_community_follow(community.id, join_request, current_user.id)
-                else:
-                    send_community_follow.delay(community.id, join_request.id, current_user.id)
+                follow = {
+                    "actor": f"https://{current_app.config['SERVER_NAME']}/u/{current_user.user_name}",
+                    "to": [community.ap_profile_id],
+                    "object": community.ap_profile_id,
+                    "type": "Follow",
+                    "id": f"https://{current_app.config['SERVER_NAME']}/activities/follow/{join_request.id}"
+                }
+                post_request_in_background(community.ap_inbox_url, follow, current_user.id,
+                                           _('Problem joining %(name)s', name=community.title), f'/c/{community.link()}')
 
             member = CommunityMember(user_id=current_user.id, community_id=community.id)
             db.session.add(member)
             db.session.commit()
             cache.delete_memoized(community_membership, current_user, community)
-
-
-@celery.task
-def send_community_follow(community_id, join_request_id, user_id):
-    with current_app.app_context():
-        user = User.query.get(user_id)
-        community = Community.query.get(community_id)
-        follow = {
-            "actor": f"https://{current_app.config['SERVER_NAME']}/u/{user.user_name}",
-            "to": [community.ap_profile_id],
-            "object": community.ap_profile_id,
-            "type": "Follow",
-            "id": f"https://{current_app.config['SERVER_NAME']}/activities/follow/{join_request_id}"
-        }
-        success = post_request(community.ap_inbox_url, follow, user.private_key,
-                               user.profile_id() + '#main-key')
+    invalidate_home_timeline(current_user.id)
@@ -1,13 +1,12 @@
 from datetime import datetime, timedelta
-from time import sleep
 
 from flask import redirect, url_for, flash, request, make_response, session, Markup, current_app, abort, json
 from flask_login import login_user, logout_user, current_user, login_required
 from flask_babel import _
 
 from app import db, cache, celery
-from app.activitypub.signature import post_request
-from app.activitypub.util import default_context, find_actor_or_create
+from app.activitypub.signature import post_request_in_background
+from app.activitypub.util import find_actor_or_create
 from app.community.util import save_icon_file, save_banner_file, retrieve_mods_and_backfill
 from app.constants import SUBSCRIPTION_MEMBER, SUBSCRIPTION_PENDING
 from app.models import Post, Community, CommunityMember, User, PostReply, PostVote, Notification, utcnow, File, Site, \
@@ -15,10 +14,11 @@ from app.models import Post, Community, CommunityMember, User, PostReply, PostVo
     InstanceBlock
 from app.user import bp
 from app.user.forms import ProfileForm, SettingsForm, DeleteAccountForm, ReportUserForm, FilterEditForm
-from app.user.utils import purge_user_then_delete
+from app.user.utils import purge_user_then_delete, delete_account as start_account_deletion
 from app.utils import get_setting, render_template, markdown_to_html, user_access, markdown_to_text, shorten_string, \
     is_image_url, ensure_directory_exists, gibberish, file_get_contents, community_membership, user_filters_home, \
-    user_filters_posts, user_filters_replies, moderating_communities, joined_communities, theme_list
+    user_filters_posts, user_filters_replies, moderating_communities, joined_communities, theme_list, keyset_paginate, \
+    post_sort_columns, request_loader, invalidate_home_timeline
 from sqlalchemy import desc, or_, text
 import os
 
@@ -43,10 +43,12 @@ def show_profile(user):
     if user.deleted:
         flash(_('This user has been deleted.'), 'warning')
 
-    post_page = request.args.get('post_page', 1, type=int)
-    replies_page = request.args.get('replies_page', 1, type=int)
+    post_cursor = request.args.get('post_cursor')
+    replies_cursor = request.args.get('replies_cursor')
 
-    posts = Post.query.filter_by(user_id=user.id).order_by(desc(Post.posted_at)).paginate(page=post_page, per_page=50, error_out=False)
+    posts = keyset_paginate(Post.query.filter_by(user_id=user.id).options(*Post.loading_profile('teaser')),
+                            post_sort_columns('new'), post_cursor, per_page=50)
+    request_loader().prime(posts=posts.items)
     moderates = Community.query.filter_by(banned=False).join(CommunityMember).filter(CommunityMember.user_id == user.id)\
         .filter(or_(CommunityMember.is_moderator, CommunityMember.is_owner))
     if current_user.is_authenticated and (user.id == current_user.get_id() or current_user.is_admin()):
@@ -56,22 +58,22 @@ def show_profile(user):
     subscribed = Community.query.filter_by(banned=False).join(CommunityMember).filter(CommunityMember.user_id == user.id).all()
     if current_user.is_anonymous or user.id != current_user.id:
         moderates = moderates.filter(Community.private_mods == False)
-    post_replies = PostReply.query.filter_by(user_id=user.id).order_by(desc(PostReply.posted_at)).paginate(page=replies_page, per_page=50, error_out=False)
+    post_replies = keyset_paginate(PostReply.query.filter_by(user_id=user.id), [PostReply.posted_at, PostReply.id],
+                                   replies_cursor, per_page=50)
 
     # profile info
     canonical = user.ap_public_url if user.ap_public_url else None
-    user.about_html = markdown_to_html(user.about)
     description = shorten_string(markdown_to_text(user.about), 150) if user.about else None
 
     # pagination urls
     post_next_url = url_for('activitypub.user_profile', actor=user.ap_id if user.ap_id is not None else user.user_name,
-                       post_page=posts.next_num) if posts.has_next else None
+                       post_cursor=posts.next_cursor) if posts.has_next else None
     post_prev_url = url_for('activitypub.user_profile', actor=user.ap_id if user.ap_id is not None else user.user_name,
-                       post_page=posts.prev_num) if posts.has_prev and post_page != 1 else None
+                       post_cursor=posts.prev_cursor) if posts.has_prev else None
     replies_next_url = url_for('activitypub.user_profile', actor=user.ap_id if user.ap_id is not None else user.user_name,
-                       replies_page=post_replies.next_num) if post_replies.has_next else None
+                       replies_cursor=post_replies.next_cursor) if post_replies.has_next else None
     replies_prev_url = url_for('activitypub.user_profile', actor=user.ap_id if user.ap_id is not None else user.user_name,
-                       replies_page=post_replies.prev_num) if post_replies.has_prev and replies_page != 1 else None
+                       replies_cursor=post_replies.prev_cursor) if post_replies.has_prev else None
 
     return render_template('user/show_profile.html', user=user, posts=posts, post_replies=post_replies,
                            moderates=moderates.all(), canonical=canonical, title=_('Posts by %(user_name)s',
@@ -408,10 +410,7 @@ def delete_account():
 
         db.session.commit()
 
-        if current_app.debug:
-            send_deletion_requests(current_user.id)
-        else:
-            send_deletion_requests.delay(current_user.id)
+        start_account_deletion(current_user.id, ['account', 'finish'])
 
         logout_user()
         flash(_('Account deletion in progress. Give it a few minutes.'), 'success')
@@ -425,33 +424,6 @@ def delete_account():
                            )
 
 
-@celery.task
-def send_deletion_requests(user_id):
-    user = User.query.get(user_id)
-    if user:
-        instances = Instance.query.all()
-        payload = {
-            "@context": default_context(),
-            "actor": user.profile_id(),
-            "id": f"{user.profile_id()}#delete",
-            "object": user.profile_id(),
-            "to": [
-                "https://www.w3.org/ns/activitystreams#Public"
-            ],
-            "type": "Delete"
-        }
-        for instance in instances:
-            if instance.inbox and instance.online() and instance.id != 1: # instance id 1 is always the current instance
-                post_request(instance.inbox, payload, user.private_key, f"{user.profile_id()}#main-key")
-
-        sleep(5)
-
-        user.banned = True
-        user.deleted = True
-
-        db.session.commit()
-
-
 @bp.route('/u/<actor>/ban_purge', methods=['GET'])
 @login_required
 def ban_purge_profile(actor):
@@ -581,16 +553,16 @@ def import_settings_task(user_id, filename):
                         "type": "Follow",
                         "id": f"https://{current_app.config['SERVER_NAME']}/activities/follow/{join_request.id}"
                     }
-                    success = post_request(community.ap_inbox_url, follow, user.private_key,
-                                           user.profile_id() + '#main-key')
-                    if not success:
-                        sleep(5)    # give them a rest
+                    post_request_in_background(community.ap_inbox_url, follow, user.id,
+                                               _('Problem joining %(name)s', name=community.title),
+                                               f'/c/{community.link()}')
                 else:  # for local communities, joining is instant
                     banned = CommunityBan.query.filter_by(user_id=user.id, community_id=community.id).first()
                     if not banned:
                         member = CommunityMember(user_id=user.id, community_id=community.id)
                         db.session.add(member)
                         db.session.commit()
+                        invalidate_home_timeline(user.id)
                 cache.delete_memoized(community_membership, current_user, community)
 
     for community_ap_id in contents_json['blocked_communities'] if 'blocked_communities' in contents_json else []:
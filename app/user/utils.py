@@ -1,116 +1,409 @@
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from time import monotonic, time
 
-from flask import current_app, json
+from flask import current_app, render_template
+from flask_babel import _
+from sqlalchemy import text
+from sqlalchemy.orm import joinedload, load_only
 
 from app import celery, db
-from app.activitypub.signature import post_request
+from app.activitypub.outbox import queue_for_retry
+from app.activitypub.signature import HttpSignature
 from app.activitypub.util import default_context
-from app.community.util import send_to_remote_instance
-from app.models import User, CommunityMember, Community, Instance, Site, utcnow, ActivityPubLog
-from app.utils import gibberish, ap_datetime, instance_banned
+from app.community.util import send_to_followers
+from app.models import User, CommunityMember, Community, Instance, Post, utcnow, ActivityPubLog
+from app.utils import gibberish, ap_datetime, record_delivery_results, redis_connection
+from app.email import send_bulk_email_task
+
+
+ACCOUNT_DELETION_STAGES = ['posts', 'unsubscribe', 'account', 'finish']
+ACCOUNT_DELETION_BATCH_SIZE = 200   # posts, memberships or instances sent to between checkpoints
+ACCOUNT_DELETION_GRACE = 100        # seconds between federating the deletion and removing the account, for remote servers
+                                    # that GET the actor to verify the Delete and for related traffic to die down
+ACCOUNT_DELETION_KEY = 'account_deletion:'
 
 
 def purge_user_then_delete(user_id):
+    delete_account(user_id, ACCOUNT_DELETION_STAGES, cleanup='purge')
+
+
+# Delete a local account, federating the deletion first. The stages are done in this order:
+#   posts       - send a Delete for each of their posts
+#   unsubscribe - send an Undo Follow to each remote community they are a member of
+#   account     - send a Delete of the account to the shared inbox of every instance that is online
+#   finish      - mark the account as banned and deleted. cleanup='files' also deletes their avatar and cover and
+#                 cleanup='purge' deletes those and all their posts. Without cleanup the caller has dealt with files.
+# Progress is checkpointed in redis after each batch, so if a worker is restarted part way through then
+# 'flask resume-account-deletions' will carry on from where it got to.
+def delete_account(user_id: int, stages: list, cleanup: str = None):
     if current_app.debug:
-        purge_user_then_delete_task(user_id)
+        delete_account_task(user_id, stages, cleanup)
     else:
-        purge_user_then_delete_task.delay(user_id)
+        delete_account_task.delay(user_id, stages, cleanup)
+
+
+class DeletionCheckpoint:
+    # Which stages of the deletion of an account are done and how far through the current one it is. Without redis
+    # nothing is remembered between runs, so a run that comes back later to finish is only given the stages left to do.
+    def __init__(self, user_id: int):
+        self.key = f'{ACCOUNT_DELETION_KEY}{user_id}'
+        self.redis = redis_connection()
+        self.completed = []
+        self.cursor = 0
+        self.finish_after = 0.0
+
+    # Load the checkpoint or start a new one. Returns False if another worker is already deleting this account.
+    def begin(self, stages: list, cleanup: str | None) -> bool:
+        if self.redis is None:
+            return True
+        if not self.redis.set(self.key + ':lock', 1, nx=True, ex=15 * 60):
+            return False
+        saved = self.redis.hgetall(self.key)
+        if saved:
+            self.completed = saved[b'completed'].decode().split(',') if saved.get(b'completed') else []
+            self.cursor = int(saved.get(b'cursor', 0))
+            self.finish_after = float(saved.get(b'finish_after', 0))
+        else:
+            self.redis.hset(self.key, mapping={'stages': ','.join(stages), 'cleanup': cleanup or ''})
+        return True
+
+    def advance(self, cursor: int):
+        self.cursor = cursor
+        if self.redis is not None:
+            self.redis.hset(self.key, 'cursor', cursor)
+            self.redis.expire(self.key + ':lock', 15 * 60)
+
+    def complete(self, stage: str):
+        self.completed.append(stage)
+        self.cursor = 0
+        if self.redis is not None:
+            self.redis.hset(self.key, mapping={'completed': ','.join(self.completed), 'cursor': 0})
+
+    def schedule_finish(self, finish_after: float):
+        self.finish_after = finish_after
+        if self.redis is not None:
+            self.redis.hset(self.key, 'finish_after', finish_after)
+
+    def release(self):
+        if self.redis is not None:
+            self.redis.delete(self.key + ':lock')
+
+    def discard(self):
+        if self.redis is not None:
+            self.redis.delete(self.key, self.key + ':lock')
 
 
 @celery.task
-def purge_user_then_delete_task(user_id):
+def delete_account_task(user_id: int, stages: list, cleanup: str = None, finish_after: float = 0.0):
     user = User.query.get(user_id)
-    if user:
-        # posts
-        for post in user.posts:
-            if not post.community.local_only:
-                delete_json = {
-                    'id': f"https://{current_app.config['SERVER_NAME']}/activities/delete/{gibberish(15)}",
-                    'type': 'Delete',
-                    'actor': user.profile_id(),
-                    'audience': post.community.profile_id(),
-                    'to': [post.community.profile_id(), 'https://www.w3.org/ns/activitystreams#Public'],
-                    'published': ap_datetime(utcnow()),
-                    'cc': [
-                        user.followers_url()
+    if user is None or user.deleted:
+        DeletionCheckpoint(user_id).discard()
+        return
+    checkpoint = DeletionCheckpoint(user_id)
+    if not checkpoint.begin(stages, cleanup):
+        return
+    checkpoint.finish_after = max(checkpoint.finish_after, finish_after)
+    try:
+        for stage in stages:
+            if stage in checkpoint.completed:
+                continue
+            if stage == 'posts':
+                federate_post_deletions(user, checkpoint)
+            elif stage == 'unsubscribe':
+                federate_unsubscribes(user, checkpoint)
+            elif stage == 'account':
+                federate_account_deletion(user, checkpoint)
+                checkpoint.schedule_finish(time() + ACCOUNT_DELETION_GRACE)
+            elif stage == 'finish':
+                # give remote servers a while to come back for the actor before it goes. Rather than sleep, which ties
+                # up the worker, come back later. The earlier stages are done, so only 'finish' is passed on - without
+                # redis there is no checkpoint to say so.
+                wait = checkpoint.finish_after - time()
+                if wait > 0 and not current_app.debug:
+                    delete_account_task.apply_async((user_id, ['finish'], cleanup, checkpoint.finish_after), countdown=wait)
+                    return
+                user.banned = True
+                user.deleted = True
+                if cleanup == 'purge':
+                    user.purge_content()
+                elif cleanup == 'files':
+                    user.delete_dependencies()
+                db.session.commit()
+                checkpoint.discard()
+                return
+            checkpoint.complete(stage)
+        checkpoint.discard()
+    finally:
+        checkpoint.release()
+
+
+# Resume deletions that were interrupted, e.g. by a worker being restarted. Returns the ids of the accounts resumed.
+def resume_account_deletions() -> list:
+    redis = redis_connection()
+    if redis is None:
+        return []
+    resumed = []
+    for key in redis.scan_iter(match=ACCOUNT_DELETION_KEY + '*'):
+        key = key.decode()
+        if key.endswith(':lock') or redis.exists(key + ':lock'):
+            continue
+        saved = redis.hgetall(key)
+        if not saved.get(b'stages'):
+            continue
+        user_id = int(key[len(ACCOUNT_DELETION_KEY):])
+        delete_account(user_id, saved[b'stages'].decode().split(','), saved.get(b'cleanup', b'').decode() or None)
+        resumed.append(user_id)
+    return resumed
+
+
+def federate_post_deletions(user: User, checkpoint: DeletionCheckpoint):
+    while True:
+        posts = Post.query.options(load_only(Post.id, Post.ap_id, Post.community_id),
+                                   joinedload(Post.community).joinedload(Community.instance)).\
+            filter(Post.user_id == user.id, Post.id > checkpoint.cursor).order_by(Post.id).\
+            limit(ACCOUNT_DELETION_BATCH_SIZE).all()
+        if not posts:
+            return
+        deliveries = []
+        for post in posts:
+            community = post.community
+            if community.local_only:
+                continue
+            delete_json = {
+                'id': f"https://{current_app.config['SERVER_NAME']}/activities/delete/{gibberish(15)}",
+                'type': 'Delete',
+                'actor': user.profile_id(),
+                'audience': community.profile_id(),
+                'to': [community.profile_id(), 'https://www.w3.org/ns/activitystreams#Public'],
+                'published': ap_datetime(utcnow()),
+                'cc': [
+                    user.followers_url()
+                ],
+                'object': post.ap_id,
+            }
+
+            if not community.is_local():  # this is a remote community, send it to the instance that hosts it
+                if community.instance is None or community.instance.online():
+                    deliveries.append((community.instance_id, community.ap_inbox_url, delete_json))
+
+            else:  # local community - send it to followers on remote instances, using Announce
+                announce = {
+                    "id": f"https://{current_app.config['SERVER_NAME']}/activities/announce/{gibberish(15)}",
+                    "type": 'Announce',
+                    "to": [
+                        "https://www.w3.org/ns/activitystreams#Public"
+                    ],
+                    "actor": community.ap_profile_id,
+                    "cc": [
+                        community.ap_followers_url
                     ],
-                    'object': post.ap_id,
+                    '@context': default_context(),
+                    'object': delete_json
                 }
 
-                if not post.community.is_local():  # this is a remote community, send it to the instance that hosts it
-                    success = post_request(post.community.ap_inbox_url, delete_json, user.private_key,
-                                           user.ap_profile_id + '#main-key')
-
-                else:  # local community - send it to followers on remote instances, using Announce
-                    announce = {
-                        "id": f"https://{current_app.config['SERVER_NAME']}/activities/announce/{gibberish(15)}",
-                        "type": 'Announce',
-                        "to": [
-                            "https://www.w3.org/ns/activitystreams#Public"
-                        ],
-                        "actor": post.community.ap_profile_id,
-                        "cc": [
-                            post.community.ap_followers_url
-                        ],
-                        '@context': default_context(),
-                        'object': delete_json
-                    }
-
-                    for instance in post.community.following_instances():
-                        if instance.inbox and not instance_banned(instance.domain):
-                            send_to_remote_instance(instance.id, post.community.id, announce)
-
-        # unsubscribe
-        communities = CommunityMember.query.filter_by(user_id=user_id).all()
-        for membership in communities:
-            community = Community.query.get(membership.community_id)
-            unsubscribe_from_community(community, user)
-
-        # federate deletion of account
-        if user.is_local():
-            instances = Instance.query.all()
-            site = Site.query.get(1)
-            payload = {
-                "@context": default_context(),
-                "actor": user.ap_profile_id,
-                "id": f"{user.ap_profile_id}#delete",
-                "object": user.ap_profile_id,
-                "to": [
-                    "https://www.w3.org/ns/activitystreams#Public"
-                ],
-                "type": "Delete"
+                send_to_followers(community.id, announce)
+        send_in_parallel(user, deliveries)
+        checkpoint.advance(posts[-1].id)
+
+
+def federate_unsubscribes(user: User, checkpoint: DeletionCheckpoint):
+    while True:
+        communities = Community.query.join(CommunityMember, CommunityMember.community_id == Community.id).\
+            options(joinedload(Community.instance)).\
+            filter(CommunityMember.user_id == user.id, Community.id > checkpoint.cursor).order_by(Community.id).\
+            limit(ACCOUNT_DELETION_BATCH_SIZE).all()
+        if not communities:
+            return
+        deliveries = []
+        for community in communities:
+            if community.is_local() or (community.instance and not community.instance.online()):
+                continue
+            follow = {
+                "actor": user.profile_id(),
+                "to": [community.ap_profile_id],
+                "object": community.ap_profile_id,
+                "type": "Follow",
+                "id": f"https://{current_app.config['SERVER_NAME']}/activities/follow/{gibberish(15)}"
             }
-            for instance in instances:
-                if instance.inbox and instance.id != 1:
-                    post_request(instance.inbox, payload, user.private_key, user.ap_profile_id + '#main-key')
-
-        sleep(100)                                  # wait a while for any related activitypub traffic to die down.
-        user.deleted = True
-        user.delete_dependencies()
-        user.purge_content()
-        db.session.commit()
+            undo = {
+                'actor': user.profile_id(),
+                'to': [community.ap_profile_id],
+                'type': 'Undo',
+                'id': f"https://{current_app.config['SERVER_NAME']}/activities/undo/" + gibberish(15),
+                'object': follow
+            }
+            deliveries.append((community.instance_id, community.ap_inbox_url, undo))
+        send_in_parallel(user, deliveries)
+        checkpoint.advance(communities[-1].id)
 
 
-def unsubscribe_from_community(community, user):
-    undo_id = f"https://{current_app.config['SERVER_NAME']}/activities/undo/" + gibberish(15)
-    follow = {
-        "actor": f"https://{current_app.config['SERVER_NAME']}/u/{user.user_name}",
-        "to": [community.ap_profile_id],
-        "object": community.ap_profile_id,
-        "type": "Follow",
-        "id": f"https://{current_app.config['SERVER_NAME']}/activities/follow/{gibberish(15)}"
-    }
-    undo = {
-        'actor': user.profile_id(),
-        'to': [community.ap_profile_id],
-        'type': 'Undo',
-        'id': undo_id,
-        'object': follow
+def federate_account_deletion(user: User, checkpoint: DeletionCheckpoint):
+    payload = {
+        "@context": default_context(),
+        "actor": user.profile_id(),
+        "id": f"{user.profile_id()}#delete",
+        "object": user.profile_id(),
+        "to": [
+            "https://www.w3.org/ns/activitystreams#Public"
+        ],
+        "type": "Delete"
     }
-    activity = ActivityPubLog(direction='out', activity_id=undo_id, activity_type='Undo',
-                              activity_json=json.dumps(undo), result='processing')
-    db.session.add(activity)
+    while True:
+        instances = Instance.query.filter(Instance.id > max(checkpoint.cursor, 1)).order_by(Instance.id).\
+            limit(ACCOUNT_DELETION_BATCH_SIZE).all()     # instance id 1 is always the current instance
+        if not instances:
+            return
+        send_in_parallel(user, [(instance.id, instance.inbox, payload) for instance in instances
+                                if instance.inbox and instance.online()])
+        checkpoint.advance(instances[-1].id)
+
+
+# Sign and send activities as user, FEDERATION_FANOUT_CONCURRENCY at a time. deliveries is a list of
+# (instance_id, inbox, payload) - a payload that goes to several inboxes is only serialized once. Anything that fails
+# goes into the outbox to be tried again later.
+def send_in_parallel(user: User, deliveries: list):
+    if not deliveries:
+        return
+    key_id = user.profile_id() + '#main-key'
+    signed = {}
+    for instance_id, inbox, payload in deliveries:
+        signed.setdefault(payload['id'], (payload, []))[1].append(inbox)
+    for payload_id, (payload, inboxes) in list(signed.items()):
+        signed[payload_id] = HttpSignature.signed_requests(inboxes, payload, user.private_key, key_id)
+    app = current_app._get_current_object()
+
+    def deliver(delivery):
+        instance_id, inbox, payload = delivery
+        body_bytes, signed_headers = signed[payload['id']]
+        with app.app_context():
+            try:
+                response = HttpSignature.send_signed(inbox, signed_headers[inbox], body_bytes)
+                if response.status_code == 200 or response.status_code == 202:
+                    return None
+                return f'{inbox} {response.status_code}'
+            except Exception as e:
+                return f'{inbox} {e}'
+
+    with ThreadPoolExecutor(max_workers=current_app.config['FEDERATION_FANOUT_CONCURRENCY']) as executor:
+        errors = list(executor.map(deliver, deliveries))
+
+    succeeded = set()
+    failed = set()
+    for (instance_id, inbox, payload), error in zip(deliveries, errors):
+        db.session.add(ActivityPubLog(direction='out', activity_id=payload['id'], activity_type=payload['type'],
+                                      activity_json=signed[payload['id']][0].decode('utf8'),
+                                      result='success' if error is None else 'failure', exception_message=error))
+        if error is None:
+            succeeded.add(instance_id)
+        else:   # try again later
+            failed.add(instance_id)
+            queue_for_retry(instance_id, inbox, payload, user_id=user.id, error=error)
+    succeeded.discard(None)
+    failed.discard(None)
+    record_delivery_results(list(succeeded - failed), list(failed))
     db.session.commit()
-    post_request(community.ap_inbox_url, undo, user.private_key, user.profile_id() + '#main-key')
-    activity.result = 'success'
-    db.session.commit()
\ No newline at end of file
+
+
+DIGEST_BATCH_SIZE = 500         # people per batch. Each batch is one query for posts and one celery task to send it
+DIGEST_MAX_NOTIFICATIONS = 50   # most notifications listed in one email
+DIGEST_TOP_POSTS = 20
+
+
+# The person an unread notifications email is going to, with just what the templates need
+class DigestRecipient:
+    def __init__(self, id, email, title, user_name, verification_token):
+        self.id = id
+        self.email = email
+        self.title = title
+        self.user_name = user_name
+        self.verification_token = verification_token
+
+    def display_name(self):
+        return self.title or self.user_name
+
+
+# A notification or post listed in an unread notifications email
+class DigestItem:
+    def __init__(self, id, title):
+        self.id = id
+        self.title = title
+
+
+# Email local users who have unread notifications they have not been told about yet, along with the top posts in their
+# communities since they last visited. Everyone is found with one query and their posts are found a batch at a time
+# with a lateral join, so the number of queries does not grow with the number of users. With dry_run nothing is sent
+# or changed. Returns the number of emails and how many seconds each step took.
+def send_unread_notification_digests(dry_run=False, batch_size=DIGEST_BATCH_SIZE) -> dict:
+    timings = {'users': 0.0, 'posts': 0.0, 'render': 0.0, 'send': 0.0, 'update': 0.0}
+    started = monotonic()
+    rows = db.session.execute(text("""
+        SELECT user_id, email, title, user_name, verification_token, notification_id, notification_title FROM (
+            SELECT u.id AS user_id, u.email, u.title, u.user_name, u.verification_token, n.id AS notification_id,
+                   n.title AS notification_title,
+                   ROW_NUMBER() OVER (PARTITION BY u.id ORDER BY n.id DESC) AS position
+            FROM "user" u INNER JOIN "notification" n ON n.user_id = u.id
+            WHERE u.ap_id is null AND u.email_unread = true AND u.email_unread_sent = false
+            AND n.read = false AND n.created_at > u.last_seen) unread
+        WHERE position <= :max_notifications
+        ORDER BY user_id, notification_id"""), {'max_notifications': DIGEST_MAX_NOTIFICATIONS}).fetchall()
+    recipients = []
+    for user_id, user_rows in groupby(rows, key=lambda row: row.user_id):
+        user_rows = list(user_rows)
+        first = user_rows[0]
+        recipients.append((DigestRecipient(user_id, first.email, first.title, first.user_name, first.verification_token),
+                           [DigestItem(row.notification_id, row.notification_title) for row in user_rows]))
+    timings['users'] = monotonic() - started
+
+    subject = _('[PieFed] You have unread notifications')
+    sender = f'PieFed <noreply@{current_app.config["SERVER_NAME"]}>'
+    for batch_start in range(0, len(recipients), batch_size):
+        batch = recipients[batch_start:batch_start + batch_size]
+        user_ids = [user.id for user, notifications in batch]
+
+        started = monotonic()
+        top_posts = {user_id: [] for user_id in user_ids}
+        post_rows = db.session.execute(text("""
+            SELECT u.id, p.id, p.title FROM "user" u CROSS JOIN LATERAL (
+                SELECT p.id, p.title, p.score FROM "post" p
+                INNER JOIN "community_member" cm ON cm.community_id = p.community_id
+                WHERE cm.user_id = u.id AND cm.is_banned = false AND p.posted_at > u.last_seen
+                AND (u.ignore_bots is not true OR p.from_bot = false)
+                AND (u.show_nsfl is not false OR p.nsfl = false)
+                AND (u.show_nsfw is not false OR p.nsfw = false)
+                AND (p.domain_id is null OR NOT EXISTS (SELECT 1 FROM "domain_block" db
+                                                        WHERE db.user_id = u.id AND db.domain_id = p.domain_id))
+                ORDER BY p.score DESC LIMIT :top_posts) p
+            WHERE u.id = ANY(:user_ids)
+            ORDER BY u.id, p.score DESC"""), {'user_ids': user_ids, 'top_posts': DIGEST_TOP_POSTS})
+        for user_id, post_id, post_title in post_rows:
+            top_posts[user_id].append(DigestItem(post_id, post_title))
+        timings['posts'] += monotonic() - started
+
+        started = monotonic()
+        messages = []
+        for user, notifications in batch:
+            messages.append((user.email,
+                             render_template('email/unread_notifications.txt', user=user, notifications=notifications),
+                             render_template('email/unread_notifications.html', user=user, notifications=notifications,
+                                             posts=top_posts[user.id], domain=current_app.config['SERVER_NAME'])))
+        timings['render'] += monotonic() - started
+
+        if dry_run:
+            continue
+
+        started = monotonic()
+        if current_app.debug:
+            send_bulk_email_task(subject, sender, messages)
+        else:
+            send_bulk_email_task.delay(subject, sender, messages)
+        timings['send'] += monotonic() - started
+
+        # marked a batch at a time so that if the job is interrupted, the people already emailed are not emailed again
+        started = monotonic()
+        db.session.execute(text('UPDATE "user" SET email_unread_sent = true WHERE id = ANY(:user_ids)'),
+                           {'user_ids': user_ids})
+        db.session.commit()
+        timings['update'] += monotonic() - started
+
+    return {'emails': len(recipients), 'timings': timings}
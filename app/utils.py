@@ -1,11 +1,15 @@
 from __future__ import annotations
 
+import base64
 import hashlib
 import mimetypes
 import random
 import urllib
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from datetime import datetime, timedelta, date
+from html import escape
+from html.parser import HTMLParser
+from abc import ABC, abstractmethod
 from typing import List, Literal, Union
 
 import markdown2
@@ -15,15 +19,25 @@ from functools import wraps
 import flask
 from bs4 import BeautifulSoup, NavigableString
 import requests
+import requests.adapters
+from redis.exceptions import RedisError
+import urllib3
 import os
-from flask import current_app, json, redirect, url_for, request, make_response, Response, g
+import tempfile
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from flask import current_app, json, redirect, url_for, request, make_response, Response, g, Markup
+from flask_babel import get_locale
 from flask_login import current_user
-from sqlalchemy import text, or_
+from sqlalchemy import text, or_, and_, desc, asc
+from sqlalchemy.orm.attributes import set_committed_value
 from wtforms.fields  import SelectField, SelectMultipleField
 from wtforms.widgets import Select, html_params, ListWidget, CheckboxInput
-from app import db, cache
+from app import db, cache, celery
 import re
 
+from app.constants import SUBSCRIPTION_NONMEMBER, SUBSCRIPTION_MEMBER, SUBSCRIPTION_MODERATOR, SUBSCRIPTION_OWNER, \
+    SUBSCRIPTION_BANNED, SUBSCRIPTION_PENDING
 from app.email import send_welcome_email
 from app.models import Settings, Domain, Instance, BannedInstances, User, Community, DomainBlock, ActivityPubLog, IpBan, \
     Site, Post, PostReply, utcnow, Filter, CommunityMember, InstanceBlock
@@ -69,6 +83,65 @@ def getmtime(filename):
         return os.path.getmtime('static/' + filename)
 
 
+class CountingHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    def _new_conn(self):
+        http_client_stats['connections'] += 1
+        return super()._new_conn()
+
+
+class CountingHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    def _new_conn(self):
+        http_client_stats['connections'] += 1
+        return super()._new_conn()
+
+
+class PooledHTTPAdapter(requests.adapters.HTTPAdapter):
+    """ Keeps a pool of keep-alive connections per host and counts how often a new connection has to be opened """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': CountingHTTPConnectionPool,
+                                                   'https': CountingHTTPSConnectionPool}
+
+
+_http_session = None
+_http_session_pid = None
+http_client_stats = {'requests': 0, 'connections': 0}
+
+
+# One requests.Session per process, so connections to the same few big instances are reused rather than doing a new
+# TCP and TLS handshake for every fetch and delivery. Recreated after a fork (gunicorn and celery both fork).
+def http_session() -> requests.Session:
+    global _http_session, _http_session_pid
+    if _http_session is None or _http_session_pid != os.getpid():
+        session = requests.Session()
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))     # never send one instance's cookies to another
+        adapter = PooledHTTPAdapter(pool_connections=current_app.config['HTTP_POOL_CONNECTIONS'],
+                                    pool_maxsize=current_app.config['HTTP_POOL_MAXSIZE'])
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _http_session = session
+        _http_session_pid = os.getpid()
+    return _http_session
+
+
+# All outgoing HTTP requests go through here. Same arguments as requests.request()
+def http_request(method: str, uri: str, **kwargs) -> requests.Response:
+    kwargs.setdefault('timeout', current_app.config['HTTP_TIMEOUT'])
+    response = http_session().request(method, uri, **kwargs)
+    http_client_stats['requests'] += 1
+    if http_client_stats['requests'] % 1000 == 0:
+        current_app.logger.info(f"HTTP client: {http_client_stats['requests']} requests, "
+                                f"{http_client_stats['connections']} connections, reuse ratio {http_client_reuse_ratio()}")
+    return response
+
+
+# The proportion of requests that did not need a new connection
+def http_client_reuse_ratio() -> float:
+    if http_client_stats['requests'] == 0:
+        return 0.0
+    return round(max(1 - http_client_stats['connections'] / http_client_stats['requests'], 0.0), 3)
+
+
 # do a GET request to a uri, return the result
 def get_request(uri, params=None, headers=None) -> requests.Response:
     if headers is None:
@@ -80,7 +153,7 @@ def get_request(uri, params=None, headers=None) -> requests.Response:
     else:
         payload_str = urllib.parse.urlencode(params) if params else None
     try:
-        response = requests.get(uri, params=payload_str, headers=headers, timeout=5, allow_redirects=True)
+        response = http_request('GET', uri, params=payload_str, headers=headers, allow_redirects=True)
     except requests.exceptions.SSLError as invalid_cert:
         # Not our problem if the other end doesn't have proper SSL
         current_app.logger.info(f"{uri} {invalid_cert}")
@@ -102,7 +175,7 @@ def head_request(uri, params=None, headers=None) -> requests.Response:
     else:
         headers.update({'User-Agent': 'PieFed/1.0'})
     try:
-        response = requests.head(uri, params=params, headers=headers, timeout=5, allow_redirects=True)
+        response = http_request('HEAD', uri, params=params, headers=headers, allow_redirects=True)
     except requests.exceptions.SSLError as invalid_cert:
         # Not our problem if the other end doesn't have proper SSL
         current_app.logger.info(f"{uri} {invalid_cert}")
@@ -117,6 +190,120 @@ def head_request(uri, params=None, headers=None) -> requests.Response:
     return response
 
 
+_redis_connection = None
+
+
+# a connection to the redis server at REDIS_URL, or None if REDIS_URL is not set. One connection pool per process.
+def redis_connection():
+    global _redis_connection
+    if _redis_connection is None and current_app.config['REDIS_URL']:
+        import redis
+        _redis_connection = redis.Redis.from_url(current_app.config['REDIS_URL'], socket_timeout=1)
+    return _redis_connection
+
+
+HOME_TIMELINE_DEPTH = 1000              # how many posts are kept in each materialized home timeline
+HOME_TIMELINE_TTL = 7 * 24 * 60 * 60    # timelines of people who have not visited for this long are discarded
+
+
+# Materialized home timelines - when HOME_TIMELINES is enabled each local user who has visited recently has a redis
+# sorted set of the ids of posts in communities they have joined, scored by Post.ranking. New posts are added as they
+# arrive so building the home page does not need to join post to community_member.
+def home_timelines_enabled() -> bool:
+    return current_app.config['HOME_TIMELINES'] and redis_connection() is not None
+
+
+def _home_timeline_key(user_id) -> str:
+    return f"{current_app.config['CACHE_KEY_PREFIX']}:timeline:home:{user_id}"
+
+
+HOME_TIMELINE_BUILT = 0     # member of every timeline, so one for someone who has joined nothing still exists. Not a post id
+
+
+# Ids of the posts in a user's home timeline, highest ranking first. The timeline is built from the database if they
+# don't have one yet. Returns None if redis is not working, for the caller to query the database instead.
+def home_timeline_post_ids(user_id: int) -> List[int] | None:
+    redis = redis_connection()
+    key = _home_timeline_key(user_id)
+    try:
+        post_ids = [int(post_id) for post_id in redis.zrevrange(key, 0, -1)]
+        if post_ids:
+            redis.expire(key, HOME_TIMELINE_TTL)
+            return [post_id for post_id in post_ids if post_id != HOME_TIMELINE_BUILT]
+    except RedisError as e:
+        current_app.logger.warning(f'Home timeline unavailable: {e}')
+        return None
+
+    rows = db.session.execute(text("""SELECT p.id, p.ranking FROM "post" p
+                                      INNER JOIN "community_member" cm ON cm.community_id = p.community_id
+                                      WHERE cm.user_id = :user_id AND cm.is_banned = false
+                                      ORDER BY p.ranking DESC, p.posted_at DESC LIMIT :depth"""),
+                              {'user_id': user_id, 'depth': HOME_TIMELINE_DEPTH}).fetchall()
+    try:
+        pipe = redis.pipeline(transaction=False)
+        pipe.zadd(key, {HOME_TIMELINE_BUILT: float('-inf'), **{post_id: ranking or 0 for post_id, ranking in rows}})
+        pipe.expire(key, HOME_TIMELINE_TTL)
+        pipe.execute()
+    except RedisError as e:
+        current_app.logger.warning(f'Home timeline unavailable: {e}')
+    return [post_id for post_id, ranking in rows]
+
+
+# Store the current ranking of some posts, so the timeline is trimmed by up-to-date scores
+def rescore_home_timeline(user_id: int, posts: List[Post]):
+    if posts:
+        try:
+            redis_connection().zadd(_home_timeline_key(user_id), {post.id: post.ranking or 0 for post in posts}, xx=True)
+        except RedisError as e:
+            current_app.logger.warning(f'Home timeline unavailable: {e}')
+
+
+# Call after a user joins or leaves communities. Their timeline will be rebuilt next time it is needed.
+def invalidate_home_timeline(user_id: int):
+    if home_timelines_enabled():
+        try:
+            redis_connection().delete(_home_timeline_key(user_id))
+        except RedisError as e:
+            current_app.logger.warning(f'Home timeline of {user_id} not invalidated: {e}')
+
+
+# Put a new post into the home timeline of every local member of its community
+def add_post_to_home_timelines(post_id: int):
+    if home_timelines_enabled():
+        if current_app.debug:
+            add_post_to_home_timelines_task(post_id)
+        else:
+            add_post_to_home_timelines_task.delay(post_id)
+
+
+@celery.task
+def add_post_to_home_timelines_task(post_id: int):
+    post = Post.query.get(post_id)
+    if post is None:
+        return
+    member_ids = db.session.execute(text("""SELECT cm.user_id FROM "community_member" cm INNER JOIN "user" u ON u.id = cm.user_id
+                                            WHERE cm.community_id = :community_id AND cm.is_banned = false
+                                            AND u.ap_id is null"""),
+                                    {'community_id': post.community_id}).scalars().all()
+    if not member_ids:
+        return
+    redis = redis_connection()
+    # only timelines that already exist are updated, the rest get built when their owner next visits
+    keys = [_home_timeline_key(user_id) for user_id in member_ids]
+    try:
+        pipe = redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.exists(key)
+        existing = [key for key, exists in zip(keys, pipe.execute()) if exists]
+        pipe = redis.pipeline(transaction=False)
+        for key in existing:
+            pipe.zadd(key, {post.id: post.ranking or 0})
+            pipe.zremrangebyrank(key, 0, -HOME_TIMELINE_DEPTH - 2)     # the extra one is HOME_TIMELINE_BUILT
+        pipe.execute()
+    except RedisError as e:
+        current_app.logger.warning(f'Post {post_id} not added to home timelines: {e}')
+
+
 # saves an arbitrary object into a persistent key-value store. cached.
 @cache.memoize(timeout=50)
 def get_setting(name: str, default=None):
@@ -159,54 +346,136 @@ def is_image_url(url):
     return any(path.endswith(extension) for extension in common_image_extensions)
 
 
+ALLOWED_TAGS = {'p', 'strong', 'a', 'ul', 'ol', 'li', 'em', 'blockquote', 'cite', 'br', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+                'pre', 'code', 'img', 'details', 'summary', 'table', 'tr', 'td', 'th', 'tbody', 'thead'}
+ALLOWED_ATTRIBUTES = ('href', 'src', 'alt')
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+re_url = re.compile(r'(http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+)')
+re_unsafe_scheme = re.compile(r'^(javascript|vbscript|data):', re.IGNORECASE)
+re_ignored_url_chars = re.compile(r'[\x00-\x20\x7f]')     # browsers drop these from urls, so 'java\tscript:' is javascript:
+
+
+def unsafe_url(url: str) -> bool:
+    return re_unsafe_scheme.match(re_ignored_url_chars.sub('', url)) is not None
+
+
+# Sanitizes HTML in one pass over the events of html.parser, writing out allowed tags and text as they arrive. Tags
+# that are not allowed are dropped along with their contents, attributes other than href, src and alt are removed and
+# plain text links are turned into <a> tags.
+class AllowlistHTMLParser(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.output = []
+        self.open_tags = []     # (tag name, whether it was written to output) of each open tag
+        self.skipping = 0       # how many of the open tags are not allowed. Nothing is written while this is > 0
+        self.in_link = 0
+
+    def handle_starttag(self, tag, attrs):
+        allowed = tag in ALLOWED_TAGS and not self.skipping
+        if allowed:
+            self._write_start_tag(tag, attrs)
+        if tag in VOID_TAGS:
+            return
+        self.open_tags.append((tag, allowed))
+        if not allowed:
+            self.skipping += 1
+        elif tag == 'a':
+            self.in_link += 1
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in ALLOWED_TAGS and not self.skipping:
+            self._write_start_tag(tag, attrs)
+            if tag not in VOID_TAGS:
+                self.output.append(f'</{tag}>')
+
+    def handle_endtag(self, tag):
+        if not any(name == tag for name, allowed in self.open_tags):
+            return  # a stray end tag
+        while self.open_tags:
+            name, allowed = self.open_tags.pop()
+            self._close(name, allowed)
+            if name == tag:
+                break
+
+    def handle_data(self, data):
+        if self.skipping:
+            return
+        if self.in_link:
+            self.output.append(escape(data, quote=False))
+            return
+        for part in re_url.split(data):
+            if part == '':
+                continue
+            if re_url.match(part):
+                url = escape(part)
+                self.output.append(f'<a href="{url}" rel="nofollow ugc" target="_blank">{escape(part, quote=False)}</a>')
+            else:
+                self.output.append(escape(part, quote=False))
+
+    def close(self):
+        super().close()
+        while self.open_tags:
+            self._close(*self.open_tags.pop())
+        return ''.join(self.output)
+
+    def _close(self, name, allowed):
+        if allowed:
+            self.output.append(f'</{name}>')
+            if name == 'a':
+                self.in_link -= 1
+        else:
+            self.skipping -= 1
+
+    def _write_start_tag(self, tag, attrs):
+        attributes = {}
+        for name, value in attrs:
+            if name in ALLOWED_ATTRIBUTES and name not in attributes:
+                if name in ('href', 'src') and value and unsafe_url(value):
+                    continue
+                attributes[name] = value or ''
+        if tag == 'a':
+            attributes['rel'] = 'nofollow ugc'
+            attributes['target'] = '_blank'
+        elif tag == 'img':
+            attributes['loading'] = 'lazy'
+        elif tag == 'table':
+            attributes['class'] = 'table'
+        self.output.append('<' + tag + ''.join(f' {name}="{escape(value)}"' for name, value in attributes.items()) +
+                           ('/>' if tag in VOID_TAGS else '>'))
+
+
+SANITIZED_CACHE_SIZE = 4096     # how many recently sanitized bodies are remembered
+_sanitized_cache = OrderedDict()
+_sanitized_cache_lock = threading.Lock()
+
+
+# The same content is often sanitized many times - e.g. a post delivered by several instances, or a profile viewed
+# again - so results are kept in a small LRU keyed on a hash of the input and the kind of conversion.
+def _sanitize_cached(kind: str, content: str, convert):
+    key = hashlib.sha256(kind.encode() + b'\0' + content.encode('utf-8', 'surrogatepass')).digest()
+    with _sanitized_cache_lock:
+        if key in _sanitized_cache:
+            _sanitized_cache.move_to_end(key)
+            return _sanitized_cache[key]
+    result = convert(content)
+    with _sanitized_cache_lock:
+        _sanitized_cache[key] = result
+        if len(_sanitized_cache) > SANITIZED_CACHE_SIZE:
+            _sanitized_cache.popitem(last=False)
+    return result
+
+
+def _allowlist_html(html: str) -> str:
+    parser = AllowlistHTMLParser()
+    parser.feed(html)
+    return parser.close()
+
+
 # sanitise HTML using an allow list
 def allowlist_html(html: str) -> str:
     if html is None or html == '':
         return ''
-    allowed_tags = ['p', 'strong', 'a', 'ul', 'ol', 'li', 'em', 'blockquote', 'cite', 'br', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'pre',
-                    'code', 'img', 'details', 'summary', 'table', 'tr', 'td', 'th', 'tbody', 'thead']
-    # Parse the HTML using BeautifulSoup
-    soup = BeautifulSoup(html, 'html.parser')
-
-    # Find all plain text links, convert to <a> tags
-    re_url = re.compile(r'(http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+)')
-    for tag in soup.find_all(text=True):
-        tags = []
-        url = False
-        for t in re_url.split(tag.string):
-            if re_url.match(t):
-                a = soup.new_tag("a", href=t)
-                a.string = t
-                tags.append(a)
-                url = True
-            else:
-                tags.append(t)
-        if url:
-            for t in tags:
-                tag.insert_before(t)
-            tag.extract()
-
-    # Filter tags, leaving only safe ones
-    for tag in soup.find_all():
-        # If the tag is not in the allowed_tags list, remove it and its contents
-        if tag.name not in allowed_tags:
-            tag.extract()
-        else:
-            # Filter and sanitize attributes
-            for attr in list(tag.attrs):
-                if attr not in ['href', 'src', 'alt']:
-                    del tag[attr]
-            # Add nofollow and target=_blank to anchors
-            if tag.name == 'a':
-                tag.attrs['rel'] = 'nofollow ugc'
-                tag.attrs['target'] = '_blank'
-            # Add loading=lazy to images
-            if tag.name == 'img':
-                tag.attrs['loading'] = 'lazy'
-            if tag.name == 'table':
-                tag.attrs['class'] = 'table'
-
-    return str(soup)
+    return _sanitize_cached('html', html, _allowlist_html)
 
 
 # convert basic HTML to Markdown
@@ -246,11 +515,15 @@ def html_to_markdown_worker(element, indent_level=0):
 
 def markdown_to_html(markdown_text) -> str:
     if markdown_text:
-        return allowlist_html(markdown2.markdown(markdown_text, safe_mode=True, extras={'middle-word-em': False, 'tables': True}))
+        return _sanitize_cached('markdown', markdown_text, _markdown_to_html)
     else:
         return ''
 
 
+def _markdown_to_html(markdown_text: str) -> str:
+    return _allowlist_html(markdown2.markdown(markdown_text, safe_mode=True, extras={'middle-word-em': False, 'tables': True}))
+
+
 def markdown_to_text(markdown_text) -> str:
     if not markdown_text or markdown_text == '':
         return ''
@@ -307,6 +580,136 @@ def community_membership(user: User, community: Community) -> int:
     return user.subscribed(community.id)
 
 
+# Request-scoped batch loader. Templates ask the same questions about the viewer for every item on a page - their
+# membership of each community, who moderates it, how they voted on each post, what they have permission to do. Listing
+# routes call prime() with everything on the page so those are answered with a few bulk queries and then served from
+# memory for the rest of the request, rather than going through the cache backend (and the database on a miss) per item.
+# Anything that was not primed is loaded on first use and remembered.
+class RequestLoader:
+    def __init__(self, user_id: int | None):
+        self.user_id = user_id
+        self.memberships = {}       # community id -> SUBSCRIPTION_* level of the viewer
+        self.moderators = {}        # community id -> set of user ids
+        self.post_votes = {}        # post id -> effect of the viewer's vote, or None
+        self.reply_votes = {}       # post reply id -> effect of the viewer's vote, or None
+        self.permissions = None     # permissions the viewer has through their roles
+
+    def prime(self, posts=(), communities=(), replies=()):
+        community_ids = set(community.id for community in communities) | set(post.community_id for post in posts)
+        self._load_communities([community_id for community_id in community_ids if community_id not in self.moderators])
+        self._load_post_votes([post.id for post in posts if post.id not in self.post_votes])
+        self._load_reply_votes([reply.id for reply in replies if reply.id not in self.reply_votes])
+
+    def membership(self, community_id: int) -> int:
+        if community_id not in self.memberships:
+            self._load_communities([community_id])
+        return self.memberships.get(community_id, SUBSCRIPTION_NONMEMBER)
+
+    def is_moderator(self, community_id: int, user_id: int) -> bool:
+        if community_id not in self.moderators:
+            self._load_communities([community_id])
+        return user_id in self.moderators[community_id]
+
+    def post_vote(self, post_id: int):
+        if post_id not in self.post_votes:
+            self._load_post_votes([post_id])
+        return self.post_votes[post_id]
+
+    def reply_vote(self, reply_id: int):
+        if reply_id not in self.reply_votes:
+            self._load_reply_votes([reply_id])
+        return self.reply_votes[reply_id]
+
+    def has_permission(self, permission: str) -> bool:
+        if self.permissions is None:
+            self.permissions = set(db.session.execute(text("""SELECT rp.permission FROM "role_permission" rp
+                                                              INNER JOIN "user_role" ur ON rp.role_id = ur.role_id
+                                                              WHERE ur.user_id = :user_id"""),
+                                                      {'user_id': self.user_id}).scalars()) if self.user_id else set()
+        return permission in self.permissions
+
+    def _load_communities(self, community_ids: List[int]):
+        if not community_ids:
+            return
+        for community_id in community_ids:
+            self.moderators[community_id] = set()
+            self.memberships[community_id] = SUBSCRIPTION_NONMEMBER
+        rows = db.session.execute(text("""SELECT community_id, user_id, is_moderator, is_owner, is_banned FROM "community_member"
+                                          WHERE community_id = ANY(:community_ids) AND (is_moderator OR is_owner OR user_id = :user_id)"""),
+                                  {'community_ids': community_ids, 'user_id': self.user_id or 0})
+        for community_id, user_id, is_moderator, is_owner, is_banned in rows:
+            if is_moderator or is_owner:
+                self.moderators[community_id].add(user_id)
+            if user_id == self.user_id:
+                self.memberships[community_id] = SUBSCRIPTION_BANNED if is_banned else SUBSCRIPTION_OWNER if is_owner else \
+                    SUBSCRIPTION_MODERATOR if is_moderator else SUBSCRIPTION_MEMBER
+        if self.user_id:
+            pending = db.session.execute(text('SELECT community_id FROM "community_join_request" WHERE user_id = :user_id AND community_id = ANY(:community_ids)'),
+                                         {'user_id': self.user_id, 'community_ids': community_ids}).scalars()
+            for community_id in pending:
+                if self.memberships[community_id] == SUBSCRIPTION_NONMEMBER:
+                    self.memberships[community_id] = SUBSCRIPTION_PENDING
+
+    def _load_post_votes(self, post_ids: List[int]):
+        if not post_ids:
+            return
+        for post_id in post_ids:
+            self.post_votes[post_id] = None
+        if self.user_id:
+            votes = db.session.execute(text('SELECT post_id, effect FROM "post_vote" WHERE user_id = :user_id AND post_id = ANY(:post_ids)'),
+                                       {'user_id': self.user_id, 'post_ids': post_ids})
+            for post_id, effect in votes:
+                self.post_votes[post_id] = effect
+
+    def _load_reply_votes(self, reply_ids: List[int]):
+        if not reply_ids:
+            return
+        for reply_id in reply_ids:
+            self.reply_votes[reply_id] = None
+        if self.user_id:
+            votes = db.session.execute(text('SELECT post_reply_id, effect FROM "post_reply_vote" WHERE user_id = :user_id AND post_reply_id = ANY(:reply_ids)'),
+                                       {'user_id': self.user_id, 'reply_ids': reply_ids})
+            for reply_id, effect in votes:
+                self.reply_votes[reply_id] = effect
+
+
+# The RequestLoader for the current request, created on first use
+def request_loader() -> RequestLoader:
+    if 'request_loader' not in g:
+        g.request_loader = RequestLoader(current_user.id if current_user.is_authenticated else None)
+    return g.request_loader
+
+
+# community_membership() and user_access() for templates - answers about the viewer come from the request loader
+def request_community_membership(user: User, community: Community) -> int:
+    if community is None:
+        return False
+    if current_user.is_authenticated and user.id == current_user.id:
+        return request_loader().membership(community.id)
+    return community_membership(user, community)
+
+
+def request_user_access(permission: str, user_id: int) -> bool:
+    if current_user.is_authenticated and user_id == current_user.id:
+        return request_loader().has_permission(permission)
+    return user_access(permission, user_id)
+
+
+# upvoted_class and downvoted_class for the voting buttons, showing how the viewer has voted on a post or reply
+def post_vote_classes(post: Post):
+    return _vote_classes(request_loader().post_vote(post.id) if current_user.is_authenticated else None)
+
+
+def reply_vote_classes(reply: PostReply):
+    return _vote_classes(request_loader().reply_vote(reply.id) if current_user.is_authenticated else None)
+
+
+def _vote_classes(effect):
+    if effect is None or effect == 0:
+        return '', ''
+    return ('voted_up', '') if effect > 0 else ('', 'voted_down')
+
+
 @cache.memoize(timeout=86400)
 def blocked_domains(user_id) -> List[int]:
     blocks = DomainBlock.query.filter_by(user_id=user_id)
@@ -321,7 +724,7 @@ def blocked_instances(user_id) -> List[int]:
 
 def retrieve_block_list():
     try:
-        response = requests.get('https://raw.githubusercontent.com/rimu/no-qanon/master/domains.txt', timeout=1)
+        response = http_request('GET', 'https://raw.githubusercontent.com/rimu/no-qanon/master/domains.txt', timeout=1)
     except:
         return None
     if response and response.status_code == 200:
@@ -330,7 +733,7 @@ def retrieve_block_list():
 
 def retrieve_peertube_block_list():
     try:
-        response = requests.get('https://peertube_isolation.frama.io/list/peertube_isolation.json', timeout=1)
+        response = http_request('GET', 'https://peertube_isolation.frama.io/list/peertube_isolation.json', timeout=1)
     except:
         return None
     list = ''
@@ -401,6 +804,82 @@ def ap_datetime(date_time: datetime) -> str:
     return date_time.isoformat() + '+00:00'
 
 
+SITEMAP_DIRECTORY = 'app/static/sitemaps'
+SITEMAP_MAX_URLS = 50000    # the most a sitemap file may contain, according to sitemaps.org
+
+
+# Write sitemap.xml, which is a sitemap index, and sitemap-1.xml, sitemap-2.xml, etc which list the local posts. Only
+# the id and dates of each post are selected and rows are written out as they are streamed from the database, so
+# memory use does not grow with the number of posts. Run by 'flask generate-sitemaps'.
+def generate_sitemaps():
+    site = Site.query.get(1)
+    sql = """SELECT p.id, COALESCE(p.edited_at, p.posted_at, p.created_at) FROM "post" p
+             INNER JOIN "community" c ON c.id = p.community_id
+             WHERE p.from_bot = false AND c.show_all = true AND c.ap_id is null"""
+    if not site.enable_nsfw:
+        sql += ' AND c.nsfw = false'
+    if not site.enable_nsfl:
+        sql += ' AND c.nsfl = false'
+    sql += ' ORDER BY p.posted_at DESC'
+
+    ensure_directory_exists(SITEMAP_DIRECTORY)
+    server_name = current_app.config['SERVER_NAME']
+    pages = []      # last modified date of each sitemap-N.xml
+    file = None
+    rows = db.session.execute(text(sql).execution_options(stream_results=True, max_row_buffer=5000))
+    for count, (post_id, modified) in enumerate(rows):
+        if count % SITEMAP_MAX_URLS == 0:
+            if file:
+                _finish_sitemap_file(file, '</urlset>\n')
+            pages.append(modified)
+            file = _start_sitemap_file(f'sitemap-{len(pages)}.xml')
+            file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                       '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+        elif modified is not None and (pages[-1] is None or modified > pages[-1]):
+            pages[-1] = modified
+        lastmod = f'\t\t<lastmod>{ap_datetime(modified)}</lastmod>\n' if modified else ''  # no dates at all is rare
+        file.write(f'\t<url>\n\t\t<loc>https://{server_name}/post/{post_id}</loc>\n{lastmod}\t</url>\n')
+    if file:
+        _finish_sitemap_file(file, '</urlset>\n')
+
+    index = _start_sitemap_file('sitemap.xml')
+    index.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+    for number, modified in enumerate(pages, start=1):
+        lastmod = f'\t\t<lastmod>{ap_datetime(modified)}</lastmod>\n' if modified else ''
+        index.write(f'\t<sitemap>\n\t\t<loc>https://{server_name}/sitemap-{number}.xml</loc>\n{lastmod}\t</sitemap>\n')
+    _finish_sitemap_file(index, '</sitemapindex>\n')
+
+    # remove pages left over from when there were more posts
+    number = len(pages) + 1
+    while os.path.exists(os.path.join(SITEMAP_DIRECTORY, f'sitemap-{number}.xml')):
+        os.unlink(os.path.join(SITEMAP_DIRECTORY, f'sitemap-{number}.xml'))
+        number += 1
+    return len(pages)
+
+
+@celery.task
+def generate_sitemaps_task():
+    generate_sitemaps()
+
+
+# Files are written under a temporary name then renamed, so requests never see a half-written sitemap. The temporary
+# name is unique so two runs at once can't write into the same file.
+def _start_sitemap_file(filename):
+    fd, temporary_name = tempfile.mkstemp(prefix=filename + '.', suffix='.tmp', dir=SITEMAP_DIRECTORY)
+    os.chmod(temporary_name, 0o644)
+    file = os.fdopen(fd, 'w', encoding='utf-8')
+    file.temporary_name = temporary_name
+    file.final_name = os.path.join(SITEMAP_DIRECTORY, filename)
+    return file
+
+
+def _finish_sitemap_file(file, closing_tag: str):
+    file.write(closing_tag)
+    file.close()
+    os.replace(file.temporary_name, file.final_name)
+
+
 class MultiCheckboxField(SelectMultipleField):
     widget = ListWidget(prefix_label=False)
     option_widget = CheckboxInput()
@@ -543,6 +1022,40 @@ def awaken_dormant_instance(instance):
             db.session.commit()
 
 
+# Update the health columns of Instance after sending to them. After each failure wait failures ** 4 seconds before
+# trying again, and go dormant after 3 failures in a row.
+def record_delivery_results(succeeded: List[int], failed: List[int]):
+    now = utcnow()
+    if succeeded:
+        db.session.execute(text('UPDATE "instance" SET last_successful_send = :now, failures = 0 WHERE id = ANY(:ids)'),
+                           {'now': now, 'ids': succeeded})
+    if failed:
+        db.session.execute(text("""UPDATE "instance" SET failures = COALESCE(failures, 0) + 1, most_recent_attempt = :now,
+                                      start_trying_again = :now + make_interval(secs => power(COALESCE(failures, 0) + 1, 4)),
+                                      dormant = COALESCE(failures, 0) + 1 > 2
+                                   WHERE id = ANY(:ids)"""),
+                           {'now': now, 'ids': failed})
+
+
+TEASER_CACHE_TIMEOUT = 3600
+TEASER_VOTING_BUTTONS = '<!--voting_buttons-->'     # where the per-viewer parts go in a cached post teaser
+TEASER_REPORT_ICON = '<!--report_icon-->'
+
+
+# Render the parts of a post teaser that look the same to everyone, from cache when possible. The cache key includes
+# everything that changes the html so entries never need invalidating. The bits that depend on who is looking (voting
+# buttons, the moderator's report icon) are rendered by the calling template each time and slotted in.
+def post_teaser_fragment(template_name: str, post: Post, voting_buttons: str = '', report_icon: str = '', **context):
+    key = f"teaser/{template_name}/{post.id}/{post.last_active}/{post.edited_at}/{post.score}/{post.reply_count}/" \
+          f"{context.get('post_layout')}/{context.get('low_bandwidth')}/{context.get('show_post_community')}/" \
+          f"{context.get('sort') == 'active'}/{get_locale()}"
+    html = cache.get(key)
+    if html is None:
+        html = flask.render_template(template_name, post=post, **context)
+        cache.set(key, html, timeout=TEASER_CACHE_TIMEOUT)
+    return Markup(html.replace(TEASER_VOTING_BUTTONS, str(voting_buttons)).replace(TEASER_REPORT_ICON, str(report_icon)))
+
+
 def shorten_number(number):
     if number < 1000:
         return str(number)
@@ -552,43 +1065,160 @@ def shorten_number(number):
         return f'{number / 1000000:.1f}M'
 
 
+# The result of keyset_paginate(). Has .items, .has_next and .has_prev like Flask-SQLAlchemy's Pagination, with
+# next_cursor and prev_cursor to put in the next_url and prev_url instead of page numbers.
+class KeysetPage:
+    def __init__(self, items: list, next_cursor: str | None, prev_cursor: str | None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.has_next = next_cursor is not None
+        self.has_prev = prev_cursor is not None
+
+
+# Cursor pagination - instead of counting every row and skipping over the earlier pages with OFFSET, each page starts
+# where the previous one ended. sort_columns are the columns to sort by, all descending, and must end with a unique
+# column (e.g. Post.id) to break ties. cursor is a token from a previous page's next_cursor or prev_cursor, or None for
+# the first page. Any order_by already on the query is replaced. NULLs in nullable columns come last. The columns are
+# compared as they are, not through an expression, so their indexes can still be used.
+def keyset_paginate(query, sort_columns: list, cursor: str | None, per_page: int) -> KeysetPage:
+    direction, values = _decode_cursor(cursor, sort_columns) if cursor else ('next', None)
+    query = query.order_by(None)
+    if direction == 'next':
+        if values:
+            query = query.filter(_keyset_beyond(sort_columns, values, descending=True))
+        query = query.order_by(*[desc(column).nulls_last() if column.nullable else desc(column) for column in sort_columns])
+    else:
+        query = query.filter(_keyset_beyond(sort_columns, values, descending=False))
+        query = query.order_by(*[asc(column).nulls_first() if column.nullable else asc(column) for column in sort_columns])
+    items = query.limit(per_page + 1).all()
+    more = len(items) > per_page
+    items = items[:per_page]
+    if direction == 'prev':
+        items.reverse()
+
+    if not items:
+        return KeysetPage(items, None, None)
+    first = _encode_cursor('prev', _keyset_values(items[0], sort_columns))
+    last = _encode_cursor('next', _keyset_values(items[-1], sort_columns))
+    if direction == 'next':
+        return KeysetPage(items, last if more else None, first if values else None)
+    else:
+        return KeysetPage(items, last, first if more else None)
+
+
+# The columns to keyset_paginate() posts by, for each way of sorting them
+def post_sort_columns(sort: str) -> list:
+    if sort == 'top':
+        return [Post.score, Post.id]
+    elif sort == 'new':
+        return [Post.posted_at, Post.id]
+    elif sort == 'active':
+        return [Post.last_active, Post.id]
+    else:
+        return [Post.ranking, Post.posted_at, Post.id]
+
+
+# The condition for rows that come after values when sorting by columns - further down the page when descending, further
+# up when not. Like the row comparison (a, b) < (x, y) but with NULL counted as lower than any value, which a row
+# comparison can't do.
+def _keyset_beyond(columns: list, values: list, descending: bool):
+    column, value = columns[-1], values[-1]
+    condition = column < value if descending else column > value
+    for column, value in zip(reversed(columns[:-1]), reversed(values[:-1])):
+        if value is None:
+            if descending:
+                condition = and_(column.is_(None), condition)
+            else:
+                condition = or_(column.is_not(None), and_(column.is_(None), condition))
+        elif descending:
+            condition = or_(column < value, and_(column == value, condition))
+            if column.nullable:
+                condition = or_(condition, column.is_(None))
+        else:
+            condition = or_(column > value, and_(column == value, condition))
+    return condition
+
+
+def _keyset_values(item, sort_columns: list) -> list:
+    return [getattr(item, column.key) for column in sort_columns]
+
+
+def _encode_cursor(direction: str, values: list) -> str:
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps([direction] + values).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decode_cursor(cursor: str, sort_columns: list):
+    try:
+        direction, *values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if direction not in ('next', 'prev') or len(values) != len(sort_columns) or \
+                any(value is None and not column.nullable for column, value in zip(sort_columns, values)):
+            raise ValueError('malformed cursor')
+        return direction, [datetime.fromisoformat(value) if value is not None and isinstance(column.type, db.DateTime)
+                           else value for column, value in zip(sort_columns, values)]
+    except (ValueError, TypeError):
+        return 'next', None     # start from the beginning
+
+
+# Keyword filters, compiled into one regular expression for the filters that hide posts completely and one for the rest,
+# so each post is searched once no matter how many keywords there are. Instances are cached by the user_filters_*
+# functions below.
+class ContentFilters:
+    def __init__(self, filters):
+        self.names = {}     # keyword -> title of the filter it came from, or '-1' for filters that hide completely
+        hide_keywords = set()
+        for filter in filters:
+            for keyword in filter.keywords.splitlines():
+                keyword = keyword.strip().lower()
+                if keyword == '':
+                    continue
+                if filter.hide_type == 0:     # type == 1 means hide completely. These posts are excluded from output by the jinja template
+                    self.names.setdefault(keyword, filter.title)
+                else:
+                    hide_keywords.add(keyword)
+        for keyword in hide_keywords:
+            self.names[keyword] = '-1'
+        self.hide_pattern = self._compile(hide_keywords)
+        self.warn_pattern = self._compile(set(self.names) - hide_keywords)
+
+    @staticmethod
+    def _compile(keywords):
+        if not keywords:
+            return None
+        # longest first, so that a keyword which contains another one is the one that matches
+        return re.compile('|'.join(re.escape(keyword) for keyword in sorted(keywords, key=len, reverse=True)))
+
+    def __bool__(self):
+        return bool(self.names)
+
+    # The title of the filter that matches text, '-1' if the post should be hidden completely, or False.
+    def match(self, text: str):
+        if text:
+            text = text.lower()
+            for pattern in (self.hide_pattern, self.warn_pattern):
+                found = pattern.search(text) if pattern else None
+                if found:
+                    return self.names[found.group()]
+        return False
+
+
 @cache.memoize(timeout=300)
 def user_filters_home(user_id):
     filters = Filter.query.filter_by(user_id=user_id, filter_home=True).filter(or_(Filter.expire_after > date.today(), Filter.expire_after == None))
-    result = defaultdict(set)
-    for filter in filters:
-        keywords = [keyword.strip().lower() for keyword in filter.keywords.splitlines()]
-        if filter.hide_type == 0:
-            result[filter.title].update(keywords)
-        else:   # type == 1 means hide completely. These posts are excluded from output by the jinja template
-            result['-1'].update(keywords)
-    return result
+    return ContentFilters(filters)
 
 
 @cache.memoize(timeout=300)
 def user_filters_posts(user_id):
     filters = Filter.query.filter_by(user_id=user_id, filter_posts=True).filter(or_(Filter.expire_after > date.today(), Filter.expire_after == None))
-    result = defaultdict(set)
-    for filter in filters:
-        keywords = [keyword.strip().lower() for keyword in filter.keywords.splitlines()]
-        if filter.hide_type == 0:
-            result[filter.title].update(keywords)
-        else:
-            result['-1'].update(keywords)
-    return result
+    return ContentFilters(filters)
 
 
 @cache.memoize(timeout=300)
 def user_filters_replies(user_id):
     filters = Filter.query.filter_by(user_id=user_id, filter_replies=True).filter(or_(Filter.expire_after > date.today(), Filter.expire_after == None))
-    result = defaultdict(set)
-    for filter in filters:
-        keywords = [keyword.strip().lower() for keyword in filter.keywords.splitlines()]
-        if filter.hide_type == 0:
-            result[filter.title].update(keywords)
-        else:
-            result['-1'].update(keywords)
-    return result
+    return ContentFilters(filters)
 
 
 @cache.memoize(timeout=300)
@@ -633,15 +1263,216 @@ def epoch_seconds(date):
     return td.days * 86400 + td.seconds + (float(td.microseconds) / 1000000)
 
 
+# 'Hot' ranking of posts. Each strategy calculates the same thing twice - in python, for a single post as it arrives or is
+# voted on, and as a SQL expression over the score and posted_at columns, so rerank_posts() can recalculate every post
+# in the active window with one UPDATE. Which one is used is chosen by RANKING_STRATEGY.
+class RankingStrategy(ABC):
+    decays = False      # True if a post's ranking drops as it gets older, without any votes
+
+    @abstractmethod
+    def rank(self, score: int, date: datetime) -> float:
+        ...
+
+    # score is the SQL for the score to rank by, usually just the column
+    @abstractmethod
+    def sql(self, score: str = 'score') -> str:
+        ...
+
+
+# The ranking never changes unless the score does. Newer posts get a higher ranking because every 12.5 hours of age is
+# worth the same as a 10x difference in score.
+class RedditRanking(RankingStrategy):
+    def rank(self, score, date):
+        if date is None:
+            date = datetime.utcnow()
+        if score is None:
+            score = 1
+        order = math.log(max(abs(score), 1), 10)
+        sign = 1 if score > 0 else -1 if score < 0 else 0
+        seconds = epoch_seconds(date) - 1685766018
+        return round(sign * order + seconds / 45000, 7)
+
+    def sql(self, score='score'):
+        return f"""ROUND((SIGN(COALESCE({score}, 1)) * LOG(GREATEST(ABS(COALESCE({score}, 1)), 1))
+                          + (EXTRACT(EPOCH FROM COALESCE(posted_at, :now)) - 1685766018) / 45000)::numeric, 7)"""
+
+
+# Hacker News style - the score is divided by the age of the post, so rankings decay and need rerank_posts() to be run
+# every few minutes.
+class GravityRanking(RankingStrategy):
+    decays = True
+    gravity = 1.8
+
+    def rank(self, score, date):
+        if date is None:
+            date = datetime.utcnow()
+        if score is None:
+            score = 1
+        hours = max((datetime.utcnow() - date).total_seconds(), 0) / 3600
+        return round((score - 1) / (hours + 2) ** self.gravity, 7)
+
+    def sql(self, score='score'):
+        return f"""ROUND(((COALESCE({score}, 1) - 1)
+                          / POWER(GREATEST(EXTRACT(EPOCH FROM (:now - COALESCE(posted_at, :now))), 0) / 3600 + 2,
+                                  {self.gravity}))::numeric, 7)"""
+
+
+RANKING_STRATEGIES = {'reddit': RedditRanking(), 'gravity': GravityRanking()}
+
+
+def ranking_strategy() -> RankingStrategy:
+    return RANKING_STRATEGIES.get(current_app.config['RANKING_STRATEGY'], RANKING_STRATEGIES['reddit'])
+
+
 def post_ranking(score, date: datetime):
-    if date is None:
-        date = datetime.utcnow()
-    if score is None:
-        score = 1
-    order = math.log(max(abs(score), 1), 10)
-    sign = 1 if score > 0 else -1 if score < 0 else 0
-    seconds = epoch_seconds(date) - 1685766018
-    return round(sign * order + seconds / 45000, 7)
+    return ranking_strategy().rank(score, date)
+
+
+# Recalculate the ranking of every post made in the last RANKING_WINDOW_DAYS, in one statement. Rows whose ranking
+# has not changed are not written. Run by 'flask rerank' from cron. Returns the number of posts that changed.
+def rerank_posts() -> int:
+    strategy = ranking_strategy()
+    now = utcnow()
+    expression = strategy.sql()
+    changed = db.session.execute(text(f"""UPDATE "post" SET ranking = {expression}
+                                          WHERE posted_at > :window_start AND deleted = false
+                                          AND ranking IS DISTINCT FROM {expression}
+                                          RETURNING id, ranking"""),
+                                 {'now': now, 'window_start': now - timedelta(days=current_app.config['RANKING_WINDOW_DAYS'])}).fetchall()
+    db.session.commit()
+    if strategy.decays and changed and home_timelines_enabled():
+        rescore_home_timelines({post_id: ranking for post_id, ranking in changed})
+    return len(changed)
+
+
+# Update the scores of posts in every materialized home timeline that contains them, after their rankings changed.
+# Timelines are read and written a batch at a time and only the posts each one holds are written to it.
+def rescore_home_timelines(rankings: dict, batch_size: int = 500):
+    redis = redis_connection()
+    try:
+        keys = []
+        for key in redis.scan_iter(match=_home_timeline_key('*'), count=1000):
+            keys.append(key)
+            if len(keys) == batch_size:
+                _rescore_home_timeline_batch(redis, keys, rankings)
+                keys = []
+        if keys:
+            _rescore_home_timeline_batch(redis, keys, rankings)
+    except RedisError as e:
+        current_app.logger.warning(f'Home timelines not rescored: {e}')
+
+
+def _rescore_home_timeline_batch(redis, keys: list, rankings: dict):
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        pipe.zrange(key, 0, -1)
+    pipe_writes = redis.pipeline(transaction=False)
+    for key, members in zip(keys, pipe.execute()):
+        scores = {int(member): rankings[int(member)] or 0 for member in members if int(member) in rankings}
+        if scores:
+            pipe_writes.zadd(key, scores, xx=True)
+    pipe_writes.execute()
+
+
+# How one vote (or undoing one) changes the counters of a post or reply and the reputation of its author
+class VoteTally:
+    def __init__(self):
+        self.up_votes = 0
+        self.down_votes = 0
+        self.score = 0
+        self.reputation = 0
+
+
+def _vote_deltas_key() -> str:
+    return f"{current_app.config['CACHE_KEY_PREFIX']}:vote_deltas"
+
+
+# Popular posts get lots of votes at once, from web requests and from several celery workers. Rather than each of them
+# doing a read-modify-write of the post and author rows (which loses updates and makes them all wait for each other's
+# row locks) the counters are changed by atomic increments in SQL, as part of the caller's transaction. With
+# VOTE_WRITE_BEHIND (needs REDIS_URL) the increments are collected in a redis hash instead and folded into the database
+# by flush_vote_deltas() every minute or so, which writes each busy row once no matter how many votes it received. If
+# redis can't be reached the increments go to the database as usual.
+# target is the Post or PostReply that was voted on. It is updated in memory so the new counts can be displayed.
+def apply_vote_tally(target: Post | PostReply, tally: VoteTally):
+    if not (tally.up_votes or tally.down_votes or tally.score or tally.reputation):
+        return
+    table = 'post' if isinstance(target, Post) else 'post_reply'
+    for column in ('up_votes', 'down_votes', 'score'):
+        set_committed_value(target, column, (getattr(target, column) or 0) + getattr(tally, column))
+    if current_app.config['VOTE_WRITE_BEHIND'] and redis_connection() is not None:
+        key = _vote_deltas_key()
+        pipe = redis_connection().pipeline(transaction=False)
+        for column in ('up_votes', 'down_votes', 'score'):
+            if getattr(tally, column):
+                pipe.hincrbyfloat(key, f'{table}:{target.id}:{column}', getattr(tally, column))
+        if tally.reputation:
+            pipe.hincrbyfloat(key, f'user:{target.user_id}:reputation', tally.reputation)
+        try:
+            pipe.execute()
+            return
+        except RedisError as e:
+            current_app.logger.warning(f'Vote not written behind: {e}')
+    _increment_vote_counters(table, {target.id: {'up_votes': tally.up_votes, 'down_votes': tally.down_votes,
+                                                 'score': tally.score}},
+                             {target.user_id: tally.reputation} if tally.reputation else {})
+
+
+# Add the votes collected by apply_vote_tally() to the database. Returns the number of rows changed, or None if
+# another flush is already running.
+def flush_vote_deltas():
+    redis = redis_connection()
+    key = _vote_deltas_key()
+    if redis is None or not redis.set(key + ':lock', 1, nx=True, ex=300):
+        return None
+    try:
+        processing_key = key + ':processing'
+        # a batch left behind by a failed flush is retried before taking a new one
+        if not redis.exists(processing_key):
+            if not redis.exists(key):
+                return 0
+            # atomic, so votes that arrive from now on go into a new hash
+            redis.rename(key, processing_key)
+        counters = {'post': defaultdict(lambda: defaultdict(float)), 'post_reply': defaultdict(lambda: defaultdict(float))}
+        reputations = defaultdict(float)
+        for field, delta in redis.hgetall(processing_key).items():
+            table, row_id, column = field.decode().split(':')
+            if table == 'user':
+                reputations[int(row_id)] += float(delta)
+            else:
+                counters[table][int(row_id)][column] += float(delta)
+        _increment_vote_counters('post', counters['post'], {})
+        _increment_vote_counters('post_reply', counters['post_reply'], reputations)
+        db.session.commit()
+        redis.delete(processing_key)
+        return len(counters['post']) + len(counters['post_reply']) + len(reputations)
+    finally:
+        redis.delete(key + ':lock')
+
+
+# Rows are always updated in order of id so that concurrent transactions lock them in the same order and cannot deadlock
+def _increment_vote_counters(table: str, counters: dict, reputations: dict):
+    if counters:
+        params = [{'id': row_id, 'up_votes': deltas.get('up_votes', 0), 'down_votes': deltas.get('down_votes', 0),
+                   'score': deltas.get('score', 0)} for row_id, deltas in sorted(counters.items())]
+        if table == 'post':
+            now = utcnow()
+            for row in params:
+                row['now'] = now
+            db.session.execute(text(f"""UPDATE "post" SET up_votes = up_votes + :up_votes, down_votes = down_votes + :down_votes,
+                                        score = score + :score, ranking = {ranking_strategy().sql('(score + :score)')}
+                                        WHERE id = :id"""), params)
+        else:
+            db.session.execute(text("""UPDATE "post_reply" SET up_votes = up_votes + :up_votes, down_votes = down_votes + :down_votes,
+                                       score = score + :score WHERE id = :id"""), params)
+            # confidence() is not practical to write in SQL, so ranking is calculated from the new counts
+            rows = db.session.execute(text('SELECT id, up_votes, down_votes FROM "post_reply" WHERE id = ANY(:ids)'),
+                                      {'ids': [row_id for row_id in sorted(counters)]}).fetchall()
+            db.session.execute(text('UPDATE "post_reply" SET ranking = :ranking WHERE id = :id'),
+                               [{'id': row_id, 'ranking': confidence(up_votes, down_votes)} for row_id, up_votes, down_votes in rows])
+    if reputations:
+        db.session.execute(text('UPDATE "user" SET reputation = reputation + :reputation WHERE id = :id'),
+                           [{'id': user_id, 'reputation': delta} for user_id, delta in sorted(reputations.items())])
 
 
 # used for ranking comments
@@ -0,0 +1,101 @@
+# Compares the speed of allowlist_html() and markdown_to_html() with the BeautifulSoup implementation they replaced.
+# Usage: python benchmark_sanitizer.py
+import json
+import os
+import re
+import timeit
+
+import markdown2
+from bs4 import BeautifulSoup
+
+from app.utils import file_get_contents, _allowlist_html, allowlist_html, markdown_to_html
+
+
+# The previous implementation, kept here for comparison
+def reference_allowlist_html(html: str) -> str:
+    if html is None or html == '':
+        return ''
+    allowed_tags = ['p', 'strong', 'a', 'ul', 'ol', 'li', 'em', 'blockquote', 'cite', 'br', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'pre',
+                    'code', 'img', 'details', 'summary', 'table', 'tr', 'td', 'th', 'tbody', 'thead']
+    soup = BeautifulSoup(html, 'html.parser')
+    re_url = re.compile(r'(http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+)')
+    for tag in soup.find_all(text=True):
+        tags = []
+        url = False
+        for t in re_url.split(tag.string):
+            if re_url.match(t):
+                a = soup.new_tag("a", href=t)
+                a.string = t
+                tags.append(a)
+                url = True
+            else:
+                tags.append(t)
+        if url:
+            for t in tags:
+                tag.insert_before(t)
+            tag.extract()
+    for tag in soup.find_all():
+        if tag.name not in allowed_tags:
+            tag.extract()
+        else:
+            for attr in list(tag.attrs):
+                if attr not in ['href', 'src', 'alt']:
+                    del tag[attr]
+            if tag.name == 'a':
+                tag.attrs['rel'] = 'nofollow ugc'
+                tag.attrs['target'] = '_blank'
+            if tag.name == 'img':
+                tag.attrs['loading'] = 'lazy'
+            if tag.name == 'table':
+                tag.attrs['class'] = 'table'
+    return str(soup)
+
+
+def reference_markdown_to_html(markdown_text) -> str:
+    return reference_allowlist_html(markdown2.markdown(markdown_text, safe_mode=True, extras={'middle-word-em': False, 'tables': True}))
+
+
+# content and source.content of every object in the activities in testing_data
+def testing_data_bodies():
+    html_bodies, markdown_bodies = [], []
+
+    def walk(item):
+        if isinstance(item, dict):
+            if isinstance(item.get('content'), str):
+                html_bodies.append(item['content'])
+            if isinstance(item.get('source'), dict) and isinstance(item['source'].get('content'), str):
+                markdown_bodies.append(item['source']['content'])
+            for value in item.values():
+                walk(value)
+        elif isinstance(item, list):
+            for value in item:
+                walk(value)
+
+    for filename in sorted(os.listdir('testing_data')):
+        if filename.endswith('.json'):
+            walk(json.loads(file_get_contents(os.path.join('testing_data', filename))))
+    return html_bodies, markdown_bodies
+
+
+def run(name, function, bodies, number):
+    seconds = timeit.timeit(lambda: [function(body) for body in bodies], number=number)
+    print(f'{name:<40} {seconds * 1000 / (number * len(bodies)):8.3f} ms per body')
+
+
+if __name__ == '__main__':
+    html_bodies, markdown_bodies = testing_data_bodies()
+    # the testing data is only short comments, so also try something the size of a long post
+    long_markdown = '\n\n'.join(markdown_bodies * 20 + ['A list:\n\n* one https://example.com/one\n* two **bold** and _em_\n\n'
+                                                        '> quoted https://example.com/quote\n\n    code()\n'] * 20)
+    markdown_bodies.append(long_markdown)
+    html_bodies.append(reference_markdown_to_html(long_markdown))
+    number = 200
+
+    differences = sum(1 for body in html_bodies if reference_allowlist_html(body) != _allowlist_html(body))
+    print(f'{len(html_bodies)} HTML bodies, {len(markdown_bodies)} markdown bodies, '
+          f'{differences} sanitized differently by the two implementations')
+    run('allowlist_html (BeautifulSoup)', reference_allowlist_html, html_bodies, number)
+    run('allowlist_html (uncached)', _allowlist_html, html_bodies, number)
+    run('allowlist_html (cached)', allowlist_html, html_bodies, number)
+    run('markdown_to_html (BeautifulSoup)', reference_markdown_to_html, markdown_bodies, number)
+    run('markdown_to_html (cached)', markdown_to_html, markdown_bodies, number)
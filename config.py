@@ -18,12 +18,20 @@ class Config(object):
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD') or None
     MAIL_FROM = os.environ.get('MAIL_FROM') or None
     MAIL_ERRORS = os.environ.get('MAIL_ERRORS') is not None
+    MAIL_RATE_LIMIT = int(os.environ.get('MAIL_RATE_LIMIT') or 10)     # messages per second in bulk sends, across all workers if REDIS_URL is set, per worker if not
     ADMINS = os.environ.get('ADMINS')
     RECAPTCHA_PUBLIC_KEY = os.environ.get("RECAPTCHA_PUBLIC_KEY")
     RECAPTCHA_PRIVATE_KEY = os.environ.get("RECAPTCHA_PRIVATE_KEY")
     MODE = os.environ.get('MODE') or 'development'
     LANGUAGES = ['en']
     FULL_AP_CONTEXT = bool(int(os.environ.get('FULL_AP_CONTEXT', 0)))
+    INBOX_FAST_PATH = bool(int(os.environ.get('INBOX_FAST_PATH', 0)))   # /inbox returns 202 straight away and does all the work in celery
+    HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT') or 5)                    # seconds, for outgoing requests
+    HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS') or 100)  # how many hosts to keep connection pools for
+    HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE') or 10)           # keep-alive connections kept per host
+    FEDERATION_FANOUT_CONCURRENCY = int(os.environ.get('FEDERATION_FANOUT_CONCURRENCY') or 10)  # simultaneous deliveries when announcing to followers
+    OUTBOX_HOST_CONCURRENCY = int(os.environ.get('OUTBOX_HOST_CONCURRENCY') or 2)  # simultaneous retries to any one instance
+    OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS') or 12)         # retries before an undeliverable activity is dropped
     CACHE_TYPE = os.environ.get('CACHE_TYPE') or 'FileSystemCache'
     CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL') or 'redis://localhost:6379/1'
     CACHE_DIR = os.environ.get('CACHE_DIR') or '/dev/shm/pyfedi'
@@ -32,6 +40,11 @@ class Config(object):
     CACHE_KEY_PREFIX = 'pyfedi'
     CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL') or 'redis://localhost:6379/0'
     RESULT_BACKEND = os.environ.get('RESULT_BACKEND') or 'redis://localhost:6379/0'
+    REDIS_URL = os.environ.get('REDIS_URL') or None     # optional. Used for state shared between workers, e.g. inbox de-duplication
+    HOME_TIMELINES = bool(int(os.environ.get('HOME_TIMELINES', 0)))   # keep each user's home feed in redis. Needs REDIS_URL
+    RANKING_STRATEGY = os.environ.get('RANKING_STRATEGY') or 'reddit'   # how 'hot' is calculated. 'reddit' or 'gravity'
+    VOTE_WRITE_BEHIND = bool(int(os.environ.get('VOTE_WRITE_BEHIND', 0)))   # collect vote counts in redis, see flush_vote_deltas()
+    RANKING_WINDOW_DAYS = int(os.environ.get('RANKING_WINDOW_DAYS') or 7)   # posts older than this are not re-ranked
     SQLALCHEMY_ECHO = False     # set to true to see SQL in console
     WTF_CSRF_TIME_LIMIT = None  # a value of None ensures csrf token is valid for the lifetime of the session
 
@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+from config import Config
+
+
+class TestConfig(Config):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    SERVER_NAME = 'localhost'
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL')    # an empty postgres database, tables are created
+    CACHE_TYPE = 'NullCache'
+    REDIS_URL = None
+    HOME_TIMELINES = False
+    VOTE_WRITE_BEHIND = False
+
+
+# An app with a freshly created database. Tests that need one are skipped unless TEST_DATABASE_URL is set.
+@pytest.fixture
+def app():
+    if not TestConfig.SQLALCHEMY_DATABASE_URI:
+        pytest.skip('TEST_DATABASE_URL is not set')
+    from app import create_app, db
+    app = create_app(TestConfig)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
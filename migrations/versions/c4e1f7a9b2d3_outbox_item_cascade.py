@@ -0,0 +1,33 @@
+"""outbox item cascade
+
+Revision ID: c4e1f7a9b2d3
+Revises: a6c3e9d2f481
+Create Date: 2024-03-12 09:15:42.731806
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e1f7a9b2d3'
+down_revision = 'a6c3e9d2f481'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('outbox_item', schema=None) as batch_op:
+        batch_op.drop_constraint('outbox_item_user_id_fkey', type_='foreignkey')
+        batch_op.drop_constraint('outbox_item_community_id_fkey', type_='foreignkey')
+        batch_op.create_foreign_key('outbox_item_user_id_fkey', 'user', ['user_id'], ['id'], ondelete='CASCADE')
+        batch_op.create_foreign_key('outbox_item_community_id_fkey', 'community', ['community_id'], ['id'],
+                                    ondelete='CASCADE')
+
+
+def downgrade():
+    with op.batch_alter_table('outbox_item', schema=None) as batch_op:
+        batch_op.drop_constraint('outbox_item_community_id_fkey', type_='foreignkey')
+        batch_op.drop_constraint('outbox_item_user_id_fkey', type_='foreignkey')
+        batch_op.create_foreign_key('outbox_item_community_id_fkey', 'community', ['community_id'], ['id'])
+        batch_op.create_foreign_key('outbox_item_user_id_fkey', 'user', ['user_id'], ['id'])
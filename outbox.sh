@@ -0,0 +1,5 @@
+#!/bin/bash
+
+source venv/bin/activate
+export FLASK_APP=pyfedi.py
+flask outbox drain
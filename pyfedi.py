@@ -11,7 +11,8 @@ from flask import session, g, json, request, current_app
 from app.constants import POST_TYPE_LINK, POST_TYPE_IMAGE, POST_TYPE_ARTICLE
 from app.models import Site
 from app.utils import getmtime, gibberish, shorten_string, shorten_url, digits, user_access, community_membership, \
-    can_create_post, can_upvote, can_downvote, shorten_number, ap_datetime, current_theme
+    can_create_post, can_upvote, can_downvote, shorten_number, ap_datetime, current_theme, post_teaser_fragment, \
+    request_community_membership, request_user_access, post_vote_classes, reply_vote_classes
 
 app = create_app()
 cli.register(app)
@@ -35,15 +36,18 @@ with app.app_context():
     app.jinja_env.globals['digits'] = digits
     app.jinja_env.globals['str'] = str
     app.jinja_env.globals['shorten_number'] = shorten_number
-    app.jinja_env.globals['community_membership'] = community_membership
+    app.jinja_env.globals['community_membership'] = request_community_membership
     app.jinja_env.globals['json_loads'] = json.loads
-    app.jinja_env.globals['user_access'] = user_access
+    app.jinja_env.globals['user_access'] = request_user_access
     app.jinja_env.globals['ap_datetime'] = ap_datetime
     app.jinja_env.globals['can_create'] = can_create_post
     app.jinja_env.globals['can_upvote'] = can_upvote
     app.jinja_env.globals['can_downvote'] = can_downvote
     app.jinja_env.globals['theme'] = current_theme
     app.jinja_env.globals['file_exists'] = os.path.exists
+    app.jinja_env.globals['post_teaser_fragment'] = post_teaser_fragment
+    app.jinja_env.globals['post_vote_classes'] = post_vote_classes
+    app.jinja_env.globals['reply_vote_classes'] = reply_vote_classes
     app.jinja_env.filters['shorten'] = shorten_string
     app.jinja_env.filters['shorten_url'] = shorten_url
 
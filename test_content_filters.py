@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+
+from app.utils import ContentFilters
+
+
+def keyword_filter(title, keywords, hide_completely=False):
+    return SimpleNamespace(title=title, keywords='\n'.join(keywords), hide_type=1 if hide_completely else 0)
+
+
+def test_no_filters():
+    filters = ContentFilters([])
+    assert not filters
+    assert filters.match('anything at all') is False
+
+
+def test_warning_filter_returns_its_title():
+    filters = ContentFilters([keyword_filter('Politics', ['election', ' Senate '])])
+    assert filters
+    assert filters.match('Results of the ELECTION') == 'Politics'
+    assert filters.match('the senate voted') == 'Politics'
+    assert filters.match('cat pictures') is False
+    assert filters.match('') is False
+    assert filters.match(None) is False
+
+
+def test_hiding_wins_over_warning():
+    filters = ContentFilters([keyword_filter('Sport', ['football', 'cricket']),
+                              keyword_filter('Spoilers', ['football final'], hide_completely=True)])
+    assert filters.match('the cricket score') == 'Sport'
+    assert filters.match('who won the football final') == '-1'
+    assert filters.match('football practice') == 'Sport'
+
+
+def test_keyword_in_both_kinds_of_filter_hides():
+    filters = ContentFilters([keyword_filter('Warn', ['crypto']), keyword_filter('Hide', ['crypto'], hide_completely=True)])
+    assert filters.match('crypto news') == '-1'
+
+
+def test_keywords_are_not_regular_expressions():
+    filters = ContentFilters([keyword_filter('Symbols', ['c++', 'a.b'])])
+    assert filters.match('learning c++ today') == 'Symbols'
+    assert filters.match('axb') is False
+
+
+def test_first_filter_keeps_a_shared_keyword():
+    filters = ContentFilters([keyword_filter('First', ['news']), keyword_filter('Second', ['news'])])
+    assert filters.match('breaking news') == 'First'
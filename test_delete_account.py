@@ -0,0 +1,48 @@
+from app import db
+from app.models import User
+
+
+def test_delete_account_form_starts_deletion(app, client, monkeypatch):
+    user = User(user_name='leaving', email='leaving@example.com', verified=True)
+    db.session.add(user)
+    db.session.commit()
+    started = []
+    monkeypatch.setattr('app.user.routes.start_account_deletion',
+                        lambda user_id, stages, cleanup=None: started.append((user_id, stages, cleanup)))
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+
+    response = client.post('/delete_account', data={'submit': 'Yes, delete my account'})
+
+    assert response.status_code == 302
+    assert started == [(user.id, ['account', 'finish'], None)]
+    assert User.query.get(user.id).banned
+
+
+def test_deletion_without_redis_finishes_after_the_grace_period(app, monkeypatch):
+    import app.user.utils as user_utils
+    user = User(user_name='leaving', email='leaving@example.com', verified=True)
+    db.session.add(user)
+    db.session.commit()
+    federated = []
+    rescheduled = []
+    monkeypatch.setattr(user_utils, 'federate_account_deletion', lambda user, checkpoint: federated.append(user.id))
+    monkeypatch.setattr(user_utils.delete_account_task, 'apply_async',
+                        lambda args, countdown: rescheduled.append(args))
+    monkeypatch.setattr(app, 'debug', False)
+    now = 1_000_000.0
+    monkeypatch.setattr(user_utils, 'time', lambda: now)
+
+    user_utils.delete_account_task(user.id, ['account', 'finish'])
+
+    assert federated == [user.id]
+    assert rescheduled == [(user.id, ['finish'], None, now + user_utils.ACCOUNT_DELETION_GRACE)]
+    assert not User.query.get(user.id).deleted
+
+    now += user_utils.ACCOUNT_DELETION_GRACE + 1
+    user_utils.delete_account_task(*rescheduled[0])
+
+    assert federated == [user.id]
+    assert len(rescheduled) == 1
+    assert User.query.get(user.id).deleted
@@ -0,0 +1,90 @@
+import hashlib
+
+import pytest
+import redis
+from flask import Flask
+
+import app.activitypub.util as activitypub_util
+from app.activitypub.util import _ingested_filter_positions, ingested_filter_might_contain, mark_activity_ingested, \
+    INGESTED_FILTER_BITS, INGESTED_FILTER_HASHES
+
+
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+        self.fail_writes = False
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+
+class FakePipeline:
+    def __init__(self, r):
+        self.r = r
+        self.commands = []
+
+    def exists(self, key):
+        self.commands.append(lambda: int(key in self.r.values))
+
+    def getbit(self, key, position):
+        self.commands.append(lambda: self.r.values.get((key, position), 0))
+
+    def setbit(self, key, position, value):
+        if self.r.fail_writes:
+            raise redis.exceptions.ConnectionError('redis went away')
+        self.commands.append(lambda: self.r.values.__setitem__((key, position), value))
+
+    def expire(self, key, time):
+        self.commands.append(lambda: True)
+
+    def execute(self):
+        return [command() for command in self.commands]
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    r = FakeRedis()
+    monkeypatch.setattr(activitypub_util, 'redis_connection', lambda: r)
+    monkeypatch.setattr(activitypub_util, '_ingested_filter_write_failed', False)
+    flask_app = Flask(__name__)
+    flask_app.config['CACHE_KEY_PREFIX'] = 'test'
+    with flask_app.app_context():
+        yield r
+
+
+def test_bit_positions():
+    ap_id = 'https://example.com/activities/like/1'
+    positions = _ingested_filter_positions(ap_id)
+    digest = hashlib.sha256(ap_id.encode('utf-8')).digest()
+    assert len(positions) == INGESTED_FILTER_HASHES
+    assert positions[0] == int.from_bytes(digest[:4], 'big') % INGESTED_FILTER_BITS
+    assert all(0 <= position < INGESTED_FILTER_BITS for position in positions)
+    assert positions == _ingested_filter_positions(ap_id)
+    assert positions != _ingested_filter_positions('https://example.com/activities/like/2')
+
+
+def test_negative_is_not_trusted_until_warm(fake_redis):
+    assert ingested_filter_might_contain('https://example.com/a/1') is None
+    mark_activity_ingested('https://example.com/a/1')
+    assert ingested_filter_might_contain('https://example.com/a/1') is True
+
+
+def test_negative_is_trusted_when_warm(fake_redis):
+    fake_redis.set('test:ingested:warm', 1)
+    assert ingested_filter_might_contain('https://example.com/a/2') is False
+    mark_activity_ingested('https://example.com/a/2')
+    assert ingested_filter_might_contain('https://example.com/a/2') is True
+
+
+def test_failed_write_makes_the_filter_cold(fake_redis):
+    fake_redis.set('test:ingested:warm', 1)
+    fake_redis.fail_writes = True
+    mark_activity_ingested('https://example.com/a/3')
+    assert ingested_filter_might_contain('https://example.com/a/3') is None
@@ -0,0 +1,55 @@
+from datetime import datetime
+
+from app.models import Post, PostReply
+from app.utils import _encode_cursor, _decode_cursor, _keyset_beyond, _keyset_values, post_sort_columns
+
+
+def test_cursor_round_trip():
+    columns = post_sort_columns('hot')
+    posted_at = datetime(2024, 3, 1, 12, 30, 5)
+    cursor = _encode_cursor('next', [12.5, posted_at, 42])
+    assert '=' not in cursor
+    assert _decode_cursor(cursor, columns) == ('next', [12.5, posted_at, 42])
+
+
+def test_prev_cursor_round_trip():
+    columns = [PostReply.posted_at, PostReply.id]
+    posted_at = datetime(2023, 12, 31, 23, 59, 59)
+    assert _decode_cursor(_encode_cursor('prev', [posted_at, 7]), columns) == ('prev', [posted_at, 7])
+
+
+def test_bad_cursors_start_from_the_beginning():
+    columns = post_sort_columns('new')
+    assert _decode_cursor('not a cursor', columns) == ('next', None)
+    assert _decode_cursor(_encode_cursor('sideways', [datetime(2024, 1, 1), 1]), columns) == ('next', None)
+    assert _decode_cursor(_encode_cursor('next', [1]), columns) == ('next', None)
+    assert _decode_cursor(_encode_cursor('next', [None, 1]), columns) == ('next', None)
+
+
+def test_cursors_can_hold_nulls_in_nullable_columns():
+    columns = post_sort_columns('hot')
+    values = _keyset_values(Post(id=9, ranking=None, posted_at=None), columns)
+    assert values == [None, None, 9]
+    assert _decode_cursor(_encode_cursor('next', values), columns) == ('next', values)
+    assert _decode_cursor(_encode_cursor('next', [1.5, None, None]), columns) == ('next', None)
+
+
+# The SQL for a condition, without the brackets so the tests don't depend on how SQLAlchemy nests them
+def compiled(condition):
+    return str(condition.compile(compile_kwargs={'literal_binds': True})).replace('(', '').replace(')', '')
+
+
+def test_conditions_compare_the_bare_columns():
+    columns = post_sort_columns('top')
+    sql = compiled(_keyset_beyond(columns, [10, 42], descending=True))
+    assert 'coalesce' not in sql.lower()
+    assert sql == 'post.score < 10 OR post.score = 10 AND post.id < 42 OR post.score IS NULL'
+    assert compiled(_keyset_beyond(columns, [10, 42], descending=False)) == \
+        'post.score > 10 OR post.score = 10 AND post.id > 42'
+
+
+def test_conditions_after_a_null():
+    columns = post_sort_columns('top')
+    assert compiled(_keyset_beyond(columns, [None, 42], descending=True)) == 'post.score IS NULL AND post.id < 42'
+    assert compiled(_keyset_beyond(columns, [None, 42], descending=False)) == \
+        'post.score IS NOT NULL OR post.score IS NULL AND post.id > 42'
@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import text
+
+from app import db
+from app.utils import RankingStrategy, RedditRanking, GravityRanking, RANKING_STRATEGIES
+
+CASES = [(1, 0), (10, 3), (-5, 30), (0, 100), (250, 2), (None, 5)]
+
+
+def test_strategies_must_implement_rank_and_sql():
+    class Incomplete(RankingStrategy):
+        def rank(self, score, date):
+            return 0.0
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_reddit_ranking_prefers_newer_and_higher_scoring_posts():
+    strategy = RedditRanking()
+    now = datetime.utcnow()
+    assert strategy.rank(10, now) > strategy.rank(10, now - timedelta(hours=1))
+    assert strategy.rank(100, now) > strategy.rank(10, now)
+    assert strategy.rank(-10, now) < strategy.rank(0, now)
+
+
+def test_gravity_ranking_decays():
+    strategy = GravityRanking()
+    now = datetime.utcnow()
+    assert strategy.decays
+    assert strategy.rank(50, now - timedelta(hours=1)) > strategy.rank(50, now - timedelta(hours=10))
+
+
+# The SQL used by rerank_posts() has to agree with the python used as posts arrive
+@pytest.mark.parametrize('name', RANKING_STRATEGIES.keys())
+@pytest.mark.parametrize('score, hours_old', CASES)
+def test_python_and_sql_agree(app, name, score, hours_old):
+    strategy = RANKING_STRATEGIES[name]
+    now = datetime.utcnow()
+    posted_at = now - timedelta(hours=hours_old)
+    in_sql = db.session.execute(text(f"""SELECT {strategy.sql()} FROM (SELECT CAST(:score AS integer) AS score,
+                                         CAST(:posted_at AS timestamp) AS posted_at) p"""),
+                                {'score': score, 'posted_at': posted_at, 'now': now}).scalar()
+    assert float(in_sql) == pytest.approx(strategy.rank(score, posted_at), abs=1e-5)
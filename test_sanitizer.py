@@ -0,0 +1,60 @@
+import pytest
+
+from app.utils import _allowlist_html, allowlist_html, unsafe_url
+
+
+@pytest.mark.parametrize('href', ['javascript:alert(1)', ' JaVaScRiPt:alert(1)', 'java&#x09;script:alert(1)',
+                                  'jav&#10;ascript:alert(1)', '&#x01;javascript:alert(1)', 'vbscript:msgbox(1)',
+                                  'data:text/html;base64,PHNjcmlwdD4='])
+def test_unsafe_schemes_are_removed(href):
+    assert _allowlist_html(f'<a href="{href}">x</a>') == '<a rel="nofollow ugc" target="_blank">x</a>'
+
+
+def test_unsafe_image_source_is_removed():
+    assert _allowlist_html('<img src="data:image/png;base64,AAAA" alt="pic">') == '<img alt="pic" loading="lazy"/>'
+
+
+@pytest.mark.parametrize('url', ['https://example.com/', 'http://example.com/javascript:', 'mailto:a@example.com',
+                                 '/relative/path'])
+def test_safe_urls(url):
+    assert not unsafe_url(url)
+
+
+def test_attributes_not_allowed_are_dropped():
+    assert _allowlist_html('<a href="https://example.com/" onclick="evil()" class="c">link</a>') == \
+        '<a href="https://example.com/" rel="nofollow ugc" target="_blank">link</a>'
+
+
+def test_tags_not_allowed_are_dropped_with_their_contents():
+    assert _allowlist_html('<p>before<script>alert(1)</script>after</p>') == '<p>beforeafter</p>'
+    assert _allowlist_html('<style>p {}</style><p>kept</p>') == '<p>kept</p>'
+
+
+def test_plain_text_links_are_linked():
+    assert _allowlist_html('<p>visit https://example.com/ now</p>') == \
+        '<p>visit <a href="https://example.com/" rel="nofollow ugc" target="_blank">https://example.com/</a> now</p>'
+
+
+def test_links_inside_a_tags_are_not_linked_again():
+    assert _allowlist_html('<a href="https://example.com/">see https://example.com/ here</a>') == \
+        '<a href="https://example.com/" rel="nofollow ugc" target="_blank">see https://example.com/ here</a>'
+
+
+def test_unclosed_and_stray_tags():
+    assert _allowlist_html('<p><strong>bold') == '<p><strong>bold</strong></p>'
+    assert _allowlist_html('<p>a</em>b</p>') == '<p>ab</p>'
+
+
+def test_text_stays_escaped():
+    assert _allowlist_html('<p>1 &lt; 2</p>') == '<p>1 &lt; 2</p>'
+
+
+def test_tables_get_a_class():
+    assert _allowlist_html('<table><tr><td>1</td></tr></table>') == '<table class="table"><tr><td>1</td></tr></table>'
+
+
+def test_cached_result_matches():
+    html = '<p>cached https://example.com/</p>'
+    assert allowlist_html(html) == _allowlist_html(html)
+    assert allowlist_html(html) == _allowlist_html(html)
+    assert allowlist_html('') == ''
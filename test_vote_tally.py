@@ -0,0 +1,48 @@
+import pytest
+from flask import Flask
+from redis.exceptions import ConnectionError
+
+import app.utils as utils
+from app.models import Post
+from app.utils import VoteTally, apply_vote_tally
+
+
+class BrokenPipeline:
+    def hincrbyfloat(self, key, field, amount):
+        pass
+
+    def execute(self):
+        raise ConnectionError('redis went away')
+
+
+class BrokenRedis:
+    def pipeline(self, transaction=True):
+        return BrokenPipeline()
+
+
+@pytest.fixture
+def write_behind_app():
+    flask_app = Flask(__name__)
+    flask_app.config.update(CACHE_KEY_PREFIX='test', VOTE_WRITE_BEHIND=True)
+    with flask_app.app_context():
+        yield flask_app
+
+
+def test_votes_go_to_the_database_when_redis_fails(write_behind_app, monkeypatch):
+    increments = []
+    monkeypatch.setattr(utils, 'redis_connection', lambda: BrokenRedis())
+    monkeypatch.setattr(utils, '_increment_vote_counters', lambda *args: increments.append(args))
+    post = Post(id=3, user_id=8, up_votes=4, down_votes=0, score=4)
+    tally = VoteTally()
+    tally.up_votes = 1
+    tally.score = 1
+    tally.reputation = 1
+
+    apply_vote_tally(post, tally)
+
+    assert (post.up_votes, post.score) == (5, 5)
+    assert increments == [('post', {3: {'up_votes': 1, 'down_votes': 0, 'score': 1}}, {8: 1})]
+
+
+def test_vote_deltas_key_is_prefixed(write_behind_app):
+    assert utils._vote_deltas_key() == 'test:vote_deltas'
@@ -0,0 +1,33 @@
+from app.models import User
+
+
+def test_new_votes_are_counted():
+    user = User(upvotes_cast=0, downvotes_cast=0)
+    user.vote_changed(None, 1.0)
+    user.vote_changed(None, 1.0)
+    user.vote_changed(None, -1.0)
+    assert (user.upvotes_cast, user.downvotes_cast) == (2, 1)
+    assert user.attitude == (2 - 1) / (2 + 1)
+
+
+def test_reversed_vote_moves_between_counters():
+    user = User(upvotes_cast=3, downvotes_cast=1)
+    user.vote_changed(1.0, -1.0)
+    assert (user.upvotes_cast, user.downvotes_cast) == (2, 2)
+    assert user.attitude == 0
+
+
+def test_removed_vote_is_subtracted_but_never_below_zero():
+    user = User(upvotes_cast=1, downvotes_cast=0)
+    user.vote_changed(1.0, None)
+    user.vote_changed(1.0, None)
+    user.vote_changed(-1.0, None)
+    assert (user.upvotes_cast, user.downvotes_cast) == (0, 0)
+    assert user.attitude == 1.0
+
+
+def test_counters_that_were_never_set():
+    user = User()
+    user.vote_changed(None, -1.0)
+    assert (user.upvotes_cast, user.downvotes_cast) == (0, 1)
+    assert user.attitude == -1.0